@@ -0,0 +1,713 @@
+#!/usr/bin/python3
+
+# Benchmarks of the audio pipeline. Plays generated audio through real guilds and playlists, with a
+# stand-in for discord's voice client that reads packets the same way discord's audio player does,
+# and against a synthetic library of empty files. Measures:
+#   - start: time from /start to the first packet, per kind of track.
+#   - ff: time from /seek or /ff to the first packet played from the new position.
+#   - transitions: silence between consecutive tracks, and time spent in each packet read.
+#   - streams: CPU and memory used per concurrently-playing guild.
+#   - library: time to catalog a large library, and the time and memory to create a guild.
+#   - search: time to index the large library's track names, and to answer queries against it.
+#   - stalls: late packets while reads from storage stall now and then, with and without buffering.
+#
+# Requires ffmpeg, and Linux for the per-process statistics. Results are printed to stdout as JSON,
+# so that they can be compared between releases; logs go to stderr.
+#
+# Usage: python3 bench.py [--only start ff ...] > results.json
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from typing import Any, Callable, cast, Optional
+
+import discord
+
+import cache
+import catalog
+import encoders
+import guilds
+import messages
+import ogg
+import search
+import utils
+
+_BENCHMARKS: list[str] = ['start', 'ff', 'transitions', 'streams', 'library', 'search',
+                          'stalls']
+
+# discord's player sends one packet every 20ms.
+_PACKET_TIME_S: float = 0.02
+
+# Upper bound on the time to wait for any one packet.
+_PACKET_TIMEOUT_S: float = 30.0
+
+# Upper bound on the time to wait for the track cache to fill.
+_CACHE_TIMEOUT_S: float = 120.0
+
+# Length of the tracks used to measure fast-forwarding and concurrent streams.
+_LONG_TRACK_S: int = 120
+
+# Number of directories the synthetic library is spread across, and playlists carved out of it.
+_LIBRARY_DIRS: int = 100
+_LIBRARY_PLAYLISTS: int = 10
+
+# Simulated storage stalls: how long each lasts, and how many packets are read between them.
+_STALL_S: float = 0.3
+_STALL_EVERY: int = 100
+
+# Read-ahead compared against none when reads stall.
+_STALL_READ_AHEAD: datetime.timedelta = datetime.timedelta(milliseconds=500)
+
+# Queries typed a character at a time against the synthetic library, from matching nearly every
+# track to matching a few.
+_SEARCH_QUERIES: list[str] = ['t', 'tr', 'tra', 'track', 'track-', 'track-0', 'track-00',
+                              'track-000', 'track-0004', 'ck-01', '99']
+
+
+# Returns summary statistics of the given durations, in milliseconds.
+def _stats(values_s: list[float]) -> dict[str, Any]:
+  if not values_s:
+    return {'count': 0}
+
+  ms: list[float] = sorted(v * 1000 for v in values_s)
+  return {
+      'count': len(ms),
+      'mean_ms': round(statistics.fmean(ms), 3),
+      'median_ms': round(statistics.median(ms), 3),
+      'p95_ms': round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 3),
+      'max_ms': round(ms[-1], 3),
+  }
+
+
+# Returns the (CPU seconds, resident bytes) of every child process of this one, keyed by pid.
+def _child_usage() -> dict[int, tuple[float, int]]:
+  ticks: int = os.sysconf('SC_CLK_TCK')
+  page_size: int = os.sysconf('SC_PAGE_SIZE')
+
+  usage: dict[int, tuple[float, int]] = {}
+  for pid in os.listdir('/proc'):
+    if not pid.isdigit():
+      continue
+
+    try:
+      with open(f'/proc/{pid}/stat') as f:
+        # The command name may contain spaces, so split after it.
+        fields: list[str] = f.read().rsplit(')', 1)[1].split()
+      if int(fields[1]) != os.getpid():
+        continue
+
+      with open(f'/proc/{pid}/statm') as f:
+        rss: int = int(f.read().split()[1]) * page_size
+    except (OSError, IndexError, ValueError):
+      continue
+
+    usage[int(pid)] = ((int(fields[11]) + int(fields[12])) / ticks, rss)
+
+  return usage
+
+
+# Returns the resident bytes of this process.
+def _own_rss() -> int:
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# Returns the CPU seconds used by this process.
+def _own_cpu() -> float:
+  usage: resource.struct_rusage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+# Generates a tone of the given length with ffmpeg, at about the loudness to which tracks are
+# normalised, so that Opus fixtures are played natively.
+def _generate(path: str, seconds: int, frequency: int) -> None:
+  subprocess.run(['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                  '-i', f'sine=frequency={frequency}:duration={seconds}', '-filter:a', 'volume=6dB',
+                  '-ac', '2', path],
+                 stdin=subprocess.DEVNULL, check=True)
+
+
+# Makes every in-process read of an Ogg Opus file stall for a while, once every so many packets, as
+# if the file were on a slow network mount.
+@contextlib.contextmanager
+def _stalling_reads(stall_s: float, every: int) -> Any:
+  read: Callable[[ogg.OggOpusAudio], bytes] = ogg.OggOpusAudio.read
+  count: list[int] = [0]
+
+  def stalling_read(source: ogg.OggOpusAudio) -> bytes:
+    count[0] += 1
+    if count[0] % every == 0:
+      time.sleep(stall_s)
+    return read(source)
+
+  setattr(ogg.OggOpusAudio, 'read', stalling_read)
+  try:
+    yield
+  finally:
+    setattr(ogg.OggOpusAudio, 'read', read)
+
+
+# Records when each packet was read, and from which stream. Written from player threads.
+class _PacketLog:
+
+  def __init__(self):
+    self._lock: threading.Lock = threading.Lock()
+
+    # Tuples of (time read, time spent reading, id of the stream read from).
+    self._packets: list[tuple[float, float, int]] = []
+
+  def Record(self, at: float, took: float, stream: int) -> None:
+    with self._lock:
+      self._packets.append((at, took, stream))
+
+  # Returns a copy of the packets read so far.
+  def Get(self) -> list[tuple[float, float, int]]:
+    with self._lock:
+      return list(self._packets)
+
+  # Waits for a packet read after the given time, optionally from a stream other than the given one,
+  # and returns the time at which it was read.
+  async def WaitForPacket(self, after: float, not_stream: Optional[int] = None) -> float:
+    deadline: float = time.perf_counter() + _PACKET_TIMEOUT_S
+    seen: int = 0
+    while time.perf_counter() < deadline:
+      packets: list[tuple[float, float, int]] = self.Get()
+      for at, _, stream in packets[seen:]:
+        if at >= after and stream != not_stream:
+          return at
+      seen = len(packets)
+      await asyncio.sleep(0.001)
+
+    raise TimeoutError('No packet was played.')
+
+  # Returns the id of the stream of the last packet read, if any.
+  def last_stream(self) -> Optional[int]:
+    with self._lock:
+      return self._packets[-1][2] if self._packets else None
+
+
+# Plays a source on its own thread, pacing reads like discord's AudioPlayer (or as fast as possible
+# if not realtime), and calls back once the source ends or is stopped.
+class _FakePlayer(threading.Thread):
+
+  def __init__(self, source: discord.AudioSource, after: Optional[Callable[[Any], None]],
+               log: _PacketLog, realtime: bool):
+    super().__init__(name='fake-player', daemon=True)
+    self._source: discord.AudioSource = source
+    self._after: Optional[Callable[[Any], None]] = after
+    self._log: _PacketLog = log
+    self._realtime: bool = realtime
+    self._end: threading.Event = threading.Event()
+
+  def run(self) -> None:
+    error: Optional[Exception] = None
+    try:
+      self._Play()
+    except Exception as e:
+      error = e
+      self._end.set()
+    finally:
+      # As in discord, the callback runs before the source is cleaned up.
+      if self._after:
+        self._after(error)
+      self._source.cleanup()
+
+  def Stop(self) -> None:
+    self._end.set()
+
+  @property
+  def playing(self) -> bool:
+    return not self._end.is_set()
+
+  def _Play(self) -> None:
+    loops: int = 0
+    start: float = time.perf_counter()
+    while not self._end.is_set():
+      before: float = time.perf_counter()
+      data: bytes = self._source.read()
+      now: float = time.perf_counter()
+      if not data:
+        self._end.set()
+        return
+
+      # Identify the underlying track, so that gapless swaps count as a change of stream.
+      stream: object = getattr(self._source, '_stream', self._source)
+      self._log.Record(now, now - before, id(stream))
+
+      if self._realtime:
+        loops += 1
+        next_time: float = start + _PACKET_TIME_S * loops
+        time.sleep(max(0.0, _PACKET_TIME_S + (next_time - time.perf_counter())))
+
+
+# Stands in for discord.VoiceClient, with just the members that guilds use.
+class _FakeVoiceClient:
+
+  def __init__(self, channel: object, realtime: bool = True):
+    self.loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    self.channel: object = channel
+    self.packets: _PacketLog = _PacketLog()
+    self._realtime: bool = realtime
+    self._player: Optional[_FakePlayer] = None
+    # Every player started, including stopped ones that may still be finishing.
+    self._players: list[_FakePlayer] = []
+
+  def play(self, source: discord.AudioSource,
+           after: Optional[Callable[[Any], None]] = None) -> None:
+    if self.is_playing():
+      raise discord.ClientException('Already playing audio.')
+
+    self._player = _FakePlayer(source, after, self.packets, self._realtime)
+    self._player.start()
+    self._players = [p for p in self._players if p.is_alive()] + [self._player]
+
+  def stop(self) -> None:
+    if self._player:
+      self._player.Stop()
+      self._player = None
+
+  def is_playing(self) -> bool:
+    return self._player is not None and self._player.playing
+
+  # Unlike stop, waits for every player to finish calling back and cleaning up its source.
+  async def disconnect(self) -> None:
+    self.stop()
+    for player in self._players:
+      await utils.run_blocking(player.join)
+    self._players = []
+
+
+class _FakeVoiceState:
+
+  def __init__(self, channel: object):
+    self.channel: object = channel
+
+
+# Passes guilds' isinstance checks without a connection to Discord.
+class _FakeMember(discord.Member):
+
+  def __init__(self, channel: object):
+    self._voice: _FakeVoiceState = _FakeVoiceState(channel)
+
+  @property
+  def voice(self) -> Any:
+    return self._voice
+
+
+# Stands in for the context of a slash command issued from the bot's voice channel.
+class _FakeMessage:
+
+  def __init__(self, messages: list[str]):
+    self._messages: list[str] = messages
+
+  async def edit(self, content: str) -> None:
+    self._messages.append(content)
+
+
+class _FakeContext:
+
+  def __init__(self, realtime: bool = True):
+    channel: object = object()
+    self.voice_client: _FakeVoiceClient = _FakeVoiceClient(channel, realtime)
+    self.author: _FakeMember = _FakeMember(channel)
+    self.guild: Optional[discord.Guild] = None
+    self.bot: Any = None
+    self.channel_id: int = 0
+    self.messages: list[str] = []
+
+  async def send(self, message: str) -> _FakeMessage:
+    self.messages.append(message)
+    return _FakeMessage(self.messages)
+
+  async def respond(self, message: str) -> None:
+    self.messages.append(message)
+
+
+class _Benchmarks:
+
+  def __init__(self, args: argparse.Namespace, directory: str):
+    self._args: argparse.Namespace = args
+    self._directory: str = directory
+    self._supervisor: encoders.Supervisor = encoders.Supervisor(args.max_encoders)
+    self._sender: messages.Sender = messages.Sender()
+    self._guild_ids: int = 0
+
+    # Every guild created, with its context if it has one, to be closed once done.
+    self._guilds: list[tuple[guilds.ShiloGuild, Optional[_FakeContext]]] = []
+
+    # Short tracks for transitions, and long ones for everything else.
+    self._fixtures: dict[str, list[str]] = {}
+    self._catalog: Optional[catalog.Catalog] = None
+    self._cache: Optional[cache.TrackCache] = None
+    self._library_config: Optional[dict[str, list[str]]] = None
+
+  async def Run(self, names: list[str]) -> dict[str, Any]:
+    results: dict[str, Any] = {'meta': self._Meta()}
+    for name in names:
+      utils.log(utils.LogSeverity.INFO, f'Running benchmark "{name}".')
+      results[name] = await getattr(self, f'_Bench{name.capitalize()}')()
+    await self._Close()
+    return results
+
+  # Stops playback and background work while the event loop is still running, so that none of it
+  # outlives the loop.
+  async def _Close(self) -> None:
+    for guild, ctx in self._guilds:
+      if ctx:
+        await ctx.voice_client.disconnect()
+      guild.Close()
+    self._guilds = []
+    self._sender.Close()
+    # Let the cancelled tasks finish.
+    await asyncio.sleep(0)
+
+  def _Meta(self) -> dict[str, Any]:
+    ffmpeg_version: str = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE,
+                                         check=True).stdout.decode().split('\n')[0]
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'ffmpeg': ffmpeg_version,
+        'args': vars(self._args),
+    }
+
+  # Generates the audio fixtures and catalogs them (with loudness analysis) on first use.
+  def _EnsureFixtures(self) -> catalog.Catalog:
+    if self._catalog:
+      return self._catalog
+
+    audio_dir: str = os.path.join(self._directory, 'audio')
+    os.makedirs(audio_dir)
+    for ext in ['mp3', 'opus']:
+      short: list[str] = []
+      for i in range(self._args.tracks):
+        short.append(os.path.join(audio_dir, f'short-{i}.{ext}'))
+        _generate(short[-1], self._args.track_seconds, 220 + 110 * i)
+      self._fixtures[f'short-{ext}'] = short
+
+      long_path: str = os.path.join(audio_dir, f'long.{ext}')
+      _generate(long_path, _LONG_TRACK_S, 440)
+      self._fixtures[f'long-{ext}'] = [long_path]
+
+    self._catalog = catalog.Catalog(
+        {name: paths for name, paths in self._fixtures.items()},
+        catalog.LibraryIndex(os.path.join(self._directory, 'fixtures.db')))
+    self._catalog.Probe()
+    return self._catalog
+
+  # Returns a fresh guild serving the fixture playlists, along with a context for commanding it.
+  def _NewGuild(self, track_cache: Optional[cache.TrackCache] = None, realtime: bool = True,
+                read_ahead: datetime.timedelta = datetime.timedelta()
+                ) -> tuple[guilds.ShiloGuild, _FakeContext]:
+    self._guild_ids += 1
+    guild: guilds.ShiloGuild = guilds.ShiloGuild(self._guild_ids, self._EnsureFixtures(),
+                                                 self._supervisor, track_cache,
+                                                 read_ahead=read_ahead, sender=self._sender)
+    ctx: _FakeContext = _FakeContext(realtime)
+    self._guilds.append((guild, ctx))
+    return guild, ctx
+
+  # Returns a track cache holding every long fixture.
+  async def _EnsureCache(self) -> cache.TrackCache:
+    if self._cache:
+      return self._cache
+
+    self._cache = cache.TrackCache(os.path.join(self._directory, 'cache'), 2**30)
+    guild, ctx = self._NewGuild(self._cache)
+
+    # Playing a track schedules it to be cached.
+    await guild.Start(cast(Any, ctx), 'long-mp3')
+    await guild.Stop(cast(Any, ctx))
+
+    deadline: float = time.perf_counter() + _CACHE_TIMEOUT_S
+    while not any(n.endswith('.opus') for n in os.listdir(os.path.join(self._directory, 'cache'))):
+      if time.perf_counter() > deadline:
+        raise TimeoutError('Track wasn\'t cached.')
+      await asyncio.sleep(0.1)
+
+    return self._cache
+
+  # Time from /start to the first packet, for native Opus, transcoded and cached tracks.
+  async def _BenchStart(self) -> dict[str, Any]:
+    kinds: dict[str, tuple[str, Optional[cache.TrackCache]]] = {
+        'native': ('long-opus', None),
+        'transcoded': ('long-mp3', None),
+        'cached': ('long-mp3', await self._EnsureCache()),
+    }
+
+    results: dict[str, Any] = {}
+    for kind, (playlist_name, track_cache) in kinds.items():
+      guild, ctx = self._NewGuild(track_cache)
+      latencies: list[float] = []
+      for _ in range(self._args.repeats):
+        began: float = time.perf_counter()
+        await guild.Restart(cast(Any, ctx), playlist_name)
+        latencies.append(await ctx.voice_client.packets.WaitForPacket(began) - began)
+        await guild.Stop(cast(Any, ctx))
+
+      results[kind] = _stats(latencies)
+
+    return results
+
+  # Time from /seek to the first packet of the new stream (including the wait to merge any further
+  # requests), and from a short /ff to the next packet played from the new position, for native Opus
+  # and transcoded tracks. A native track skips in place, while a transcoded one (unbuffered) starts
+  # a new stream.
+  async def _BenchFf(self) -> dict[str, Any]:
+    results: dict[str, Any] = {}
+    for kind, playlist_name in [('native', 'long-opus'), ('transcoded', 'long-mp3')]:
+      guild, ctx = self._NewGuild()
+      await guild.Restart(cast(Any, ctx), playlist_name)
+
+      seeks: list[float] = []
+      skips: list[float] = []
+      for i in range(self._args.repeats):
+        await asyncio.sleep(0.5)
+        stream: Optional[int] = ctx.voice_client.packets.last_stream()
+        began: float = time.perf_counter()
+        await guild.Seek(cast(Any, ctx), f'{_LONG_TRACK_S // 4 * (1 + i % 2)}s')
+        seeks.append(await ctx.voice_client.packets.WaitForPacket(began, stream) - began)
+
+        await asyncio.sleep(0.5)
+        stream = ctx.voice_client.packets.last_stream() if kind == 'transcoded' else None
+        began = time.perf_counter()
+        await guild.FastForward(cast(Any, ctx), '1s')
+        skips.append(await ctx.voice_client.packets.WaitForPacket(began, stream) - began)
+
+      await guild.Stop(cast(Any, ctx))
+      results[kind] = {'seek': _stats(seeks), 'skip': _stats(skips)}
+
+    return results
+
+  # Silence between consecutive tracks while a playlist plays through, and the time taken by each
+  # packet read (which, if longer than a packet, holds up discord's player).
+  async def _BenchTransitions(self) -> dict[str, Any]:
+    results: dict[str, Any] = {}
+    for kind, playlist_name in [('native', 'short-opus'), ('transcoded', 'short-mp3')]:
+      guild, ctx = self._NewGuild()
+      await guild.Restart(cast(Any, ctx), playlist_name)
+
+      # Wait for every track to start.
+      packets: list[tuple[float, float, int]] = []
+      deadline: float = (time.perf_counter()
+                         + self._args.tracks * (self._args.track_seconds + _PACKET_TIMEOUT_S))
+      while time.perf_counter() < deadline:
+        packets = ctx.voice_client.packets.Get()
+        if len(set(stream for _, _, stream in packets)) >= self._args.tracks:
+          break
+        await asyncio.sleep(0.1)
+
+      await guild.Stop(cast(Any, ctx))
+
+      gaps: list[float] = [max(0.0, b[0] - a[0] - _PACKET_TIME_S)
+                           for a, b in zip(packets, packets[1:]) if a[2] != b[2]]
+      results[kind] = {
+          'gaps': _stats(gaps),
+          'reads': _stats([took for _, took, _ in packets]),
+      }
+
+    return results
+
+  # CPU and memory per stream while many guilds play transcoded tracks at once.
+  async def _BenchStreams(self) -> dict[str, Any]:
+    self._EnsureFixtures()
+    count: int = self._args.streams
+    rss_before: int = _own_rss()
+
+    players: list[tuple[guilds.ShiloGuild, _FakeContext]] = [
+        self._NewGuild() for _ in range(count)]
+    for guild, ctx in players:
+      await guild.Restart(cast(Any, ctx), 'long-mp3')
+
+    # Let the encoders get going.
+    await asyncio.sleep(1)
+
+    cpu_before: float = _own_cpu()
+    children_before: dict[int, tuple[float, int]] = _child_usage()
+    began: float = time.perf_counter()
+
+    await asyncio.sleep(self._args.stream_seconds)
+
+    elapsed: float = time.perf_counter() - began
+    own_cpu: float = _own_cpu() - cpu_before
+    children: dict[int, tuple[float, int]] = _child_usage()
+    rss_after: int = _own_rss()
+
+    for guild, ctx in players:
+      await guild.Stop(cast(Any, ctx))
+
+    child_cpu: float = sum(cpu - children_before.get(pid, (0.0, 0))[0]
+                           for pid, (cpu, _) in children.items())
+    child_rss: int = sum(rss for _, rss in children.values())
+    return {
+        'streams': count,
+        'encoders': len(children),
+        'bot_cpu_percent_per_stream': round(100 * own_cpu / elapsed / count, 3),
+        'encoder_cpu_percent_per_stream': round(100 * child_cpu / elapsed / count, 3),
+        'bot_rss_kib_per_stream': (rss_after - rss_before) // 1024 // count,
+        'encoder_rss_kib_per_stream': child_rss // 1024 // count,
+    }
+
+  # Generates the synthetic library on first use, returning its playlist config.
+  def _EnsureLibrary(self) -> dict[str, list[str]]:
+    if self._library_config:
+      return self._library_config
+
+    root: str = os.path.join(self._directory, 'library')
+    per_dir: int = max(1, self._args.library_files // _LIBRARY_DIRS)
+    for d in range(_LIBRARY_DIRS):
+      dirname: str = os.path.join(root, f'{d:03}')
+      os.makedirs(dirname)
+      for f in range(per_dir):
+        open(os.path.join(dirname, f'track-{f:05}.mp3'), 'wb').close()
+
+    # Backdate the directories, since the index doesn't trust recently-modified ones.
+    settled: float = time.time() - 3600
+    for dirname in [root] + [os.path.join(root, f'{d:03}') for d in range(_LIBRARY_DIRS)]:
+      os.utime(dirname, (settled, settled))
+
+    # One playlist of everything, and several of a slice each.
+    config: dict[str, list[str]] = {'all': [os.path.join(root, '*', '*.mp3')]}
+    dirs_per_playlist: int = _LIBRARY_DIRS // _LIBRARY_PLAYLISTS
+    for p in range(_LIBRARY_PLAYLISTS):
+      config[f'slice-{p}'] = [os.path.join(root, f'{d:03}', '*.mp3')
+                              for d in range(p * dirs_per_playlist, (p + 1) * dirs_per_playlist)]
+
+    self._library_config = config
+    return config
+
+  # Time to catalog a large library from scratch, from the index and without an index, and the cost
+  # of creating guilds that serve it.
+  async def _BenchLibrary(self) -> dict[str, Any]:
+    config: dict[str, list[str]] = self._EnsureLibrary()
+    index_path: str = os.path.join(self._directory, 'library.db')
+    timings: dict[str, float] = {}
+    library: Optional[catalog.Catalog] = None
+    for name, index in [('catalog_unindexed_s', None), ('catalog_cold_s', index_path),
+                        ('catalog_warm_s', index_path)]:
+      began: float = time.perf_counter()
+      library = catalog.Catalog(config, catalog.LibraryIndex(index) if index else None)
+      timings[name] = round(time.perf_counter() - began, 3)
+    assert library is not None
+
+    count: int = self._args.guilds
+    created: list[guilds.ShiloGuild] = []
+    tracemalloc.start()
+    began = time.perf_counter()
+    for i in range(count):
+      created.append(guilds.ShiloGuild(i, library, self._supervisor, sender=self._sender))
+    elapsed: float = time.perf_counter() - began
+    allocated, _ = tracemalloc.get_traced_memory()
+
+    # Then have each guild use the largest playlist.
+    began = time.perf_counter()
+    for guild in created:
+      guild._GetPlaylist('all')
+    used_elapsed: float = time.perf_counter() - began
+    used_allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    self._guilds.extend((guild, None) for guild in created)
+
+    return {
+        'files': library.track_count,
+        'playlists': len(config),
+        **timings,
+        'guild_create_ms': round(elapsed * 1000 / count, 3),
+        'guild_kib': allocated // 1024 // count,
+        'playlist_create_ms': round(used_elapsed * 1000 / count, 3),
+        'guild_kib_after_use': used_allocated // 1024 // count,
+    }
+
+  # Time to index the track names of a large library, and to answer autocomplete queries of
+  # increasing length (across the library and within one playlist).
+  async def _BenchSearch(self) -> dict[str, Any]:
+    config: dict[str, list[str]] = self._EnsureLibrary()
+    library: catalog.Catalog = catalog.Catalog(config)
+
+    began: float = time.perf_counter()
+    index: search.TrackSearch = search.TrackSearch(library)
+    results: dict[str, Any] = {
+        'tracks': library.track_count,
+        'index_s': round(time.perf_counter() - began, 3),
+    }
+
+    for playlist_name in [None, 'slice-0']:
+      latencies: list[float] = []
+      for _ in range(self._args.repeats):
+        for query in _SEARCH_QUERIES:
+          began = time.perf_counter()
+          index.Search(query, playlist_name)
+          latencies.append(time.perf_counter() - began)
+      results['query_playlist' if playlist_name else 'query_all'] = _stats(latencies)
+
+    return results
+
+  # Packets played late while reads of a native Opus track stall every few seconds, with and without
+  # a read-ahead buffer. A packet is late if reading it held up the player.
+  async def _BenchStalls(self) -> dict[str, Any]:
+    results: dict[str, Any] = {}
+    for kind, read_ahead in [('unbuffered', datetime.timedelta()), ('buffered', _STALL_READ_AHEAD)]:
+      guild, ctx = self._NewGuild(read_ahead=read_ahead)
+      with _stalling_reads(_STALL_S, _STALL_EVERY):
+        await guild.Restart(cast(Any, ctx), 'long-opus')
+        await asyncio.sleep(self._args.stream_seconds)
+        await guild.Stop(cast(Any, ctx))
+
+      # The first read waits for the stream to open.
+      reads: list[float] = [took for _, took, _ in ctx.voice_client.packets.Get()[1:]]
+      results[kind] = {
+          'packets': len(reads),
+          'late_packets': sum(1 for took in reads if took > _PACKET_TIME_S),
+          'reads': _stats(reads),
+      }
+
+    return results
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description='Benchmarks the audio pipeline.')
+  parser.add_argument('--only', nargs='+', choices=_BENCHMARKS, default=_BENCHMARKS)
+  parser.add_argument('--repeats', type=int, default=10,
+                      help='Number of measurements of each latency.')
+  parser.add_argument('--tracks', type=int, default=4,
+                      help='Number of tracks played through to measure transitions.')
+  parser.add_argument('--track-seconds', type=int, default=8,
+                      help='Length of each track played through to measure transitions.')
+  parser.add_argument('--streams', type=int, default=8,
+                      help='Number of guilds playing at once to measure per-stream cost.')
+  parser.add_argument('--stream-seconds', type=int, default=10,
+                      help='Time over which to measure per-stream cost.')
+  parser.add_argument('--library-files', type=int, default=100000,
+                      help='Number of files in the synthetic library.')
+  parser.add_argument('--guilds', type=int, default=20,
+                      help='Number of guilds created against the synthetic library.')
+  parser.add_argument('--max-encoders', type=int, default=64)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix='shilo-bench-') as directory:
+    # Keep stdout for the results.
+    with contextlib.redirect_stdout(sys.stderr):
+      results: dict[str, Any] = asyncio.run(_Benchmarks(args, directory).Run(args.only))
+      # Logs are written in the background, so may still be on their way to stdout.
+      utils.flush_logs()
+
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
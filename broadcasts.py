@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+import asyncio
+import collections
+import threading
+
+from typing import Optional
+
+import discord
+
+import playlists
+import utils
+
+# A single Opus frame of silence, sent to subscribers while there's no track to play.
+_SILENCE: bytes = b'\xf8\xff\xfe'
+
+# Number of recent packets kept for subscribers that are slightly behind the others (5s).
+_RING_PACKETS: int = 250
+
+
+# A playlist that is played once and heard by any number of guilds. Packets are pulled from the
+# playlist's stream only by whichever subscriber is furthest ahead, and are kept in a short ring
+# buffer from which the other subscribers read through their own cursors. The cost of a broadcast
+# is therefore one stream, however many guilds are listening.
+#
+# The broadcast pauses (and releases its stream) while nobody is subscribed.
+class Broadcast:
+
+  def __init__(self, playlist: playlists.Playlist):
+    self._playlist: playlists.Playlist = playlist
+
+    # Guards everything below, which is touched from every subscriber's audio thread.
+    self._lock: threading.Lock = threading.Lock()
+
+    self._source: Optional[playlists.GaplessAudio] = None
+    self._subscribers: int = 0
+
+    # Recent packets, where _ring[0] has sequence number _base.
+    self._ring: collections.deque[bytes] = collections.deque(maxlen=_RING_PACKETS)
+    self._base: int = 0
+
+    # Set while a new stream is being opened.
+    self._opening: bool = False
+
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+  # Returns a new audio source that plays this broadcast live. Must be called from the event loop.
+  def Subscribe(self) -> 'BroadcastAudio':
+    self._loop = asyncio.get_running_loop()
+
+    with self._lock:
+      self._subscribers += 1
+      utils.log(utils.LogSeverity.INFO,
+                f'Broadcast "{self.name}" has {self._subscribers} subscribers.')
+      return BroadcastAudio(self, self._base + len(self._ring))
+
+  @property
+  def name(self) -> str:
+    return self._playlist.name
+
+  @property
+  def playlist(self) -> playlists.Playlist:
+    return self._playlist
+
+  # Returns the packet with the given sequence number (pulling it from the stream if no subscriber
+  # has yet), and the sequence number of the packet after it.
+  def _Read(self, seq: int) -> tuple[bytes, int]:
+    with self._lock:
+      # Too far behind: skip to the oldest packet still available.
+      seq = max(seq, self._base)
+
+      if seq == self._base + len(self._ring):
+        if len(self._ring) == self._ring.maxlen:
+          self._base += 1
+        self._ring.append(self._Pull())
+
+      return self._ring[seq - self._base], seq + 1
+
+  # Reads the next packet from the stream, or silence if there isn't a stream ready. Called with
+  # the lock held.
+  def _Pull(self) -> bytes:
+    packet: bytes = self._source.read() if self._source else b''
+    if packet:
+      return packet
+
+    # The stream (if any) has ended: move on to the next track.
+    if not self._opening:
+      skip: bool = self._source is not None
+      if self._source:
+        self._source.cleanup()
+        self._source = None
+
+      assert self._loop is not None
+      self._opening = True
+      asyncio.run_coroutine_threadsafe(self._Open(skip), self._loop)
+
+    return _SILENCE
+
+  def _Unsubscribe(self) -> None:
+    with self._lock:
+      self._subscribers -= 1
+      utils.log(utils.LogSeverity.INFO,
+                f'Broadcast "{self.name}" has {self._subscribers} subscribers.')
+      if self._subscribers or not self._source:
+        return
+
+      # Nobody is listening: pause, keeping our place in the track.
+      source: playlists.GaplessAudio = self._source
+      self._source = None
+
+    source.cleanup()
+    self._playlist.DiscardNext()
+
+  # Opens a stream for the playlist's current track, or the next one if skip is true. Runs on the
+  # event loop.
+  async def _Open(self, skip: bool) -> None:
+    try:
+      if self._playlist.StreamHasError():
+        await self._playlist.QuarantineCurrent()
+        skip = True
+      if skip:
+        self._playlist.Skip()
+
+      stream: Optional[playlists.Stream] = await self._playlist.MakeStream()
+    except BaseException:
+      with self._lock:
+        self._opening = False
+      raise
+
+    if not stream:
+      utils.log(utils.LogSeverity.WARNING, f'Broadcast "{self.name}" has nothing to play.')
+      with self._lock:
+        self._opening = False
+      return
+
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    source: playlists.GaplessAudio = playlists.GaplessAudio(
+        self._playlist, stream,
+        on_near_end=lambda: asyncio.run_coroutine_threadsafe(self._playlist.PrewarmNext(), loop),
+        on_advance=lambda: utils.log(utils.LogSeverity.INFO,
+                                     f'Broadcast "{self.name}" continued.'))
+
+    with self._lock:
+      self._opening = False
+      if self._subscribers:
+        self._source = source
+        utils.log(utils.LogSeverity.INFO, f'Broadcast "{self.name}" started.')
+        return
+
+    # Everyone left while we were opening.
+    source.cleanup()
+
+
+# One guild's view of a broadcast: a cursor into its packets.
+class BroadcastAudio(discord.AudioSource):
+
+  def __init__(self, broadcast: Broadcast, seq: int):
+    self._broadcast: Broadcast = broadcast
+    self._seq: int = seq
+    self._subscribed: bool = True
+
+  def read(self) -> bytes:
+    packet, self._seq = self._broadcast._Read(self._seq)
+    return packet
+
+  def is_opus(self) -> bool:
+    return True
+
+  def cleanup(self) -> None:
+    if self._subscribed:
+      self._subscribed = False
+      self._broadcast._Unsubscribe()
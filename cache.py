@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+
+import concurrent.futures as futures
+import contextlib
+import hashlib
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+from typing import Iterator, Optional
+
+import utils
+
+_CACHE_EXT: str = '.opus'
+_TEMP_EXT: str = '.tmp'
+
+# File in the cache directory that records the cached tracks, shared by every process using it.
+_INDEX_FILE: str = 'cache.db'
+
+# Generous upper bound on the time to transcode one track. A track claimed for longer than this is
+# assumed to have been abandoned (e.g. by a process that crashed), and may be claimed again.
+_TRANSCODE_TIMEOUT_S: int = 600
+
+# Limit on the time to wait for another process to finish updating the index.
+_BUSY_TIMEOUT_S: float = 60.0
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS entries (
+  key TEXT PRIMARY KEY,
+  -- NULL while the track is being transcoded.
+  size INTEGER,
+  -- Wall-clock time of last use (or, while transcoding, of being claimed), comparable between
+  -- processes.
+  used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+"""
+
+
+# An on-disk cache of tracks that have already been normalised and encoded to Ogg Opus, so that
+# playback can stream them without re-encoding. Entries are produced in the background by a pool of
+# ffmpeg workers, and the least-recently-used entries are evicted once the cache exceeds its byte
+# budget.
+#
+# Entries are keyed by the source file's path, size and mtime along with the encoder options, so a
+# changed source or encoding produces a new entry (and the stale one is eventually evicted).
+#
+# The cache directory may be shared by several processes (e.g. shard processes): entries, their
+# recency and the tracks being transcoded are recorded in an SQLite index alongside them, so that
+# each track is encoded once and the byte budget covers every process's entries.
+#
+# Safe to use from multiple threads.
+class TrackCache:
+
+  def __init__(self, directory: str, max_bytes: int, workers: int = 2):
+    self._directory: str = directory
+    self._max_bytes: int = max_bytes
+
+    os.makedirs(directory, exist_ok=True)
+
+    # Guards the connection, whose transactions are managed explicitly.
+    self._lock: threading.Lock = threading.Lock()
+    self._db: sqlite3.Connection = sqlite3.connect(
+        os.path.join(directory, _INDEX_FILE), timeout=_BUSY_TIMEOUT_S, isolation_level=None,
+        check_same_thread=False)
+    with self._lock:
+      self._db.execute('PRAGMA journal_mode=WAL')
+      self._db.executescript(_SCHEMA)
+
+    self._workers: int = workers
+    self._pool: futures.ThreadPoolExecutor = futures.ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='transcode')
+
+    self._Load()
+
+  # Returns the path of the cached encoding of the given track with the given ffmpeg output options,
+  # if there is one. The entry only counts as recently used (and so is kept longest) if it's being
+  # looked up to play it, as opposed to e.g. prefetching it. Blocks on the index.
+  def Lookup(self, path: str, options: list[str], play: bool = True) -> Optional[str]:
+    key: Optional[str] = self._Key(path, options)
+    if key is None:
+      return None
+
+    try:
+      with self._lock:
+        row = self._db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+        if not row or row[0] is None:
+          return None
+        if play:
+          self._db.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+    except sqlite3.Error as e:
+      utils.log(utils.LogSeverity.WARNING, f'Couldn\'t look up cached track: "{e}".')
+      return None
+
+    return self._Path(key)
+
+  # Forgets the cached encoding of the given track with the given ffmpeg output options, if there is
+  # one, e.g. because it turned out to be unreadable. It's encoded again on the next request.
+  def Discard(self, path: str, options: list[str]) -> None:
+    key: Optional[str] = self._Key(path, options)
+    if key is None:
+      return
+
+    try:
+      with self._Transaction() as db:
+        if not db.execute('DELETE FROM entries WHERE key = ? AND size IS NOT NULL',
+                          (key,)).rowcount:
+          return
+    except sqlite3.Error as e:
+      utils.log(utils.LogSeverity.WARNING, f'Couldn\'t discard cached track: "{e}".')
+      return
+
+    try:
+      os.remove(self._Path(key))
+    except OSError:
+      pass
+
+  # Number of tracks encoded at once, each by its own ffmpeg process.
+  @property
+  def workers(self) -> int:
+    return self._workers
+
+  # Schedules the given track to be encoded into the cache with the given ffmpeg output options, if
+  # it isn't already cached or being encoded (by any process). Blocks on the index.
+  def Request(self, path: str, options: list[str]) -> None:
+    key: Optional[str] = self._Key(path, options)
+    if key is None:
+      return
+
+    now: float = time.time()
+    try:
+      with self._Transaction() as db:
+        row = db.execute('SELECT size, used FROM entries WHERE key = ?', (key,)).fetchone()
+        if row and (row[0] is not None or now - row[1] < _TRANSCODE_TIMEOUT_S):
+          return
+        db.execute('INSERT OR REPLACE INTO entries (key, size, used) VALUES (?, NULL, ?)',
+                   (key, now))
+    except sqlite3.Error as e:
+      utils.log(utils.LogSeverity.WARNING, f'Couldn\'t request caching of track: "{e}".')
+      return
+
+    self._pool.submit(self._Transcode, path, options, key)
+
+  # Runs the body in an immediate transaction, so that it isn't interleaved with other processes'.
+  @contextlib.contextmanager
+  def _Transaction(self) -> Iterator[sqlite3.Connection]:
+    with self._lock:
+      self._db.execute('BEGIN IMMEDIATE')
+      try:
+        yield self._db
+      except BaseException:
+        self._db.execute('ROLLBACK')
+        raise
+      self._db.execute('COMMIT')
+
+  # Returns the cache key for the given track and encoding, or None if the track can't be read.
+  def _Key(self, path: str, options: list[str]) -> Optional[str]:
+    try:
+      stat: os.stat_result = os.stat(path)
+    except OSError:
+      return None
+
+    ident: str = '\0'.join([os.path.abspath(path), str(stat.st_size), str(stat.st_mtime_ns)]
+                           + options)
+    return hashlib.sha1(ident.encode('utf8', errors='surrogateescape')).hexdigest()
+
+  def _Path(self, key: str) -> str:
+    return os.path.join(self._directory, key + _CACHE_EXT)
+
+  # Brings the index up to date with the cache directory: cached files it doesn't know about (e.g.
+  # from before there was an index) are adopted, oldest first, and entries whose files are gone or
+  # whose transcoding was abandoned are forgotten. Also removes abandoned partial output.
+  def _Load(self) -> None:
+    now: float = time.time()
+    found: dict[str, tuple[int, float]] = {}
+    with os.scandir(self._directory) as it:
+      for entry in it:
+        try:
+          if entry.name.endswith(_TEMP_EXT):
+            # Another process may still be writing it.
+            if now - entry.stat().st_mtime > _TRANSCODE_TIMEOUT_S:
+              os.remove(entry.path)
+          elif entry.name.endswith(_CACHE_EXT):
+            stat: os.stat_result = entry.stat()
+            found[entry.name[:-len(_CACHE_EXT)]] = (stat.st_size, stat.st_mtime)
+        except OSError:
+          pass
+
+    with self._Transaction() as db:
+      db.executemany(
+          'INSERT INTO entries (key, size, used) VALUES (?, ?, ?) '
+          'ON CONFLICT (key) DO UPDATE SET size = excluded.size WHERE size IS NULL',
+          ((key, size, mtime) for key, (size, mtime) in found.items()))
+      stale: list[tuple[str]] = [
+          (key,) for key, size, used in db.execute('SELECT key, size, used FROM entries')
+          if (key not in found if size is not None else now - used > _TRANSCODE_TIMEOUT_S)]
+      db.executemany('DELETE FROM entries WHERE key = ?', stale)
+      count, total = db.execute(
+          'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE size IS NOT NULL').fetchone()
+
+    utils.log(utils.LogSeverity.INFO, f'Loaded {count} cached tracks ({total // 2**20} MiB).')
+    self._Evict()
+
+  # Runs on a worker thread.
+  def _Transcode(self, path: str, options: list[str], key: str) -> None:
+    out_path: str = self._Path(key)
+    # Unique to this process, in case the track is claimed again by another.
+    temp_path: str = f'{out_path}.{os.getpid()}{_TEMP_EXT}'
+    size: Optional[int] = None
+    try:
+      subprocess.run(['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', '-i', path,
+                      '-vn', '-map_metadata', '-1'] + options + ['-f', 'ogg', temp_path],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, timeout=_TRANSCODE_TIMEOUT_S, check=True)
+      size = os.path.getsize(temp_path)
+      os.replace(temp_path, out_path)
+    except (OSError, subprocess.SubprocessError):
+      utils.log(utils.LogSeverity.WARNING,
+                f'Couldn\'t cache "{utils.file_stem(path)}".')
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+
+    try:
+      with self._Transaction() as db:
+        if size is None:
+          db.execute('DELETE FROM entries WHERE key = ? AND size IS NULL', (key,))
+        else:
+          db.execute('INSERT OR REPLACE INTO entries (key, size, used) VALUES (?, ?, ?)',
+                     (key, size, time.time()))
+    except sqlite3.Error as e:
+      utils.log(utils.LogSeverity.WARNING, f'Couldn\'t record cached track: "{e}".')
+      return
+
+    self._Evict()
+
+  # Removes least-recently-used entries until the cache is within budget.
+  def _Evict(self) -> None:
+    try:
+      with self._Transaction() as db:
+        total: int = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        evicted: list[str] = []
+        for key, size in db.execute(
+            'SELECT key, size FROM entries WHERE size IS NOT NULL ORDER BY used').fetchall():
+          if total <= self._max_bytes:
+            break
+          evicted.append(key)
+          total -= size
+        db.executemany('DELETE FROM entries WHERE key = ?', ((key,) for key in evicted))
+    except sqlite3.Error as e:
+      utils.log(utils.LogSeverity.WARNING, f'Couldn\'t evict cached tracks: "{e}".')
+      return
+
+    for key in evicted:
+      try:
+        # Streams that already have the file open are unaffected.
+        os.remove(self._Path(key))
+      except OSError:
+        pass
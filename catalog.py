@@ -0,0 +1,442 @@
+#!/usr/bin/python3
+
+import array
+import fnmatch
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+import utils
+
+_MAGIC_RE: re.Pattern = re.compile('[*?[]')
+
+# Directories modified this recently aren't trusted to be unchanged on the next start, since a
+# further modification might not bump a coarse-grained mtime.
+_MTIME_SETTLE_NS: int = 2 * 10**9
+
+# Limit on the time to wait for another process (e.g. another shard process) to finish writing to
+# the index.
+_BUSY_TIMEOUT_S: float = 60.0
+
+# Generous upper bound on the time to analyse one track.
+_PROBE_TIMEOUT_S: int = 600
+
+_DURATION_RE: re.Pattern = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+_CODEC_RE: re.Pattern = re.compile(r'Stream #\S+.*?: Audio: (\w+)')
+_LOUDNESS_RE: re.Pattern = re.compile(r'"input_i" : "(-?\d+(?:\.\d+)?)"')
+_PEAK_RE: re.Pattern = re.compile(r'"input_tp" : "(-?\d+(?:\.\d+)?)"')
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS dirs (
+  path TEXT PRIMARY KEY,
+  mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+  dir TEXT NOT NULL,
+  name TEXT NOT NULL,
+  is_dir INTEGER NOT NULL,
+  size INTEGER,
+  mtime_ns INTEGER,
+  probed INTEGER NOT NULL DEFAULT 0,
+  duration REAL,
+  codec TEXT,
+  loudness REAL,
+  peak REAL,
+  PRIMARY KEY (dir, name)
+);
+CREATE TABLE IF NOT EXISTS quarantine (
+  dir TEXT NOT NULL,
+  name TEXT NOT NULL,
+  size INTEGER,
+  mtime_ns INTEGER,
+  reason TEXT,
+  PRIMARY KEY (dir, name)
+);
+"""
+
+# Columns added since the first version of the schema, which older index files lack.
+_ADDED_COLUMNS: list[str] = ['loudness REAL', 'peak REAL']
+
+# Returns true if the given glob component contains wildcards.
+def _has_magic(s: str) -> bool:
+  return _MAGIC_RE.search(s) is not None
+
+# Matches the given regex against the given text, returning the first group as a float if found.
+def _search_float(regex: re.Pattern, text: str) -> Optional[float]:
+  match: Optional[re.Match] = regex.search(text)
+  return float(match.group(1)) if match else None
+
+# Analyses the given audio file with ffmpeg. Returns a tuple of (duration in seconds, codec name,
+# integrated loudness in LUFS, true peak in dBTP), with None for any field that couldn't be
+# determined. The loudness fields are from the first pass of EBU R128 loudness normalisation, so the
+# whole track is decoded.
+def _probe(path: str) -> tuple[Optional[float], Optional[str], Optional[float], Optional[float]]:
+  try:
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-nostdin', '-i', path, '-vn',
+                             '-filter:a', 'loudnorm=print_format=json', '-f', 'null', '-'],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, timeout=_PROBE_TIMEOUT_S)
+  except (OSError, subprocess.SubprocessError):
+    return None, None, None, None
+
+  info: str = result.stderr.decode('utf8', errors='replace')
+
+  duration: Optional[float] = None
+  duration_match: Optional[re.Match] = _DURATION_RE.search(info)
+  if duration_match:
+    h, m, sec = duration_match.groups()
+    duration = int(h) * 3600 + int(m) * 60 + float(sec)
+
+  codec_match: Optional[re.Match] = _CODEC_RE.search(info)
+  codec: Optional[str] = codec_match.group(1) if codec_match else None
+
+  # Silent tracks have a loudness of -inf, which isn't matched.
+  return duration, codec, _search_float(_LOUDNESS_RE, info), _search_float(_PEAK_RE, info)
+
+
+# What the library index remembers about a single track. Probed fields are None if the track hasn't
+# been probed yet or if probing failed.
+class TrackInfo(NamedTuple):
+  path: str
+  size: int
+  mtime_ns: int
+  probed: bool
+  duration: Optional[float]
+  codec: Optional[str]
+  # Integrated loudness, in LUFS.
+  loudness: Optional[float]
+  # True peak, in dBTP.
+  peak: Optional[float]
+
+
+# Persistent index of the music library, stored in SQLite. Remembers the listing of every directory
+# the catalog walks (keyed by the directory's mtime, so that only changed directories are rescanned
+# on startup) along with per-track metadata.
+#
+# Note that a directory's mtime only changes when entries are added, removed or renamed; a file
+# rewritten in place keeps its stale size and mtime until its directory changes.
+#
+# Safe to use from multiple threads.
+class LibraryIndex:
+
+  def __init__(self, path: str):
+    self._lock: threading.Lock = threading.Lock()
+    self._db: sqlite3.Connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT_S,
+                                                   check_same_thread=False)
+    with self._lock:
+      self._db.execute('PRAGMA journal_mode=WAL')
+      self._db.executescript(_SCHEMA)
+      for column in _ADDED_COLUMNS:
+        try:
+          self._db.execute(f'ALTER TABLE entries ADD COLUMN {column}')
+          # Make sure the new column is filled in for already-probed tracks.
+          self._db.execute('UPDATE entries SET probed = 0')
+        except sqlite3.OperationalError:
+          # Already present.
+          pass
+      self._db.commit()
+
+  # Returns the remembered listing of the given directory as a map from entry name to whether that
+  # entry is a directory, or None if the directory has changed since it was last listed.
+  def GetListing(self, dirname: str, mtime_ns: int) -> Optional[dict[str, bool]]:
+    with self._lock:
+      row = self._db.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (dirname,)).fetchone()
+      if not row or row[0] != mtime_ns:
+        return None
+
+      rows = self._db.execute('SELECT name, is_dir FROM entries WHERE dir = ?', (dirname,))
+      return {name: bool(is_dir) for name, is_dir in rows}
+
+  # Replaces the remembered listing of the given directory. Probed metadata is kept for files whose
+  # size and mtime are unchanged.
+  def PutListing(self, dirname: str, mtime_ns: int,
+                 entries: Iterable[tuple[str, bool, int, int]]) -> None:
+    entries = list(entries)
+
+    # A recently-modified directory might change again within the same mtime tick, so make sure it's
+    # rescanned next time.
+    if time.time_ns() - mtime_ns < _MTIME_SETTLE_NS:
+      mtime_ns = -1
+
+    with self._lock:
+      self._db.execute('INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES (?, ?)',
+                       (dirname, mtime_ns))
+      self._db.execute('CREATE TEMP TABLE IF NOT EXISTS seen (name TEXT PRIMARY KEY)')
+      self._db.execute('DELETE FROM seen')
+      self._db.executemany('INSERT OR IGNORE INTO seen (name) VALUES (?)',
+                           ((e[0],) for e in entries))
+      self._db.execute('DELETE FROM entries WHERE dir = ? AND name NOT IN (SELECT name FROM seen)',
+                       (dirname,))
+      self._db.executemany(
+          'INSERT INTO entries (dir, name, is_dir, size, mtime_ns) VALUES (?, ?, ?, ?, ?) '
+          'ON CONFLICT (dir, name) DO UPDATE SET '
+          '  is_dir = excluded.is_dir, size = excluded.size, mtime_ns = excluded.mtime_ns, '
+          '  probed = probed AND size IS excluded.size AND mtime_ns IS excluded.mtime_ns',
+          ((dirname, name, is_dir, size, mtime) for name, is_dir, size, mtime in entries))
+
+  # Forgets every directory not in the given set, e.g. those removed from disk or no longer covered
+  # by any playlist.
+  def Prune(self, dirnames: set[str]) -> None:
+    with self._lock:
+      stale: list[tuple[str]] = [
+          (d,) for (d,) in self._db.execute('SELECT path FROM dirs') if d not in dirnames]
+      self._db.executemany('DELETE FROM dirs WHERE path = ?', stale)
+      self._db.executemany('DELETE FROM entries WHERE dir = ?', stale)
+      self._db.executemany('DELETE FROM quarantine WHERE dir = ?', stale)
+
+  # Returns the remembered metadata of the given track, if any.
+  def GetTrack(self, path: str) -> Optional[TrackInfo]:
+    dirname, name = os.path.split(os.path.abspath(path))
+    with self._lock:
+      row = self._db.execute(
+          'SELECT size, mtime_ns, probed, duration, codec, loudness, peak FROM entries '
+          'WHERE dir = ? AND name = ?', (dirname, name)).fetchone()
+    return TrackInfo(path, row[0], row[1], bool(row[2]), *row[3:]) if row else None
+
+  # Records the probed metadata of the given track.
+  def SetProbe(self, path: str, duration: Optional[float], codec: Optional[str],
+               loudness: Optional[float], peak: Optional[float]) -> None:
+    dirname, name = os.path.split(os.path.abspath(path))
+    with self._lock:
+      self._db.execute(
+          'UPDATE entries SET probed = 1, duration = ?, codec = ?, loudness = ?, peak = ? '
+          'WHERE dir = ? AND name = ?', (duration, codec, loudness, peak, dirname, name))
+
+  # Records that the given track couldn't be played, for as long as it's unchanged.
+  def SetQuarantined(self, path: str, reason: str) -> None:
+    dirname, name = os.path.split(os.path.abspath(path))
+    with self._lock:
+      self._db.execute(
+          'INSERT OR REPLACE INTO quarantine (dir, name, size, mtime_ns, reason) '
+          'SELECT dir, name, size, mtime_ns, ? FROM entries WHERE dir = ? AND name = ?',
+          (reason, dirname, name))
+
+  # Returns the paths of the tracks that couldn't be played and are unchanged since.
+  def GetQuarantined(self) -> list[str]:
+    with self._lock:
+      rows = self._db.execute(
+          'SELECT q.dir, q.name FROM quarantine q JOIN entries e USING (dir, name) '
+          'WHERE q.size IS e.size AND q.mtime_ns IS e.mtime_ns').fetchall()
+    return [os.path.join(dirname, name) for dirname, name in rows]
+
+  # Writes any pending changes to disk.
+  def Commit(self) -> None:
+    with self._lock:
+      self._db.commit()
+
+
+# The process-wide set of tracks, resolved once from the playlist globs in the config file.
+# Every track is stored once, in a table of paths and display names; playlists refer to tracks by
+# their (integer) id in that table rather than holding paths themselves.
+class Catalog:
+
+  def __init__(self, playlist_config: dict[str, list[str]],
+               index: Optional[LibraryIndex] = None):
+    # Used to remember the library between runs, if given.
+    self._index: Optional[LibraryIndex] = index
+    self._rescanned: int = 0
+
+    # Directory listings shared by every glob, so that overlapping globs only scan each directory
+    # once. Maps directory path to {entry name: is directory}.
+    self._listings: dict[str, dict[str, bool]] = {}
+
+    # Glob results, so that a pattern repeated across playlists is only resolved once.
+    globbed: dict[str, list[str]] = {}
+
+    # Maps path to track id, so that a track in several playlists is stored once.
+    ids: dict[str, int] = {}
+
+    self._tracks: dict[str, array.array] = {}
+    for name, patterns in playlist_config.items():
+      # Dict used as an ordered set, so that a file matched by several globs appears once.
+      tracks: dict[int, None] = {}
+      for pattern in patterns:
+        if pattern not in globbed:
+          globbed[pattern] = list(self._Glob(pattern))
+
+        for path in globbed[pattern]:
+          tracks[ids.setdefault(path, len(ids))] = None
+
+      self._tracks[name] = array.array('I', tracks)
+
+    # Track table, indexed by id.
+    self._paths: tuple[str, ...] = tuple(ids)
+    self._names: tuple[str, ...] = tuple(utils.file_stem(p) for p in self._paths)
+
+    utils.log(utils.LogSeverity.INFO,
+              f'Catalogued {len(self._paths)} tracks from {len(self._listings)} directories '
+              f'({self._rescanned} rescanned).')
+
+    # Ids of tracks that couldn't be played, which playlists skip. Only ever added to, so can be
+    # read without locking.
+    self._quarantined: set[int] = set()
+
+    if self._index:
+      self._index.Prune({os.path.abspath(d or os.curdir) for d in self._listings})
+      self._index.Commit()
+
+      abs_ids: dict[str, int] = {os.path.abspath(p): i for p, i in ids.items()}
+      self._quarantined.update(abs_ids[p] for p in self._index.GetQuarantined() if p in abs_ids)
+      if self._quarantined:
+        utils.log(utils.LogSeverity.INFO,
+                  f'Skipping {len(self._quarantined)} tracks that couldn\'t be played before.')
+
+    # The walk state isn't needed once all globs are resolved.
+    self._listings = {}
+
+  # Returns the ids of the tracks in the given playlist, in no particular order. The array is
+  # shared, so must not be modified.
+  def GetTrackIds(self, playlist_name: str) -> array.array:
+    return self._tracks[playlist_name]
+
+  def GetPath(self, track_id: int) -> str:
+    return self._paths[track_id]
+
+  # Returns the display name of the given track.
+  def GetName(self, track_id: int) -> str:
+    return self._names[track_id]
+
+  # Returns the remembered metadata of the given track, if there is an index.
+  def GetTrackInfo(self, path: str) -> Optional[TrackInfo]:
+    return self._index.GetTrack(path) if self._index else None
+
+  # Records that the given track couldn't be played, so that playlists skip it from now on (and, if
+  # there's an index, on later runs until the file changes). May block on the index.
+  def Quarantine(self, track_id: int, reason: str) -> None:
+    self._quarantined.add(track_id)
+    utils.log(utils.LogSeverity.WARNING, f'Quarantined "{self._names[track_id]}": {reason}',
+              track=self._names[track_id])
+
+    if self._index:
+      self._index.SetQuarantined(self._paths[track_id], reason)
+      self._index.Commit()
+
+  def IsQuarantined(self, track_id: int) -> bool:
+    return track_id in self._quarantined
+
+  # Number of tracks that couldn't be played.
+  @property
+  def quarantined_count(self) -> int:
+    return len(self._quarantined)
+
+  # Fills in the duration, codec and loudness of every indexed track that hasn't been probed yet.
+  # Slow, since every new track is decoded in full; should be run in the background.
+  def Probe(self) -> None:
+    if not self._index:
+      return
+
+    probed: int = 0
+    for path in self._paths:
+      info: Optional[TrackInfo] = self._index.GetTrack(path)
+      if not info or info.probed:
+        continue
+
+      # Committed straight away, so that the index isn't held locked against other processes while
+      # the next track is probed.
+      self._index.SetProbe(path, *_probe(path))
+      self._index.Commit()
+      probed += 1
+
+    if probed:
+      utils.log(utils.LogSeverity.INFO, f'Probed {probed} new tracks.')
+
+  # Starts probing tracks on a background thread.
+  def StartProbing(self) -> None:
+    threading.Thread(target=self.Probe, name='probe', daemon=True).start()
+
+  @property
+  def playlist_names(self) -> list[str]:
+    return list(self._tracks.keys())
+
+  # Number of tracks in the catalog, whose ids are the integers below it.
+  @property
+  def track_count(self) -> int:
+    return len(self._paths)
+
+  # Yields the paths of the files matching the given glob pattern. Follows the semantics of
+  # glob.glob (e.g. wildcards don't match hidden files), except that directories aren't matched.
+  def _Glob(self, pattern: str) -> Iterator[str]:
+    parts: list[str] = [p for p in pattern.split(os.sep) if p]
+    if not parts:
+      return
+
+    # Each candidate is a directory that matches the pattern components consumed so far.
+    candidates: list[str] = [os.sep if os.path.isabs(pattern) else '']
+    for i, part in enumerate(parts):
+      is_last: bool = i == len(parts) - 1
+
+      next_candidates: list[str] = []
+      for dirname in candidates:
+        if part in (os.curdir, os.pardir):
+          # Never listed, but present in every directory.
+          path: str = os.path.join(dirname, part)
+          if not is_last and os.path.isdir(path):
+            next_candidates.append(path)
+          continue
+
+        listing: dict[str, bool] = self._ListDir(dirname)
+
+        names: list[str] = []
+        if not _has_magic(part):
+          names = [part] if part in listing else []
+        else:
+          names = [n for n in listing
+                   if (part.startswith('.') or not n.startswith('.'))
+                   and fnmatch.fnmatchcase(n, part)]
+
+        # Intermediate components must match directories; the final one must match files.
+        next_candidates.extend(os.path.join(dirname, n) for n in names
+                               if listing[n] != is_last)
+
+      candidates = next_candidates
+
+    yield from candidates
+
+  # Returns a (cached) map from entry name to whether that entry is a directory. Directories that
+  # are unchanged since they were last indexed cost a single stat.
+  def _ListDir(self, dirname: str) -> dict[str, bool]:
+    if dirname in self._listings:
+      return self._listings[dirname]
+
+    path: str = os.path.abspath(dirname or os.curdir)
+    listing: Optional[dict[str, bool]] = None
+    try:
+      mtime_ns: int = os.stat(path).st_mtime_ns
+      if self._index:
+        listing = self._index.GetListing(path, mtime_ns)
+
+      if listing is None:
+        listing = self._ScanDir(path, mtime_ns)
+    except OSError:
+      listing = {}
+
+    self._listings[dirname] = listing
+    return listing
+
+  # Lists the given directory from disk, recording the result in the index if there is one.
+  def _ScanDir(self, path: str, mtime_ns: int) -> dict[str, bool]:
+    self._rescanned += 1
+
+    # Tuples of (name, is directory, size, mtime).
+    entries: list[tuple[str, bool, int, int]] = []
+    with os.scandir(path) as it:
+      for entry in it:
+        try:
+          is_dir: bool = entry.is_dir()
+          if is_dir or not self._index:
+            entries.append((entry.name, is_dir, 0, 0))
+          else:
+            stat: os.stat_result = entry.stat()
+            entries.append((entry.name, False, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+          entries.append((entry.name, False, 0, 0))
+
+    if self._index:
+      self._index.PutListing(path, mtime_ns, entries)
+
+    return {name: is_dir for name, is_dir, _, _ in entries}
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+import asyncio
+import collections
+import statistics
+import subprocess
+import threading
+import time
+
+from typing import Hashable, Optional
+
+import utils
+
+# How often to reap finished encoders and report statistics.
+_REAP_INTERVAL_S: float = 10.0
+_REPORT_INTERVAL_S: float = 60.0
+
+# Number of recent spawn latencies kept for reporting.
+_MAX_LATENCIES: int = 256
+
+
+# Permission to run one encoder subprocess, handed out by a Supervisor. The holder should attach
+# its process once spawned, and must release the slot once the process is finished with.
+class Slot:
+
+  def __init__(self, supervisor: 'Supervisor', requested: float):
+    self._supervisor: Supervisor = supervisor
+    self._requested: float = requested
+    self._process: Optional[subprocess.Popen] = None
+    self._released: bool = False
+
+  # Records the process running in this slot.
+  def Attach(self, process: subprocess.Popen) -> None:
+    self._process = process
+    self._supervisor._OnSpawn(self, time.monotonic() - self._requested)
+
+  # Gives up the slot, killing its process if it's still running. Idempotent and thread-safe.
+  def Release(self) -> None:
+    self._supervisor._Release(self)
+
+
+# Owns every encoder subprocess used for playback. At most a fixed number of encoders run at once;
+# further requests queue, and are admitted round-robin across owners (i.e. guilds) so that one
+# busy guild can't starve the others. Exited processes are reaped and their slots freed in the
+# background.
+#
+# Background ffmpeg work (the track cache's transcoders and the library prober) runs on its own
+# threads, outside the supervisor; its share of the overall limit is set aside instead (see
+# shilo.run).
+#
+# Acquire must be called from the event loop; slots may be released from any thread.
+class Supervisor:
+
+  def __init__(self, max_encoders: int):
+    self._max_encoders: int = max_encoders
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # Number of slots handed out and not yet released.
+    self._active: int = 0
+
+    # Waiters per owner, in round-robin order.
+    self._queues: collections.OrderedDict[Hashable, collections.deque[asyncio.Future]] = (
+        collections.OrderedDict())
+
+    # Guards _slots and _latencies, which are touched from other threads.
+    self._lock: threading.Lock = threading.Lock()
+    self._slots: set[Slot] = set()
+    self._latencies: collections.deque[float] = collections.deque(maxlen=_MAX_LATENCIES)
+    self._spawned: int = 0
+
+  # Waits for a free encoder slot on behalf of the given owner.
+  async def Acquire(self, owner: Hashable) -> Slot:
+    self._EnsureStarted()
+    requested: float = time.monotonic()
+
+    if self._active < self._max_encoders and not self.queued:
+      self._active += 1
+    else:
+      waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+      self._queues.setdefault(owner, collections.deque()).append(waiter)
+      try:
+        # Resolved once a released slot has been handed to us.
+        await waiter
+      except asyncio.CancelledError:
+        if waiter.done() and not waiter.cancelled():
+          self._HandOver()
+        raise
+
+    slot: Slot = Slot(self, requested)
+    with self._lock:
+      self._slots.add(slot)
+    return slot
+
+  # Number of slots currently handed out.
+  @property
+  def active(self) -> int:
+    return self._active
+
+  # Number of requests waiting for a slot.
+  @property
+  def queued(self) -> int:
+    return sum(len(q) for q in self._queues.values())
+
+  # Returns the recent spawn latencies, in seconds, from request to process start.
+  def GetLatencies(self) -> list[float]:
+    with self._lock:
+      return list(self._latencies)
+
+  def _OnSpawn(self, slot: Slot, latency: float) -> None:
+    with self._lock:
+      self._latencies.append(latency)
+      self._spawned += 1
+
+  def _Release(self, slot: Slot) -> None:
+    with self._lock:
+      if slot._released:
+        return
+      slot._released = True
+      self._slots.discard(slot)
+
+    process: Optional[subprocess.Popen] = slot._process
+    if process and process.poll() is None:
+      utils.log(utils.LogSeverity.WARNING, f'Killing orphaned encoder {process.pid}.')
+      process.kill()
+      process.wait()
+
+    assert self._loop is not None
+    self._loop.call_soon_threadsafe(self._HandOver)
+
+  # Passes a freed slot to the next waiter in round-robin order, or returns it to the pool. Runs on
+  # the event loop.
+  def _HandOver(self) -> None:
+    while self._queues:
+      owner, queue = next(iter(self._queues.items()))
+      waiter: asyncio.Future = queue.popleft()
+      if queue:
+        self._queues.move_to_end(owner)
+      else:
+        del self._queues[owner]
+
+      if not waiter.done():
+        waiter.set_result(None)
+        return
+
+    self._active -= 1
+
+  def _EnsureStarted(self) -> None:
+    if self._loop is None:
+      self._loop = asyncio.get_running_loop()
+      self._loop.create_task(self._Reap())
+
+  # Frees the slots of encoders that have exited (which also reaps the zombie processes), and
+  # periodically reports statistics.
+  async def _Reap(self) -> None:
+    last_report: float = time.monotonic()
+    while True:
+      await asyncio.sleep(_REAP_INTERVAL_S)
+
+      with self._lock:
+        slots: list[Slot] = list(self._slots)
+      for slot in slots:
+        if slot._process and slot._process.poll() is not None:
+          slot.Release()
+
+      if time.monotonic() - last_report >= _REPORT_INTERVAL_S:
+        last_report = time.monotonic()
+        self._Report()
+
+  def _Report(self) -> None:
+    with self._lock:
+      latencies: list[float] = list(self._latencies)
+      spawned: int = self._spawned
+      self._spawned = 0
+
+    if not spawned and not self._active:
+      return
+
+    latency_str: str = (f', spawn latency median {statistics.median(latencies) * 1000:.0f}ms '
+                        f'max {max(latencies) * 1000:.0f}ms' if latencies else '')
+    utils.log(utils.LogSeverity.INFO,
+              f'Encoders: {self._active}/{self._max_encoders} active, {self.queued} queued, '
+              f'{spawned} spawned{latency_str}.')
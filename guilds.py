@@ -1,18 +1,62 @@
 #!/usr/bin/python3
 
 import asyncio
-import concurrent.futures as futures
 import datetime
-import glob
 import enum
+import functools
+import time
 
-from typing import cast, Optional
+from typing import Callable, cast, NamedTuple, Optional
 
 import discord
 import discord.commands.context as dctx
 
-import utils
+import broadcasts
+import cache
+import catalog
+import encoders
+import messages
+import metrics
 import playlists
+import prefetch
+import state
+import utils
+
+# Limit on the time spent starting the next track (e.g. waiting for an encoder while they're all
+# busy), and the number of times it's tried before playback stops.
+_TRANSITION_TIMEOUT_S: float = 30.0
+_MAX_TRANSITION_ATTEMPTS: int = 5
+
+# Playback stops after this many tracks in a row fail, since something other than the tracks is
+# probably wrong.
+_MAX_FAILED_TRACKS: int = 5
+
+# Fast-forwards and seeks made in quick succession are carried out together, once none has been
+# made for a moment (or, during a long burst, after a while regardless).
+_SEEK_DEBOUNCE_S: float = 0.3
+_MAX_SEEK_DELAY_S: float = 1.0
+
+# Skips ahead by up to this much are made by throwing away audio from the playing stream, rather
+# than by starting a new stream from the new position, as long as that audio can be had without
+# waiting on an encoder (see GaplessAudio.skippable).
+_MAX_IN_PLACE_SKIP: datetime.timedelta = datetime.timedelta(seconds=10)
+
+# How long the buttons of a listing keep working.
+_LISTING_TIMEOUT_S: float = 300.0
+
+_TRANSITIONS: metrics.Counter = metrics.Counter(
+    'shilo_track_transitions_total',
+    'Moves to the next track, either gaplessly or by starting a new stream after the last ended.',
+    label='kind')
+_TRANSITION_SECONDS: metrics.Histogram = metrics.Histogram(
+    'shilo_track_transition_seconds',
+    'Time from the end of a track to the first packet of a new stream for the next one.')
+_SEEKS: metrics.Counter = metrics.Counter(
+    'shilo_seeks_total',
+    'Seeks carried out, either in place or by starting a new stream. Each may merge several '
+    'requests.', label='kind')
+_SEEK_REQUESTS: metrics.Counter = metrics.Counter(
+    'shilo_seek_requests_total', 'Fast-forwards and seeks requested.')
 
 class JoinResult(enum.Enum):
   FAIL = enum.auto()
@@ -37,20 +81,120 @@ def _track_name(playlist: Optional[playlists.Playlist]) -> str:
           playlist.current_track_name else 'track')
 
 
+# Returns the message showing the given page of a listing.
+def _format_page(page: playlists.ListingPage) -> str:
+  footer: str = f'Page {page.page + 1} of {page.pages}.' if page.pages > 1 else ''
+  return f'```\n{page.text}\n```{footer}'
+
+
+# Buttons that move between the pages of a listing, rendering each page on demand.
+class _ListingView(discord.ui.View):
+
+  def __init__(self, render: Callable[[int], playlists.ListingPage],
+               page: playlists.ListingPage):
+    super().__init__(timeout=_LISTING_TIMEOUT_S)
+    self._render: Callable[[int], playlists.ListingPage] = render
+    self._page: playlists.ListingPage = page
+    self._UpdateButtons()
+
+  @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+  async def previous(self, button: discord.ui.Button, interaction: discord.Interaction) -> None:
+    await self._Turn(interaction, -1)
+
+  @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+  async def next(self, button: discord.ui.Button, interaction: discord.Interaction) -> None:
+    await self._Turn(interaction, 1)
+
+  async def _Turn(self, interaction: discord.Interaction, delta: int) -> None:
+    self._page = self._render(self._page.page + delta)
+    self._UpdateButtons()
+    await interaction.response.edit_message(content=_format_page(self._page), view=self)
+
+  def _UpdateButtons(self) -> None:
+    cast(discord.ui.Button, self.previous).disabled = self._page.page <= 0
+    cast(discord.ui.Button, self.next).disabled = self._page.page >= self._page.pages - 1
+
+
+# A request to move on from a track that has ended.
+class _Transition(NamedTuple):
+  ctx: dctx.ApplicationContext
+  playlist: playlists.Playlist
+  callback: utils.CancellableCoroutine
+  # Monotonic time at which the previous track ended.
+  ended_at: float
+  # Number of earlier attempts that timed out.
+  retries: int = 0
+
+
 # Represents the presence of ShiloBot in one guild. This allows for independent playback (e.g.
 # position in playlists) per guild.
 class ShiloGuild:
 
-  def __init__(self, playlist_config: dict[str, list[str]]):
+  def __init__(self, guild_id: int, library: catalog.Catalog, supervisor: encoders.Supervisor,
+               track_cache: Optional[cache.TrackCache] = None,
+               shared: Optional[dict[str, broadcasts.Broadcast]] = None,
+               store: Optional[state.StateStore] = None,
+               read_ahead: datetime.timedelta = datetime.timedelta(),
+               prefetcher: Optional[prefetch.Prefetcher] = None,
+               sender: Optional[messages.Sender] = None):
+    self._guild_id: int = guild_id
+
+    # Broadcast playlists are shared with other guilds rather than played independently.
+    self._broadcasts: dict[str, broadcasts.Broadcast] = shared or {}
+    self._playlist_names: list[str] = library.playlist_names
+
+    # Used to create this guild's own playlists, which happens on first use.
+    self._library: catalog.Catalog = library
+    self._supervisor: encoders.Supervisor = supervisor
+    self._track_cache: Optional[cache.TrackCache] = track_cache
+    self._read_ahead: datetime.timedelta = read_ahead
+    self._prefetcher: Optional[prefetch.Prefetcher] = prefetcher
     self._playlists: dict[str, playlists.Playlist] = {}
-    for name, globs in playlist_config.items():
-      self._playlists[name] = playlists.Playlist(
-          name, sum([glob.glob(p) for p in globs], []))
 
     self._playlist: Optional[playlists.Playlist] = None
 
     self._next_callbacks: dict[str, utils.CancellableCoroutine] = {}
 
+    # The audio being played from one of this guild's own playlists, if any.
+    self._source: Optional[playlists.GaplessAudio] = None
+
+    # A pending seek, merging the fast-forwards and seeks requested since the last was carried out:
+    # the playlist, the position to seek to (or None to start from the current position), the
+    # interval to skip on from there, when the first of them was requested, and when to carry it
+    # out (both monotonic).
+    self._seek_playlist: Optional[playlists.Playlist] = None
+    self._seek_to: Optional[datetime.timedelta] = None
+    self._seek_by: datetime.timedelta = datetime.timedelta()
+    self._seek_since: float = 0.0
+    self._seek_at: float = 0.0
+    self._seek_task: Optional[asyncio.Task] = None
+
+    # Track transitions handed over from the audio thread, and the task that runs them.
+    self._transitions: Optional[asyncio.Queue[_Transition]] = None
+    self._transition_task: Optional[asyncio.Task] = None
+
+    # When the track before the one being started ended, if it's being started by a transition.
+    self._transition_ended_at: Optional[float] = None
+
+    # Number of tracks in a row that failed to play.
+    self._failed_tracks: int = 0
+
+    # Sends messages about playback in the background, and keeps one message saying what's playing
+    # up to date, rather than sending a new one for every track.
+    self._sender: messages.Sender = sender or messages.Sender()
+    self._now_playing: messages.LiveMessage = messages.LiveMessage(self._sender)
+
+    # Persists playback state between runs, if given.
+    self._store: Optional[state.StateStore] = store
+    saved: Optional[dict] = store.Load(guild_id) if store else None
+
+    # Saved positions of playlists that haven't been used yet this run.
+    self._saved_playlists: dict[str, list] = saved.get('playlists', {}) if saved else {}
+
+    saved_name: Optional[str] = saved.get('playlist') if saved else None
+    if saved_name:
+      self._playlist = self._GetPlaylist(saved_name)
+
   # Returns true if bot successfully joined author's voice channel.
   async def Join(self, ctx: dctx.ApplicationContext,
                  announce: bool = False) -> JoinResult:
@@ -100,8 +244,9 @@ class ShiloGuild:
     await ctx.respond('Disconnected.')
 
   # Start playing the current playlist (or the given playlist).
+  # If a track is given, jump to it first.
   async def Start(self, ctx: dctx.ApplicationContext, playlist_name: Optional[str] = None,
-                  restart: bool = False) -> None:
+                  restart: bool = False, track: Optional[int] = None) -> None:
     join_result: JoinResult = await self.Join(ctx)
     if join_result == JoinResult.FAIL:
       return
@@ -118,21 +263,32 @@ class ShiloGuild:
       await broadcast('Playlist not specified!')
       return
 
-    if resolved_name not in self._playlists:
+    if resolved_name in self._broadcasts:
+      if restart:
+        await broadcast(f'Playlist "{resolved_name}" is shared, and can\'t be restarted!')
+        return
+
+      await broadcast(f'Playing playlist "{resolved_name}".')
+      self._Unschedule()
+      await self._PlayBroadcast(ctx, self._broadcasts[resolved_name])
+      return
+
+    playlist: Optional[playlists.Playlist] = self._GetPlaylist(resolved_name)
+    if not playlist:
       utils.log(utils.LogSeverity.WARNING,
                 f'Playlist "{resolved_name}" doesn\'t exist.')
       await broadcast(f'Playlist "{resolved_name}" doesn\'t exist!')
       return
-    playlist: playlists.Playlist = self._playlists[resolved_name]
 
     await broadcast(f'Playing playlist "{resolved_name}".')
 
     if restart:
       playlist.Restart()
+    if track is not None:
+      playlist.JumpTo(track)
 
     # Race: "next song" callback executes before we've started the new stream.
-    if self._playlist:
-      self._next_callbacks[self._playlist.name].Cancel()
+    self._Unschedule(keep=playlist)
 
     await self._PlayCurrent(ctx, playlist)
 
@@ -141,6 +297,20 @@ class ShiloGuild:
                     playlist_name: Optional[str] = None) -> None:
     await self.Start(ctx, playlist_name, True)
 
+  # Plays the given track, in the first of the given playlists (which should all hold it) that can
+  # be controlled. The current playlist is preferred if it's among them.
+  async def Play(self, ctx: dctx.ApplicationContext, track: int,
+                 playlist_names: list[str]) -> None:
+    candidates: list[str] = [n for n in playlist_names if n not in self._broadcasts]
+    if not candidates:
+      utils.log(utils.LogSeverity.WARNING, 'Can\'t play a track outside any own playlist.')
+      await ctx.respond('That track isn\'t in a playlist that can be controlled!')
+      return
+
+    playlist_name: str = (self._playlist.name if self._playlist
+                          and self._playlist.name in candidates else candidates[0])
+    await self.Start(ctx, playlist_name, track=track)
+
   # Stop the currently-playing playlist.
   async def Stop(self, ctx: dctx.ApplicationContext) -> None:
     if not _can_command(ctx):
@@ -158,12 +328,14 @@ class ShiloGuild:
     assert self._playlist is not None
 
     # Needed to stop the after-play callback from starting the next song.
-    self._next_callbacks[self._playlist.name].Cancel()
+    self._Unschedule()
     ctx.voice_client.stop()
+    self.SaveState()
 
     utils.log(utils.LogSeverity.INFO,
               f'Playback of {_track_name(self._playlist)} stopped.')
     await ctx.respond(f'Stopped playlist "{self._playlist.name}".')
+    self._now_playing.Update(f'Stopped at {_track_name(self._playlist)}.')
 
   # Move to the next track in the current playlist.
   async def Next(self, ctx: dctx.ApplicationContext) -> None:
@@ -173,13 +345,15 @@ class ShiloGuild:
 
     utils.log(utils.LogSeverity.INFO, 'Skipping to next.')
 
-    await ctx.respond(f'Finished {_track_name(self._playlist)}.')
+    finished: str = f'Finished {_track_name(self._playlist)}.'
     if ctx.voice_client.is_playing():
       # The after-play callback will automatically start playing the next song.
+      await ctx.respond(finished)
       ctx.voice_client.stop()
     else:
       self._playlist.Skip()
-      await ctx.send(f'Loaded {_track_name(self._playlist)}.')
+      self.SaveState()
+      await ctx.respond(f'{finished} Loaded {_track_name(self._playlist)}.')
 
   # Fast-forward the current song.
   async def FastForward(self, ctx: dctx.ApplicationContext, interval_str: str) -> None:
@@ -194,36 +368,54 @@ class ShiloGuild:
                 f'Cannot fast-forward by bad interval "{interval_str}".')
       return
 
-    self._playlist.FastForward(interval)
-
     utils.log(utils.LogSeverity.INFO, f'Fast-forwarding by {str(interval)}.')
     await ctx.respond(f'Fast-forwarded {_track_name(self._playlist)}.')
+    await self._RequestSeek(ctx, self._playlist, by=interval)
 
-    if ctx.voice_client.is_playing():
-      # Race: "next song" callback executes before we've started the new stream.
-      self._next_callbacks[self._playlist.name].Cancel()
+  # Move to the given position in the current song.
+  async def Seek(self, ctx: dctx.ApplicationContext, position_str: str) -> None:
+    if not await self._ReportActivePlaylistControl(ctx):
+      return
+    assert self._playlist is not None and ctx.voice_client is not None
+
+    position: Optional[datetime.timedelta] = utils.parse_position(position_str)
+    if position is None:
+      await ctx.respond(f'Couldn\'t understand position "{position_str}"!')
+      utils.log(utils.LogSeverity.WARNING, f'Cannot seek to bad position "{position_str}".')
+      return
 
-      await self._PlayCurrent(ctx, self._playlist, announce=False)
+    utils.log(utils.LogSeverity.INFO, f'Seeking to {str(position)}.')
+    await ctx.respond(f'Moved to {str(position)} in {_track_name(self._playlist)}.')
+    await self._RequestSeek(ctx, self._playlist, to=position)
+
+  # List playlists or the tracks in an individual playlist, a page at a time. Shows the given
+  # (1-indexed) page, or else the page with the current playlist or track.
+  async def List(self, ctx: dctx.ApplicationContext, playlist_name: Optional[str] = None,
+                 page: Optional[int] = None) -> None:
+    render: Callable[[Optional[int]], playlists.ListingPage]
 
-  # List playlists or the tracks in an individual playlist.
-  async def List(self, ctx: dctx.ApplicationContext, playlist_name: Optional[str] = None) -> None:
     # Print playlist list.
     if not playlist_name:
-      playlist_names: list[str] = list(self._playlists.keys())
+      playlist_names: list[str] = self._playlist_names
       current_index: int = playlist_names.index(
           self._playlist.name) if self._playlist else -1
-      table: str = playlists.get_playlist_listing(playlist_names, current_index)
-      await ctx.respond(f'```\n{table}\n```')
-      return
+      render = functools.partial(playlists.get_playlist_listing, playlist_names, current_index)
 
     # Print specific playlist.
-    if playlist_name not in self._playlists:
-      utils.log(utils.LogSeverity.WARNING,
-                f'Trying to print non-existent playlist "{playlist_name}".')
-      await ctx.respond(f'No playlist "{playlist_name}"!')
-      return
+    else:
+      playlist: Optional[playlists.Playlist] = self._GetPlaylist(playlist_name)
+      if not playlist:
+        utils.log(utils.LogSeverity.WARNING,
+                  f'Trying to print non-existent playlist "{playlist_name}".')
+        await ctx.respond(f'No playlist "{playlist_name}"!')
+        return
+      render = playlist.GetListingPage
 
-    await ctx.respond(f'```\n{self._playlists[playlist_name].GetTrackListing()}\n```')
+    first: playlists.ListingPage = render(page - 1 if page else None)
+    if first.pages > 1:
+      await ctx.respond(_format_page(first), view=_ListingView(render, first))
+    else:
+      await ctx.respond(_format_page(first))
 
   # Leave the voice channel once everyone else has.
   async def OnVoiceStateUpdate(self, bot_voice_client: discord.VoiceClient,
@@ -256,50 +448,293 @@ class ShiloGuild:
     if not playlist.current_track_name:
       utils.log(utils.LogSeverity.WARNING,
                 f'Tried to play empty playlist "{playlist.name}".')
-      await ctx.send(f'Couldn\'t play empty playlist "{playlist.name}"!')
+      self._Send(ctx, f'Couldn\'t play empty playlist "{playlist.name}"!')
       return
 
-    stream: Optional[playlists.ResumedAudio] = await playlist.MakeStream()
+    ended_at: Optional[float] = self._transition_ended_at
+    self._transition_ended_at = None
+
+    stream: Optional[playlists.Stream] = await playlist.MakeStream()
     if not stream:
       utils.log(utils.LogSeverity.ERROR,
                 f'Couldn\'t play {_track_name(playlist)}.')
-      await ctx.send(f'Couldn\'t play {_track_name(playlist)}!')
+      self._Send(ctx, f'Couldn\'t play {_track_name(playlist)}!')
       return
 
+    # Also unsubscribes from any broadcast.
     ctx.voice_client.stop()
 
     callback: utils.CancellableCoroutine = utils.CancellableCoroutine(
         self._PlayNextTrack(ctx, playlist))
 
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    transitions: asyncio.Queue[_Transition] = self._EnsureTransitions()
+
+    # Runs on the audio thread, so only hands over to the event loop.
     def schedule_next_track(exception: Optional[Exception], ctx: dctx.ApplicationContext = ctx,
                             callback: utils.CancellableCoroutine = callback,
                             playlist: playlists.Playlist = playlist) -> None:
-      if not ctx.voice_client:
+      loop.call_soon_threadsafe(transitions.put_nowait,
+                                _Transition(ctx, playlist, callback, time.monotonic()))
+
+    def prewarm_next(playlist: playlists.Playlist = playlist) -> None:
+      asyncio.run_coroutine_threadsafe(playlist.PrewarmNext(), loop)
+
+    def announce_next(ctx: dctx.ApplicationContext = ctx,
+                      playlist: playlists.Playlist = playlist) -> None:
+      _TRANSITIONS.Inc(label='gapless')
+      asyncio.run_coroutine_threadsafe(self._AnnounceAdvance(ctx, playlist), loop)
+
+    def report_latency(ended_at: Optional[float] = ended_at) -> None:
+      if ended_at is not None:
+        latency: float = time.monotonic() - ended_at
+        _TRANSITIONS.Inc(label='handoff')
+        _TRANSITION_SECONDS.Observe(latency)
+        # Every transition is measured, so only a sample is worth logging.
+        utils.log(utils.LogSeverity.INFO, f'Track transition took {latency * 1000:.0f}ms.',
+                  sample=0.1, guild=self._guild_id)
+
+    source: playlists.GaplessAudio = playlists.GaplessAudio(
+        playlist, stream, on_near_end=prewarm_next, on_advance=announce_next,
+        on_first_packet=report_latency)
+    ctx.voice_client.play(source, after=schedule_next_track)
+
+    # Update for /next, /skip etc.
+    self._playlist = playlist
+    self._source = source
+    self._next_callbacks[playlist.name] = callback
+
+    self.SaveState()
+
+    utils.log(utils.LogSeverity.INFO, 'Playback started.', playlist=playlist.name,
+              track=playlist.current_track_name)
+    if announce:
+      self._AnnounceTrack(ctx, playlist)
+
+  # Moves the given playlist to the given position (or else its current position), plus the given
+  # interval. A short skip ahead in the track being played is made straight away, in place. Any
+  # other move of a playing playlist is put off until requests stop arriving, and merged with any
+  # others made meanwhile, so that a burst of requests starts at most one stream.
+  async def _RequestSeek(self, ctx: dctx.ApplicationContext, playlist: playlists.Playlist,
+                         to: Optional[datetime.timedelta] = None,
+                         by: datetime.timedelta = datetime.timedelta()) -> None:
+    _SEEK_REQUESTS.Inc()
+
+    # A pending seek of some other playlist is carried out first.
+    if self._seek_playlist is not None and self._seek_playlist is not playlist:
+      await self._Seek(ctx)
+
+    now: float = time.monotonic()
+    if self._seek_playlist is None:
+      self._seek_playlist = playlist
+      self._seek_since = now
+    if to is not None:
+      self._seek_to = to
+      self._seek_by = datetime.timedelta()
+    self._seek_by += by
+
+    if not self._IsPlaying(ctx, playlist) or self._CanSkipInPlace(ctx):
+      await self._Seek(ctx)
+      return
+
+    # Each request puts the seek off a little longer, up to a limit.
+    self._seek_at = min(self._seek_since + _MAX_SEEK_DELAY_S, now + _SEEK_DEBOUNCE_S)
+    if not self._seek_task:
+      self._seek_task = asyncio.get_running_loop().create_task(self._SeekWhenSettled(ctx))
+
+  # Carries out the pending seek once no more requests have been made for a moment.
+  async def _SeekWhenSettled(self, ctx: dctx.ApplicationContext) -> None:
+    try:
+      while time.monotonic() < self._seek_at:
+        await asyncio.sleep(self._seek_at - time.monotonic())
+    finally:
+      self._seek_task = None
+
+    try:
+      await self._Seek(ctx)
+    except Exception as e:
+      utils.log(utils.LogSeverity.ERROR, f'Couldn\'t seek: "{e}".')
+
+  # Carries out the pending seek, if there is one: in place if possible, or else by moving the
+  # playlist and, if it's playing, starting a new stream.
+  async def _Seek(self, ctx: dctx.ApplicationContext) -> None:
+    playlist: Optional[playlists.Playlist] = self._seek_playlist
+    if playlist is None:
+      return
+
+    in_place: bool = self._CanSkipInPlace(ctx)
+    current, target = self._GetSeek()
+    self._seek_playlist = None
+    self._seek_to = None
+    self._seek_by = datetime.timedelta()
+
+    if in_place:
+      assert self._source is not None
+      self._source.Skip(target - current)
+      _SEEKS.Inc(label='in_place')
+      return
+
+    # The new stream starts from the target, so the old one needn't carry on skipping.
+    if self._source is not None and self._playlist is playlist:
+      self._source.CancelSkip()
+    playlist.Seek(target)
+    self.SaveState()
+
+    if self._IsPlaying(ctx, playlist):
+      _SEEKS.Inc(label='new_stream')
+
+      # Race: "next song" callback executes before we've started the new stream.
+      self._next_callbacks[playlist.name].Cancel()
+
+      await self._PlayCurrent(ctx, playlist, announce=False)
+
+  # Returns the current position of the playlist with a pending seek (counting any skip that's still
+  # being made in place), and the position to move to.
+  def _GetSeek(self) -> tuple[datetime.timedelta, datetime.timedelta]:
+    assert self._seek_playlist is not None
+    current: datetime.timedelta = self._seek_playlist.GetPosition()
+    if self._source is not None and self._playlist is self._seek_playlist:
+      current += self._source.skipping
+    target: datetime.timedelta = (
+        current if self._seek_to is None else self._seek_to) + self._seek_by
+    return current, max(target, datetime.timedelta())
+
+  # Returns true if the pending seek is a short enough skip ahead in the playing track to be made in
+  # place.
+  def _CanSkipInPlace(self, ctx: dctx.ApplicationContext) -> bool:
+    if self._seek_playlist is None or not self._IsPlaying(ctx, self._seek_playlist):
+      return False
+    current, target = self._GetSeek()
+    # Skips still being made count towards the limit, so that a run of short ones can't add up.
+    assert self._source is not None
+    limit: datetime.timedelta = min(_MAX_IN_PLACE_SKIP, self._source.skippable)
+    return (datetime.timedelta() <= target - current
+            and target - current + self._source.skipping <= limit)
+
+  # Returns true if the given playlist is playing.
+  def _IsPlaying(self, ctx: dctx.ApplicationContext, playlist: playlists.Playlist) -> bool:
+    return (ctx.voice_client is not None and ctx.voice_client.is_playing()
+            and self._playlist is playlist and self._source is not None)
+
+  # Reports that playback moved seamlessly onto the next track of the given playlist.
+  async def _AnnounceAdvance(self, ctx: dctx.ApplicationContext,
+                             playlist: playlists.Playlist) -> None:
+    # Runs in a task started from the audio thread, which has no log fields of its own.
+    utils.set_log_fields(guild=self._guild_id)
+    utils.log(utils.LogSeverity.INFO, 'Playback continued.', playlist=playlist.name,
+              track=playlist.current_track_name)
+    self.SaveState()
+    self._AnnounceTrack(ctx, playlist)
+
+  # Updates the message saying what's playing, moving it to the channel of the given command.
+  def _AnnounceTrack(self, ctx: dctx.ApplicationContext, playlist: playlists.Playlist) -> None:
+    self._now_playing.Update(f'Playing {_track_name(playlist)} from playlist "{playlist.name}".',
+                             ctx)
+
+  # Returns the queue of pending track transitions, starting the task that runs them if needed.
+  def _EnsureTransitions(self) -> asyncio.Queue[_Transition]:
+    if self._transitions is None:
+      self._transitions = asyncio.Queue()
+      self._transition_task = asyncio.get_running_loop().create_task(self._RunTransitions())
+    return self._transitions
+
+  # Runs track transitions in order, each with a time limit.
+  async def _RunTransitions(self) -> None:
+    assert self._transitions is not None
+    while True:
+      transition: _Transition = await self._transitions.get()
+      try:
+        await asyncio.wait_for(self._RunTransition(transition), _TRANSITION_TIMEOUT_S)
+      except asyncio.TimeoutError:
+        self._RetryTransition(transition)
+      except Exception as e:
+        utils.log(utils.LogSeverity.ERROR, f'Couldn\'t start the next track: "{e}".')
+
+  # Queues another attempt at a transition that timed out, unless it's been cancelled or has been
+  # tried too many times.
+  def _RetryTransition(self, transition: _Transition) -> None:
+    ctx, playlist, callback, ended_at, retries = transition
+    if callback.cancelled or not ctx.voice_client:
+      return
+
+    if retries + 1 >= _MAX_TRANSITION_ATTEMPTS:
+      utils.log(utils.LogSeverity.ERROR, 'Timed out starting the next track. Stopping.')
+      self._Send(ctx, f'Couldn\'t start {_track_name(playlist)}: the bot is too busy. Stopping.')
+      return
+
+    utils.log(utils.LogSeverity.ERROR, 'Timed out starting the next track. Trying again.')
+    if not retries:
+      self._Send(ctx, f'Waiting to start {_track_name(playlist)}: the bot is busy.')
+
+    # Once started, the attempt has moved the playlist on to the next track, and only has to play
+    # it. The coroutine of an attempt that was cut off can't be resumed.
+    if callback.started:
+      callback = utils.CancellableCoroutine(self._PlayCurrent(ctx, playlist))
+      self._next_callbacks[playlist.name] = callback
+    assert self._transitions is not None
+    self._transitions.put_nowait(_Transition(ctx, playlist, callback, ended_at, retries + 1))
+
+  # Starts the next track after the previous one ended, unless that's been cancelled. A track that
+  # failed is quarantined and skipped, unless too many have failed in a row.
+  async def _RunTransition(self, transition: _Transition) -> None:
+    ctx, playlist, callback, ended_at, _ = transition
+    if callback.cancelled:
+      return
+
+    if not ctx.voice_client:
+      callback.Cancel()
+      return
+
+    if not playlist.StreamHasError():
+      self._failed_tracks = 0
+    elif await playlist.QuarantineCurrent():
+      self._failed_tracks += 1
+      if self._failed_tracks >= _MAX_FAILED_TRACKS:
         callback.Cancel()
+        self._failed_tracks = 0
+        self._Send(ctx, f'Error playing {_track_name(playlist)}, and {_MAX_FAILED_TRACKS - 1} '
+                   'tracks before it. Stopping.')
         return
+      self._Send(ctx, f'Error playing {_track_name(playlist)}. Skipping it from now on.')
+    else:
+      callback.Cancel()
+      self._Send(ctx, f'Error playing {_track_name(playlist)}. Stopping.')
+      return
 
-      future: Optional[futures.Future] = None
-      if playlist.StreamHasError():
-        callback.Cancel()
-        print_err = ctx.send(
-            f'Error playing {_track_name(playlist)}. Stopping.')
-        future = asyncio.run_coroutine_threadsafe(
-            print_err, ctx.voice_client.loop)
-      else:
-        future = asyncio.run_coroutine_threadsafe(
-            callback.Run(), ctx.voice_client.loop)
+    self._transition_ended_at = ended_at
+    await callback.Run()
 
-      future.result()
+  # Sends a message about playback in the background, so that slow Discord API calls never hold up
+  # playback.
+  def _Send(self, ctx: dctx.ApplicationContext, message: str) -> None:
+    self._sender.Send(ctx, message)
 
-    ctx.voice_client.play(stream, after=schedule_next_track)
+  # Tune in to the given broadcast over the bot voice channel. The bot must be connected to some
+  # voice channel.
+  async def _PlayBroadcast(self, ctx: dctx.ApplicationContext,
+                           shared: broadcasts.Broadcast) -> None:
+    assert ctx.voice_client is not None
 
-    # Update for /next, /skip etc.
-    self._playlist = playlist
-    self._next_callbacks[playlist.name] = callback
+    if self._playlist is shared.playlist and ctx.voice_client.is_playing():
+      return
 
-    utils.log(utils.LogSeverity.INFO, 'Playback started.')
-    if announce:
-      await ctx.send(f'Playing {_track_name(playlist)}.')
+    if not shared.playlist.current_track_name:
+      utils.log(utils.LogSeverity.WARNING,
+                f'Tried to play empty playlist "{shared.name}".')
+      self._Send(ctx, f'Couldn\'t play empty playlist "{shared.name}"!')
+      return
+
+    # Also unsubscribes from any other broadcast.
+    ctx.voice_client.stop()
+
+    def report_end(exception: Optional[Exception], name: str = shared.name) -> None:
+      if exception:
+        utils.log(utils.LogSeverity.ERROR, f'Broadcast "{name}" failed: "{exception}".')
+
+    ctx.voice_client.play(shared.Subscribe(), after=report_end)
+    self._playlist = shared.playlist
+
+    utils.log(utils.LogSeverity.INFO, f'Tuned in to broadcast "{shared.name}".')
 
   # Play the next track of the given playlist.
   async def _PlayNextTrack(self, ctx: dctx.ApplicationContext,
@@ -310,10 +745,11 @@ class ShiloGuild:
   # Stop the currently playing song, de-select the current playlist and disconnect from the current
   # voice channel.
   async def _Disconnect(self, voice_client: discord.VoiceClient) -> None:
-    if self._playlist:
-      self._next_callbacks[self._playlist.name].Cancel()
+    self._Unschedule()
     voice_client.stop()
     self._playlist = None
+    self.SaveState()
+    self._now_playing.Update('Not playing.')
 
     await voice_client.disconnect()
 
@@ -330,4 +766,79 @@ class ShiloGuild:
       await ctx.respond('No playlist selected!')
       return False
 
+    if self._playlist.name in self._broadcasts:
+      await ctx.respond(f'Playlist "{self._playlist.name}" is shared, and can\'t be controlled!')
+      return False
+
     return True
+
+  # Returns the playlist (or broadcast playlist) with the given name, if there is one, creating this
+  # guild's copy if it hasn't been used before.
+  def _GetPlaylist(self, name: str) -> Optional[playlists.Playlist]:
+    if name in self._broadcasts:
+      return self._broadcasts[name].playlist
+
+    if name not in self._playlists:
+      if name not in self._playlist_names:
+        return None
+      playlist: playlists.Playlist = playlists.Playlist(name, self._library, self._supervisor,
+                                                        self._track_cache, owner=self._guild_id,
+                                                        read_ahead=self._read_ahead,
+                                                        prefetcher=self._prefetcher)
+
+      saved: Optional[list] = self._saved_playlists.pop(name, None)
+      try:
+        if saved and not playlist.Restore(playlists.PlaylistState(*saved)):
+          utils.log(utils.LogSeverity.INFO, f'Playlist "{name}" changed; not resuming it.')
+      except TypeError:
+        utils.log(utils.LogSeverity.WARNING, f'Ignoring bad saved state of playlist "{name}".')
+
+      self._playlists[name] = playlist
+
+    return self._playlists[name]
+
+  # Saves this guild's state and stops its background work, before it's dropped from memory. Must
+  # not be called while connected.
+  def Close(self) -> None:
+    for playlist in self._playlists.values():
+      playlist.DiscardNext()
+    self.SaveState()
+
+    if self._transition_task:
+      self._transition_task.cancel()
+      self._transition_task = None
+      self._transitions = None
+
+    if self._seek_task:
+      self._seek_task.cancel()
+
+    # Stop reading ahead for playlists that are no longer in memory.
+    if self._prefetcher:
+      self._prefetcher.Cancel(self._guild_id)
+
+  # Schedules this guild's playback state to be saved, if there's a store.
+  def SaveState(self) -> None:
+    if not self._store:
+      return
+
+    saved_playlists: dict[str, list] = dict(self._saved_playlists)
+    for name, playlist in self._playlists.items():
+      saved_playlists[name] = list(playlist.GetState())
+
+    self._store.Save(self._guild_id, {
+        'playlist': self._playlist.name if self._playlist else None,
+        'playlists': saved_playlists,
+    })
+
+  # Stops the current playlist's after-play callback from starting its next track, and throws away
+  # its prepared next track unless it's about to be played again. Broadcasts have neither.
+  def _Unschedule(self, keep: Optional[playlists.Playlist] = None) -> None:
+    if not self._playlist or self._playlist.name in self._broadcasts:
+      return
+
+    # A playlist restored from a previous run might not have played yet.
+    callback: Optional[utils.CancellableCoroutine] = self._next_callbacks.get(self._playlist.name)
+    if callback:
+      callback.Cancel()
+    if self._playlist is not keep:
+      self._playlist.DiscardNext()
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+import asyncio
+import collections
+import functools
+import time
+
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple, Optional
+
+import discord
+
+import metrics
+import utils
+
+# Default limits on the Discord API calls made for messages about playback: at most this many a
+# second in all, as a backstop under Discord's global limit, and at most this many a second to any
+# one channel. Live messages are also edited at most once per interval (later updates are merged
+# into the next edit).
+_REQUESTS_PER_S: float = 40.0
+_CHANNEL_REQUESTS_PER_S: float = 1.0
+_EDIT_INTERVAL_S: float = 2.0
+
+# Number of calls made at once, so that one slow call doesn't hold up every other channel's.
+_CONCURRENCY: int = 4
+
+# Limit on the time to make one call, and the pause in calls to a channel after Discord reports that
+# a rate limit was hit.
+_MESSAGE_TIMEOUT_S: float = 10.0
+_RATE_LIMITED_S: float = 5.0
+
+# Upper bound on the messages waiting to be sent. Further messages are dropped.
+_MAX_QUEUED: int = 1000
+
+_MESSAGES: metrics.Counter = metrics.Counter(
+    'shilo_messages_total', 'Discord API calls about playback, by kind (e.g. send or edit).',
+    label='kind')
+_MESSAGES_DROPPED: metrics.Counter = metrics.Counter(
+    'shilo_messages_dropped_total', 'Messages about playback that couldn\'t be sent.',
+    label='reason')
+
+
+# Where messages can be sent, e.g. a channel or a command's context.
+Destination = Any
+
+
+# Returns the id of the channel of the given destination, if known.
+def _channel_id(destination: Destination) -> Optional[int]:
+  return getattr(destination, 'channel_id', None)
+
+
+# A call waiting to be made: the channel it's for, the (monotonic) time before which it mustn't be
+# made, and the call itself.
+class _Call(NamedTuple):
+  channel: Optional[int]
+  not_before: float
+  call: Callable[[], Awaitable[Any]]
+
+
+# Sends messages about playback in the background, so that slow or rate-limited Discord API calls
+# never hold up playback. Calls are paced per channel, since that's how Discord limits them, with a
+# few made at once and a cap on the total rate as a backstop. A channel whose calls Discord reports
+# were rate-limited anyway is paused for a while.
+#
+# Calls to the same channel are made one at a time, in order, except that a live message waiting to
+# be edited doesn't hold up the channel's other messages.
+#
+# Must be used from the event loop.
+class Sender:
+
+  def __init__(self, requests_per_s: float = _REQUESTS_PER_S,
+               channel_requests_per_s: float = _CHANNEL_REQUESTS_PER_S,
+               concurrency: int = _CONCURRENCY):
+    self._interval: float = 1 / requests_per_s
+    self._channel_interval: float = 1 / channel_requests_per_s
+    self._concurrency: int = concurrency
+
+    # Monotonic times before which the next call, and the next call to each channel, mustn't be
+    # made. Channels are forgotten once they're idle.
+    self._next_at: float = 0.0
+    self._channel_next_at: dict[Optional[int], float] = {}
+
+    # Calls waiting to be made, in order. Live messages are keyed by themselves, so that each is
+    # queued at most once.
+    self._queue: collections.OrderedDict[Hashable, _Call] = collections.OrderedDict()
+
+    # Calls being made, and the channels they're for.
+    self._running: set[asyncio.Task] = set()
+    self._busy: set[Optional[int]] = set()
+
+    # Set whenever a call is queued or finishes.
+    self._wakeup: Optional[asyncio.Event] = None
+    self._task: Optional[asyncio.Task] = None
+
+  # Sends the given text to the given destination.
+  def Send(self, destination: Destination, text: str) -> None:
+    self._Queue(object(), _channel_id(destination), 0.0,
+                functools.partial(self._SendNow, destination, text))
+
+  # Number of calls waiting to be made.
+  @property
+  def queued(self) -> int:
+    return len(self._queue)
+
+  # Drops queued calls and abandons those being made, e.g. before the event loop is closed.
+  def Close(self) -> None:
+    self._queue.clear()
+    for task in list(self._running):
+      task.cancel()
+    if self._task:
+      self._task.cancel()
+      self._task = None
+
+  async def _SendNow(self, destination: Destination, text: str) -> None:
+    await destination.send(text)
+    _MESSAGES.Inc(label='send')
+
+  def _Queue(self, key: Hashable, channel: Optional[int], not_before: float,
+             call: Callable[[], Awaitable[Any]]) -> None:
+    if key in self._queue:
+      # A live message may have moved channel meanwhile.
+      self._queue[key] = self._queue[key]._replace(channel=channel)
+      return
+    if len(self._queue) >= _MAX_QUEUED:
+      _MESSAGES_DROPPED.Inc(label='queue_full')
+      utils.log(utils.LogSeverity.WARNING, 'Too many messages queued; dropping one.', sample=0.01)
+      return
+
+    self._queue[key] = _Call(channel, not_before, call)
+
+    if self._task is None:
+      self._wakeup = asyncio.Event()
+      self._task = asyncio.get_running_loop().create_task(self._Run())
+    assert self._wakeup is not None
+    self._wakeup.set()
+
+  # Makes queued calls forever.
+  async def _Run(self) -> None:
+    assert self._wakeup is not None
+    while True:
+      self._wakeup.clear()
+      wait: Optional[float] = self._StartDue()
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), wait)
+      except asyncio.TimeoutError:
+        pass
+
+  # Starts as many queued calls as the limits allow. Returns the time until another might be
+  # allowed, or None if that has to wait for a call to be queued or to finish.
+  def _StartDue(self) -> Optional[float]:
+    now: float = time.monotonic()
+    if not self._queue:
+      self._channel_next_at = {c: t for c, t in self._channel_next_at.items() if t > now}
+      return None
+
+    wait: Optional[float] = None
+    for key, (channel, not_before, call) in list(self._queue.items()):
+      if len(self._running) >= self._concurrency:
+        return None
+      if channel in self._busy:
+        continue
+
+      due: float = max(not_before, self._channel_next_at.get(channel, 0.0), self._next_at)
+      if due > now:
+        wait = due - now if wait is None else min(wait, due - now)
+        continue
+
+      del self._queue[key]
+      self._next_at = max(self._next_at, now) + self._interval
+      self._channel_next_at[channel] = now + self._channel_interval
+      self._busy.add(channel)
+      task: asyncio.Task = asyncio.get_running_loop().create_task(self._Call(key, channel, call))
+      self._running.add(task)
+      task.add_done_callback(self._running.discard)
+
+    return wait
+
+  # Makes the given call, and then lets the next call to its channel be made.
+  async def _Call(self, key: Hashable, channel: Optional[int],
+                  call: Callable[[], Awaitable[Any]]) -> None:
+    try:
+      await asyncio.wait_for(call(), _MESSAGE_TIMEOUT_S)
+    except discord.HTTPException as e:
+      if e.status == 429:
+        self._channel_next_at[channel] = time.monotonic() + _RATE_LIMITED_S
+        _MESSAGES_DROPPED.Inc(label='rate_limited')
+        # A live message is tried again with whatever its latest text is by then.
+        if isinstance(key, LiveMessage):
+          self._Queue(key, channel, 0.0, call)
+      else:
+        _MESSAGES_DROPPED.Inc(label='error')
+      utils.log(utils.LogSeverity.WARNING, f'Couldn\'t send message: "{e}".')
+    except (asyncio.TimeoutError, discord.DiscordException) as e:
+      _MESSAGES_DROPPED.Inc(label='error')
+      utils.log(utils.LogSeverity.WARNING, f'Couldn\'t send message: "{e or "timed out"}".')
+    finally:
+      self._busy.discard(channel)
+      assert self._wakeup is not None
+      self._wakeup.set()
+
+
+# A message that's kept up to date by editing it in place (e.g. saying what's playing), rather than
+# by sending a new message each time. The message is sent on first update, and again whenever it's
+# moved to another channel or was deleted.
+#
+# Updates are sent through a Sender, at most one edit per interval: only the latest text is sent.
+class LiveMessage:
+
+  def __init__(self, sender: Sender):
+    self._sender: Sender = sender
+
+    # Where the message is shown, and its latest text.
+    self._destination: Optional[Destination] = None
+    self._channel_id: Optional[int] = None
+    self._text: str = ''
+
+    # The message as last sent, if it has been, and when it can next be edited (monotonic).
+    self._message: Optional[discord.Message] = None
+    self._sent_text: Optional[str] = None
+    self._edit_at: float = 0.0
+
+  # Sets the text of the message, moving it to the given destination's channel if one is given.
+  def Update(self, text: str, destination: Optional[Destination] = None) -> None:
+    if destination is not None:
+      channel_id: Optional[int] = _channel_id(destination)
+      if self._destination is None or channel_id != self._channel_id:
+        self._message = None
+      self._destination = destination
+      self._channel_id = channel_id
+
+    if self._destination is None:
+      return
+
+    self._text = text
+    self._sender._Queue(self, self._channel_id, self._edit_at, self._Flush)
+
+  # Sends or edits the message to show its latest text.
+  async def _Flush(self) -> None:
+    text: str = self._text
+    if self._message is not None and text == self._sent_text:
+      return
+    self._edit_at = time.monotonic() + _EDIT_INTERVAL_S
+
+    if self._message is not None:
+      try:
+        await self._message.edit(content=text)
+        _MESSAGES.Inc(label='edit')
+        self._sent_text = text
+        return
+      except discord.NotFound:
+        # Deleted; send it again.
+        self._message = None
+
+    assert self._destination is not None
+    self._message = await self._destination.send(text)
+    _MESSAGES.Inc(label='send')
+    self._sent_text = text
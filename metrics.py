@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+import asyncio
+import bisect
+import contextvars
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from typing import Any, Callable, Coroutine, Optional
+
+import utils
+
+# Default histogram buckets, in seconds.
+LATENCY_BUCKETS: tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25,
+                                      0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# How often to measure event loop lag.
+_LAG_INTERVAL_S: float = 0.5
+
+# The event loop counts as blocked once it's gone this long without waking up, and is checked for
+# that this often.
+_STALL_S: float = 0.25
+_WATCHDOG_INTERVAL_S: float = 0.05
+
+# Number of the innermost frames of the blocked code that are logged.
+_STALL_FRAMES: int = 8
+
+# Upper bound on the size of an HTTP request head.
+_MAX_REQUEST_BYTES: int = 8192
+
+
+# Escapes a label value for the Prometheus text format.
+def _escape(value: str) -> str:
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Formats a sample line, with an optional label.
+def _sample(name: str, value: float, labels: Optional[dict[str, str]] = None) -> str:
+  label_str: str = (
+      '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}' if labels else '')
+  return f'{name}{label_str} {value:g}'
+
+
+# Formats a duration in seconds for humans.
+def _format_seconds(seconds: float) -> str:
+  return f'{seconds * 1000:.1f}ms' if seconds < 1 else f'{seconds:.2f}s'
+
+
+# A named measurement, optionally split by the value of one label. Registered on construction, and
+# safe to update from any thread.
+class _Metric:
+  _KIND: str = 'untyped'
+
+  def __init__(self, name: str, description: str, label: Optional[str] = None):
+    self._name: str = name
+    self._description: str = description
+    self._label: Optional[str] = label
+    self._lock: threading.Lock = threading.Lock()
+
+    with _registry_lock:
+      _registry.append(self)
+
+  # Returns the metric in Prometheus text format.
+  def Render(self) -> list[str]:
+    return [f'# HELP {self._name} {self._description}', f'# TYPE {self._name} {self._KIND}']
+
+  # Returns (name, human-readable value) rows describing the metric.
+  def Summarise(self) -> list[tuple[str, str]]:
+    return []
+
+  def _Labels(self, value: Optional[str]) -> Optional[dict[str, str]]:
+    return {self._label: value} if self._label and value is not None else None
+
+  def _Name(self, value: Optional[str]) -> str:
+    return f'{self._name}[{value}]' if value is not None else self._name
+
+
+# A monotonically-increasing count of events.
+class Counter(_Metric):
+  _KIND: str = 'counter'
+
+  def __init__(self, name: str, description: str, label: Optional[str] = None):
+    super().__init__(name, description, label)
+    self._values: dict[Optional[str], float] = {}
+
+  def Inc(self, amount: float = 1, label: Optional[str] = None) -> None:
+    with self._lock:
+      self._values[label] = self._values.get(label, 0) + amount
+
+  def Render(self) -> list[str]:
+    with self._lock:
+      values: dict[Optional[str], float] = dict(self._values) or {None: 0}
+    return super().Render() + [_sample(self._name, v, self._Labels(l)) for l, v in values.items()]
+
+  def Summarise(self) -> list[tuple[str, str]]:
+    with self._lock:
+      values: dict[Optional[str], float] = dict(self._values) or {None: 0}
+    return [(self._Name(l), f'{v:g}') for l, v in sorted(values.items(), key=lambda i: i[0] or '')]
+
+
+# A value read on demand, e.g. the size of some collection.
+class Gauge(_Metric):
+  _KIND: str = 'gauge'
+
+  def __init__(self, name: str, description: str, read: Callable[[], float]):
+    super().__init__(name, description)
+    self._read: Callable[[], float] = read
+
+  def Render(self) -> list[str]:
+    return super().Render() + [_sample(self._name, self._read())]
+
+  def Summarise(self) -> list[tuple[str, str]]:
+    return [(self._name, f'{self._read():g}')]
+
+
+# The distribution of some measurement (usually a duration in seconds), counted in fixed buckets.
+class Histogram(_Metric):
+  _KIND: str = 'histogram'
+
+  def __init__(self, name: str, description: str, label: Optional[str] = None,
+               buckets: tuple[float, ...] = LATENCY_BUCKETS):
+    super().__init__(name, description, label)
+    self._buckets: tuple[float, ...] = buckets
+
+    # Per label value: the count in each bucket (plus one for overflow), and the sum of all
+    # observations.
+    self._counts: dict[Optional[str], list[int]] = {}
+    self._sums: dict[Optional[str], float] = {}
+
+  def Observe(self, value: float, label: Optional[str] = None) -> None:
+    i: int = bisect.bisect_left(self._buckets, value)
+    with self._lock:
+      counts: Optional[list[int]] = self._counts.get(label)
+      if counts is None:
+        counts = self._counts[label] = [0] * (len(self._buckets) + 1)
+        self._sums[label] = 0.0
+      counts[i] += 1
+      self._sums[label] += value
+
+  def Render(self) -> list[str]:
+    with self._lock:
+      counts: dict[Optional[str], list[int]] = {l: list(c) for l, c in self._counts.items()}
+      sums: dict[Optional[str], float] = dict(self._sums)
+
+    lines: list[str] = super().Render()
+    for label, bucket_counts in counts.items():
+      base: dict[str, str] = self._Labels(label) or {}
+      total: int = 0
+      for bound, count in zip(self._buckets + (float('inf'),), bucket_counts):
+        total += count
+        lines.append(_sample(f'{self._name}_bucket', total,
+                             {**base, 'le': '+Inf' if bound == float('inf') else f'{bound:g}'}))
+      lines.append(_sample(f'{self._name}_sum', sums[label], base or None))
+      lines.append(_sample(f'{self._name}_count', total, base or None))
+    return lines
+
+  def Summarise(self) -> list[tuple[str, str]]:
+    with self._lock:
+      counts: dict[Optional[str], list[int]] = {l: list(c) for l, c in self._counts.items()}
+
+    if not counts:
+      return [(self._name, 'n=0')]
+
+    return [(self._Name(label), f'n={sum(c)} p50<={self._Bound(c, 0.5)} '
+             f'p95<={self._Bound(c, 0.95)} p99<={self._Bound(c, 0.99)}')
+            for label, c in sorted(counts.items(), key=lambda i: i[0] or '')]
+
+  # Returns the upper bound of the bucket containing the given quantile of the given counts.
+  def _Bound(self, counts: list[int], quantile: float) -> str:
+    rank: float = quantile * sum(counts)
+    total: int = 0
+    for bound, count in zip(self._buckets, counts):
+      total += count
+      if total >= rank:
+        return _format_seconds(bound)
+    return 'inf'
+
+
+# Every metric created, in order of creation.
+_registry_lock: threading.Lock = threading.Lock()
+_registry: list[_Metric] = []
+
+_LOOP_LAG: Histogram = Histogram('shilo_event_loop_lag_seconds',
+                                 'Delay of event loop wake-ups beyond their scheduled time.')
+_LOOP_STALLS: Counter = Counter('shilo_event_loop_stalls_total',
+                               f'Times the event loop was blocked for over {_STALL_S}s.')
+_LOGS_DROPPED: Gauge = Gauge('shilo_log_records_dropped',
+                             'Log records dropped because too many were waiting to be written.',
+                             utils.dropped_logs)
+
+
+# Returns every metric in Prometheus text format.
+def render() -> str:
+  with _registry_lock:
+    registered: list[_Metric] = list(_registry)
+  return '\n'.join(line for m in registered for line in m.Render()) + '\n'
+
+
+# Returns (name, human-readable value) rows describing every metric.
+def summarise() -> list[tuple[str, str]]:
+  with _registry_lock:
+    registered: list[_Metric] = list(_registry)
+  return [row for m in registered for row in m.Summarise()]
+
+
+# Measures event loop lag until cancelled.
+async def monitor_loop_lag() -> None:
+  while True:
+    before: float = time.monotonic()
+    await asyncio.sleep(_LAG_INTERVAL_S)
+    _LOOP_LAG.Observe(max(0.0, time.monotonic() - before - _LAG_INTERVAL_S))
+
+
+# Watches an event loop from another thread, and logs what's running whenever the loop is blocked
+# for too long: the innermost frames of the blocked code, and the log fields (e.g. the guild and
+# command) of the task being run, if any.
+class _LoopWatchdog:
+
+  def __init__(self, loop: asyncio.AbstractEventLoop):
+    self._loop: asyncio.AbstractEventLoop = loop
+    self._loop_thread: int = threading.get_ident()
+
+    # Monotonic time at which the loop last woke up the watchdog.
+    self._beat: float = time.monotonic()
+
+    # The context of every task, so that the running task's log fields can be read from the
+    # watchdog thread.
+    self._contexts: weakref.WeakKeyDictionary[asyncio.Task, contextvars.Context] = (
+        weakref.WeakKeyDictionary())
+
+    self._stopped: threading.Event = threading.Event()
+
+  # Watches until cancelled.
+  async def Run(self) -> None:
+    # Tasks can only be given a context of our choosing from Python 3.11. Before that, stalls are
+    # reported without the task's log fields.
+    if sys.version_info >= (3, 11):
+      self._loop.set_task_factory(self._CreateTask)
+    threading.Thread(target=self._Watch, name='loop-watchdog', daemon=True).start()
+    try:
+      while True:
+        self._beat = time.monotonic()
+        await asyncio.sleep(_WATCHDOG_INTERVAL_S)
+    finally:
+      self._stopped.set()
+      self._loop.set_task_factory(None)
+
+  def _CreateTask(self, loop: asyncio.AbstractEventLoop, coro: Coroutine[Any, Any, Any],
+                  context: Optional[contextvars.Context] = None) -> asyncio.Task:
+    context = context or contextvars.copy_context()
+    task: asyncio.Task = asyncio.Task(coro, loop=loop, context=context)
+    self._contexts[task] = context
+    return task
+
+  # Runs on the watchdog thread.
+  def _Watch(self) -> None:
+    reported: Optional[float] = None
+    while not self._stopped.wait(_WATCHDOG_INTERVAL_S):
+      beat: float = self._beat
+      blocked: float = time.monotonic() - beat
+      # Report each stall once.
+      if blocked >= _STALL_S and beat != reported:
+        reported = beat
+        self._Report(blocked)
+
+  def _Report(self, blocked: float) -> None:
+    _LOOP_STALLS.Inc()
+
+    frame: Any = sys._current_frames().get(self._loop_thread)
+    stack: list[traceback.FrameSummary] = (
+        list(traceback.extract_stack(frame, _STALL_FRAMES)) if frame else [])
+    where: str = f'{stack[-1].name} ({stack[-1].filename}:{stack[-1].lineno})' if stack else '?'
+
+    task: Optional[asyncio.Task] = asyncio.current_task(self._loop)
+    context: Optional[contextvars.Context] = self._contexts.get(task) if task else None
+    fields: dict[str, Any] = utils.get_log_fields(context) if context else {}
+
+    utils.log(utils.LogSeverity.WARNING,
+              f'Event loop blocked for {blocked * 1000:.0f}ms so far, in {where}.',
+              **fields, task=task.get_name() if task else None,
+              stack=[f'{s.filename}:{s.lineno} {s.name}' for s in stack])
+
+
+# Logs whatever blocks the running event loop for too long, until cancelled.
+async def watch_loop() -> None:
+  await _LoopWatchdog(asyncio.get_running_loop()).Run()
+
+
+# Serves every metric over HTTP at /metrics on the given local port, until cancelled.
+async def serve(port: int, host: str = '127.0.0.1') -> None:
+
+  async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+      head: bytes = await reader.readuntil(b'\r\n\r\n')
+      path: str = head.split(b' ', 2)[1].decode('latin-1') if head.count(b' ') >= 2 else ''
+
+      status: str = '200 OK'
+      body: bytes = b''
+      if path.split('?')[0] == '/metrics':
+        body = render().encode('utf8')
+      else:
+        status = '404 Not Found'
+
+      writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                   f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1')
+                   + body)
+      await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+      pass
+    finally:
+      writer.close()
+
+  server: asyncio.AbstractServer = await asyncio.start_server(handle, host, port,
+                                                              limit=_MAX_REQUEST_BYTES)
+  utils.log(utils.LogSeverity.INFO, f'Serving metrics on http://{host}:{port}/metrics.')
+  async with server:
+    await server.serve_forever()
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+
+import array
+import bisect
+import collections
+import datetime
+import mmap
+import os
+import struct
+import threading
+
+from typing import Iterator, NamedTuple, Optional
+
+import discord
+
+import utils
+
+# Opus always decodes at 48kHz, and granule positions are in samples at this rate.
+_SAMPLE_RATE: int = 48000
+
+# discord's player sends one packet every 20ms, so only streams of 20ms packets play at the right
+# speed.
+_FRAME_SAMPLES: int = 960
+
+# Number of leading audio packets checked for the expected frame size.
+_FRAME_CHECK_PACKETS: int = 8
+
+# Number of per-file seek indices kept in memory.
+_MAX_CACHED_INDICES: int = 256
+
+_PAGE_HEADER: struct.Struct = struct.Struct('<4sBBqIIIB')
+_CAPTURE_PATTERN: bytes = b'OggS'
+_CONTINUED_FLAG: int = 0x01
+
+# Frame sizes (in samples) for each Opus TOC config number.
+_FRAME_SIZES: list[int] = [480, 960, 1920, 2880] * 3 + [480, 960] * 2 + [120, 240, 480, 960] * 4
+
+
+# Returns the number of samples in the given Opus packet.
+def _packet_samples(packet: bytes) -> int:
+  if not packet:
+    return 0
+
+  toc: int = packet[0]
+  code: int = toc & 0x3
+  frames: int = 1 if code == 0 else 2 if code < 3 else (packet[1] & 0x3F if len(packet) > 1 else 0)
+  return _FRAME_SIZES[toc >> 3] * frames
+
+
+# Byte offsets and granule positions of every page in a file, used to seek by time.
+class _SeekIndex(NamedTuple):
+  pre_skip: int
+  # Index of the first page that contains audio packets.
+  first_audio_page: int
+  offsets: array.array
+  # Monotonic: pages on which no packet ends inherit the previous page's granule.
+  granules: array.array
+
+
+# Builds a seek index from the page headers of the given Ogg data. Raises ValueError if the data
+# isn't a single, 20ms-framed Opus stream.
+def _build_index(data: mmap.mmap) -> _SeekIndex:
+  offsets: array.array = array.array('Q')
+  granules: array.array = array.array('q')
+
+  serial: Optional[int] = None
+  granule: int = 0
+  offset: int = 0
+  while offset + _PAGE_HEADER.size <= len(data):
+    pattern, _, _, page_granule, page_serial, _, _, nsegs = _PAGE_HEADER.unpack_from(data, offset)
+    if pattern != _CAPTURE_PATTERN:
+      raise ValueError('Bad Ogg page.')
+    if serial is None:
+      serial = page_serial
+    elif page_serial != serial:
+      raise ValueError('Multiplexed Ogg streams are unsupported.')
+
+    body_len: int = sum(data[offset + _PAGE_HEADER.size:offset + _PAGE_HEADER.size + nsegs])
+    if page_granule != -1:
+      granule = page_granule
+
+    offsets.append(offset)
+    granules.append(granule)
+    offset += _PAGE_HEADER.size + nsegs + body_len
+
+  packets: Iterator[tuple[int, bytes]] = _read_packets(data, offsets, 0)
+
+  # Identification header.
+  _, head = next(packets, (0, b''))
+  if len(head) < 19 or not head.startswith(b'OpusHead'):
+    raise ValueError('Not an Opus stream.')
+  pre_skip: int = struct.unpack_from('<H', head, 10)[0]
+
+  # Comment header. Audio starts on the page after it ends.
+  tags_page, tags = next(packets, (0, b''))
+  if not tags.startswith(b'OpusTags'):
+    raise ValueError('Missing Opus comment header.')
+
+  for _, (_, packet) in zip(range(_FRAME_CHECK_PACKETS), packets):
+    if _packet_samples(packet) != _FRAME_SAMPLES:
+      raise ValueError('Unsupported Opus frame size.')
+
+  return _SeekIndex(pre_skip, tags_page + 1, offsets, granules)
+
+
+# Yields (page index, packet) for every packet that starts on or after the given page. A packet
+# continued from before that page is skipped.
+def _read_packets(data: mmap.mmap, offsets: array.array,
+                  first_page: int) -> Iterator[tuple[int, bytes]]:
+  partial: Optional[list[bytes]] = None
+  for page in range(first_page, len(offsets)):
+    offset: int = offsets[page]
+    header_type: int = data[offset + 5]
+    nsegs: int = data[offset + _PAGE_HEADER.size - 1]
+    lacing: bytes = data[offset + _PAGE_HEADER.size:offset + _PAGE_HEADER.size + nsegs]
+
+    # Skip the tail of a packet that started before we did.
+    skipping: bool = page == first_page and bool(header_type & _CONTINUED_FLAG)
+    if not header_type & _CONTINUED_FLAG:
+      partial = None
+
+    pos: int = offset + _PAGE_HEADER.size + nsegs
+    for seg_len in lacing:
+      if not skipping:
+        if partial is None:
+          partial = []
+        partial.append(data[pos:pos + seg_len])
+      pos += seg_len
+
+      if seg_len < 255:
+        if not skipping and partial is not None:
+          yield page, b''.join(partial)
+        partial = None
+        skipping = False
+
+
+# Seek indices of recently-opened files, keyed by path, size and mtime. None for unsupported files.
+_index_lock: threading.Lock = threading.Lock()
+_indices: collections.OrderedDict[tuple[str, int, int], Optional[_SeekIndex]] = (
+    collections.OrderedDict())
+
+# Returns the (possibly cached) seek index of the given file.
+def _get_index(path: str, stat: os.stat_result, data: mmap.mmap) -> _SeekIndex:
+  key: tuple[str, int, int] = (path, stat.st_size, stat.st_mtime_ns)
+  with _index_lock:
+    if key in _indices:
+      _indices.move_to_end(key)
+      cached: Optional[_SeekIndex] = _indices[key]
+      if cached is None:
+        raise ValueError('Unsupported stream.')
+      return cached
+
+  index: Optional[_SeekIndex] = None
+  try:
+    index = _build_index(data)
+    return index
+  finally:
+    # Remember unsupported files too, so that they're only parsed once.
+    with _index_lock:
+      _indices[key] = index
+      while len(_indices) > _MAX_CACHED_INDICES:
+        _indices.popitem(last=False)
+
+
+# An audio source that reads Opus packets straight out of an Ogg Opus file, without spawning
+# ffmpeg. Seeking uses a per-file index of page granule positions, and elapsed time is counted from
+# the durations of the packets actually read.
+#
+# Raises ValueError on construction if the file isn't a supported Ogg Opus stream, in which case
+# the caller should fall back to ResumedAudio.
+class OggOpusAudio(discord.AudioSource):
+
+  def __init__(self, filename: str, elapsed: datetime.timedelta, name: Optional[str] = None):
+    # For error reporting.
+    self._filename: str = name or utils.file_stem(filename)
+
+    self._error: bool = False
+
+    with open(filename, 'rb') as f:
+      stat: os.stat_result = os.fstat(f.fileno())
+      if not stat.st_size:
+        raise ValueError('Empty file.')
+      self._data: mmap.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+      self._index: _SeekIndex = _get_index(os.path.abspath(filename), stat, self._data)
+    except ValueError:
+      self._data.close()
+      raise
+
+    # Position of the next packet, in samples from the start of the track.
+    self._position: int = 0
+    self._packets: Iterator[tuple[int, bytes]] = iter(())
+    self.Seek(elapsed)
+
+  # Moves playback to the given offset into the track.
+  def Seek(self, elapsed: datetime.timedelta) -> None:
+    target: int = self._index.pre_skip + int(elapsed.total_seconds() * _SAMPLE_RATE)
+
+    # Every packet ending by the last page at or before the target can be skipped wholesale.
+    first: int = self._index.first_audio_page
+    page: int = max(first, bisect.bisect_right(self._index.granules, target, lo=first))
+
+    # Back up to the start of any packet continued onto this page, so that it's counted.
+    while page > first and page < len(self._index.offsets) and self._IsContinued(page):
+      page -= 1
+
+    granule: int = self._index.granules[page - 1] if page > first else self._index.pre_skip
+
+    self._packets = _read_packets(self._data, self._index.offsets, page)
+    self._position = max(0, granule - self._index.pre_skip)
+
+    # Packet-accurate seek within the page.
+    while self._position + _FRAME_SAMPLES <= target - self._index.pre_skip:
+      if not self._NextPacket():
+        break
+
+  def read(self) -> bytes:
+    return self._NextPacket()
+
+  def is_opus(self) -> bool:
+    return True
+
+  def cleanup(self) -> None:
+    self._packets = iter(())
+    # Also called on garbage collection, including of a stream whose file couldn't be opened.
+    data: Optional[mmap.mmap] = getattr(self, '_data', None)
+    if data is not None and not data.closed:
+      data.close()
+
+  # Returns True if the file couldn't be read to the end.
+  def HasError(self) -> bool:
+    return self._error
+
+  # The kind and message of the error, if there is one.
+  @property
+  def error(self) -> Optional[tuple[str, str]]:
+    return ('corrupt', 'Couldn\'t read the Ogg Opus data.') if self._error else None
+
+  @property
+  def elapsed(self) -> datetime.timedelta:
+    return datetime.timedelta(seconds=self._position / _SAMPLE_RATE)
+
+  @property
+  def duration(self) -> Optional[datetime.timedelta]:
+    return datetime.timedelta(
+        seconds=max(0, self._index.granules[-1] - self._index.pre_skip) / _SAMPLE_RATE)
+
+  def _IsContinued(self, page: int) -> bool:
+    return bool(self._data[self._index.offsets[page] + 5] & _CONTINUED_FLAG)
+
+  def _NextPacket(self) -> bytes:
+    try:
+      _, packet = next(self._packets, (0, b''))
+    except (ValueError, IndexError):
+      # E.g. a truncated file, or reading after cleanup.
+      if not self._data.closed:
+        utils.log(utils.LogSeverity.ERROR, f'Error reading "{self._filename}".')
+        self._error = True
+      return b''
+
+    self._position += _packet_samples(packet)
+    return packet
@@ -1,163 +1,1004 @@
 #!/usr/bin/python3
 
+import array
+import collections
 import datetime
+import functools
+import os
 import random
-import tempfile
+import re
+import subprocess
+import threading
+import time
+import weakref
 
-from typing import BinaryIO, Optional
+from typing import Any, Callable, IO, Hashable, Iterator, NamedTuple, Optional, Union
 
 import discord
 
+import cache
+import catalog
+import encoders
+import metrics
+import ogg
+import prefetch
 import utils
 
+# Realtime normalisation applied to tracks whose loudness hasn't been measured yet.
+_NORMALISE_FILTER: str = 'dynaudnorm=p=0.9:s=5'
+
+# Loudness, in LUFS, to which tracks with measured loudness are adjusted.
+_TARGET_LOUDNESS: float = -16.0
+
+# Static gain adjustments are limited so that peaks stay below this level, in dBTP...
+_MAX_PEAK: float = -1.0
+
+# ...and so that near-silent tracks aren't boosted into noise.
+_MAX_GAIN: float = 12.0
+
+# Native Ogg Opus files are streamed as-is, so only if they need no more than this much gain, in dB,
+# to be normalised. Others are encoded (or cached) like any other track.
+_NATIVE_MAX_GAIN: float = 1.0
+
+# Extensions of files that might be playable without ffmpeg.
+_OGG_EXTS: tuple[str, ...] = ('.opus', '.ogg', '.oga')
+
+# How long before the end of a track to start preparing the next one.
+_PREWARM_TIME: datetime.timedelta = datetime.timedelta(seconds=5)
+
+# Number of packets of the next track to buffer ahead of time, so that its ffmpeg process has
+# started producing audio before the current track ends.
+_PREWARM_PACKETS: int = 25
+
+# Number of entries on each page of a listing, so that a page fits in one Discord message.
+_LISTING_PAGE_SIZE: int = 15
+
+# Number of rendered pages of its track listing that each playlist keeps.
+_CACHED_PAGES: int = 4
+
+# discord's player expects a packet every 20ms; a read that takes longer delays playback.
+_PACKET_DEADLINE_S: float = 0.02
+
+# Most time spent per packet played throwing away packets to skip ahead in place, so that a skip is
+# spread over as many packets as it takes rather than holding up any one of them.
+_DISCARD_BUDGET_S: float = 0.005
+
+_READ_SECONDS: metrics.Histogram = metrics.Histogram(
+    'shilo_ffmpeg_read_seconds', 'Time to read one packet from an ffmpeg stream.')
+_UNDERRUNS: metrics.Counter = metrics.Counter(
+    'shilo_underruns_total', 'Packets that took longer to read than the time they play for.')
+_SPAWN_SECONDS: metrics.Histogram = metrics.Histogram(
+    'shilo_ffmpeg_spawn_seconds', 'Time to start an ffmpeg process.')
+_STREAMS_MADE: metrics.Counter = metrics.Counter(
+    'shilo_make_stream_total', 'Streams made for playback (e.g. on start, resume or fast-forward).')
+_STREAM_ERRORS: metrics.Counter = metrics.Counter(
+    'shilo_stream_errors_total', 'Streams that failed, by kind of error.', label='kind')
+_BUFFER_UNDERRUNS: metrics.Counter = metrics.Counter(
+    'shilo_buffer_underruns_total',
+    'Times playback was held up waiting for a stream\'s read-ahead buffer to refill.')
+
+# ffmpeg messages that mean a track can't be played, by kind of error.
+_FATAL_ERRORS: list[tuple[str, re.Pattern]] = [
+    ('corrupt', re.compile(rb'Invalid data found')),
+    ('unreadable', re.compile(rb'No such file or directory|Permission denied|Input/output error')),
+]
+
+# ffmpeg messages about a frame that couldn't be decoded. A few are tolerable (they're skipped),
+# but a track with many is treated as corrupt.
+_DECODE_ERROR_RE: re.Pattern = re.compile(
+    rb'Error while decoding|[Hh]eader missing|[Ii]nvalid frame|invalid data|corrupt')
+_MAX_DECODE_ERRORS: int = 50
+
+# Bounds on the ffmpeg output examined: the longest line read at once, and how long to wait for
+# the last of it once a stream has ended.
+_MAX_STDERR_LINE: int = 1024
+_STDERR_DRAIN_S: float = 0.5
+
 # Returns a format string with lines of the form:
 #   [1-indexed row number] [entry] [marker]
 #
-# Where marker is a text "arrow" pointing to the specified index.
-def _format_listing(entries: list[str], index: int) -> str:
-  nums = [str(i + 1) + '.' for i in range(len(entries))]
-  markers = ['[<]' if i == index else '' for i in range(len(entries))]
+# Where marker is a text "arrow" pointing to the specified index. The entries may be a slice of a
+# longer list, starting at the given offset into it.
+def _format_listing(entries: list[str], index: int, offset: int = 0) -> str:
+  nums = [str(offset + i + 1) + '.' for i in range(len(entries))]
+  markers = ['[<]' if offset + i == index else '' for i in range(len(entries))]
 
   return utils.format_table(zip(*[nums, entries, markers]))
 
 
+# One page of a listing.
+class ListingPage(NamedTuple):
+  text: str
+  # 0-indexed.
+  page: int
+  pages: int
+
+
+# Returns the number of pages needed to list the given number of entries, and the given page
+# clamped into range (or else the page holding the given index).
+def _resolve_page(entries: int, page: Optional[int], index: int) -> tuple[int, int]:
+  pages: int = max(1, -(-entries // _LISTING_PAGE_SIZE))
+  if page is None:
+    page = max(0, index) // _LISTING_PAGE_SIZE
+  return pages, max(0, min(page, pages - 1))
+
+
+# Returns the static gain, in dB, that brings the given track to the target loudness. Returns None
+# if the track's loudness hasn't been measured.
+def _track_gain(info: Optional[catalog.TrackInfo]) -> Optional[float]:
+  if not info or info.loudness is None:
+    return None
+
+  gain: float = min(_TARGET_LOUDNESS - info.loudness, _MAX_GAIN)
+  if info.peak is not None:
+    gain = min(gain, _MAX_PEAK - info.peak)
+  return round(gain, 1)
+
+# Returns the ffmpeg filter that normalises a track with the given static gain, falling back to
+# realtime normalisation if there isn't one.
+def _normalise_filter(gain: Optional[float]) -> str:
+  return _NORMALISE_FILTER if gain is None else f'volume={gain}dB'
+
+# Returns the ffmpeg output options used to encode a track into the track cache. These match the
+# encoding of ResumedAudio so that cached and uncached playback sound the same.
+def _cache_options(gain: Optional[float]) -> list[str]:
+  return ['-filter:a', _normalise_filter(gain), '-c:a', 'libopus', '-ar', '48000', '-ac', '2',
+          '-b:a', f'{ResumedAudio._TARGET_BITRATE}k']
+
+
 # Wrapper around FFmpegOpusAudio that counts the number of milliseconds streamed so far.
 class ResumedAudio(discord.FFmpegOpusAudio):
   _TARGET_BITRATE: int = 96
   _READ_AUDIO_CHUNK_TIME: datetime.timedelta = datetime.timedelta(
       milliseconds=20)
 
-  def __init__(self, filename: str, elapsed: datetime.timedelta):
+  # Only warnings and errors are written to stderr, so that there's little to examine.
+  _LOG_OPTIONS: str = '-hide_banner -nostats -loglevel warning'
+
+  # If transcode is false, the file must already be normalised Ogg Opus (e.g. from the track cache)
+  # and is streamed without re-encoding. Otherwise, the track is normalised with the given static
+  # gain (in dB) if there is one, or else with a (costlier) realtime filter.
+  #
+  # If given, the encoder slot is attached to the ffmpeg process and released along with it.
+  def __init__(self, filename: str, elapsed: datetime.timedelta, transcode: bool = True,
+               name: Optional[str] = None, duration: Optional[datetime.timedelta] = None,
+               gain: Optional[float] = None, slot: Optional[encoders.Slot] = None):
     # For error reporting.
-    self._filename: str = utils.file_stem(filename)
+    self._filename: str = name or utils.file_stem(filename)
 
-    self._stderr: BinaryIO = tempfile.TemporaryFile('a+b')
+    # Length of the whole track, if known.
+    self._duration: Optional[datetime.timedelta] = duration
 
-    # Final error status. Used once _stderr has been cleaned up.
-    self._final_error: Optional[bool] = None
+    # The kind and message of the first error that ffmpeg reported, if any. Set by the thread that
+    # reads ffmpeg's stderr as it's written.
+    self._error: Optional[tuple[str, str]] = None
+    self._decode_errors: int = 0
+    self._monitor: Optional[threading.Thread] = None
+
+    self._slot: Optional[encoders.Slot] = slot
 
     # TODO: foward args if more sophisticated construction is needed.
-    super().__init__(filename, bitrate=self._TARGET_BITRATE, stderr=self._stderr,
-                     options=f'-filter:a "dynaudnorm=p=0.9:s=5" -bufsize {2*self._TARGET_BITRATE}k',
-                     before_options=f'-ss {str(elapsed)}')
+    try:
+      if transcode:
+        super().__init__(
+            filename, bitrate=self._TARGET_BITRATE, stderr=subprocess.PIPE,
+            options=f'-filter:a "{_normalise_filter(gain)}" -bufsize {2*self._TARGET_BITRATE}k',
+            before_options=f'{self._LOG_OPTIONS} -ss {str(elapsed)}')
+      else:
+        super().__init__(filename, codec='copy', stderr=subprocess.PIPE,
+                         before_options=f'{self._LOG_OPTIONS} -ss {str(elapsed)}')
+    except BaseException:
+      if slot:
+        slot.Release()
+      raise
+
+    # Make sure the encoder is accounted for even if this stream is dropped without cleanup.
+    if slot:
+      weakref.finalize(self, slot.Release)
 
     self._elapsed: datetime.timedelta = elapsed
 
   def read(self) -> bytes:
     self._elapsed += self._READ_AUDIO_CHUNK_TIME
-    return super().read()
+    before: float = time.perf_counter()
+    data: bytes = super().read()
+    _READ_SECONDS.Observe(time.perf_counter() - before)
+
+    # ffmpeg is exiting, so let any final errors be seen before the end is acted on.
+    if not data and self._monitor:
+      self._monitor.join(_STDERR_DRAIN_S)
+
+    return data
 
   def cleanup(self) -> None:
-    # Clean up process first to make sure stderr is populated.
     super().cleanup()
 
-    # Save error state so that we can still query error even though our resources have been cleaned
-    # up.
-    self._final_error = self.HasError()
-    self._stderr.close()
+    if self._slot:
+      self._slot.Release()
 
-  # Returns True if ffmpeg stderr contains a known playback error.
+  def _spawn_process(self, args: Any, **subprocess_kwargs: Any) -> subprocess.Popen:
+    before: float = time.perf_counter()
+    process: subprocess.Popen = super()._spawn_process(args, **subprocess_kwargs)
+    _SPAWN_SECONDS.Observe(time.perf_counter() - before)
+    if self._slot:
+      self._slot.Attach(process)
+
+    if process.stderr:
+      self._monitor = threading.Thread(target=self._MonitorStderr, args=(process.stderr,),
+                                       name='ffmpeg-stderr', daemon=True)
+      self._monitor.start()
+    return process
+
+  # Returns True if ffmpeg has reported an error that stops the track from playing properly.
   def HasError(self) -> bool:
-    if self._final_error is not None:
-      return self._final_error
+    return self._error is not None
 
+  # The kind and message of the error, if there is one.
+  @property
+  def error(self) -> Optional[tuple[str, str]]:
+    return self._error
+
+  # Reads ffmpeg's stderr a line at a time as it's written, until ffmpeg exits, classifying errors
+  # as they're reported. Runs on its own thread.
+  def _MonitorStderr(self, stderr: IO[bytes]) -> None:
     try:
-      self._stderr.seek(0)
-      err_string: str = self._stderr.read().decode('utf8')
+      for line in iter(lambda: stderr.readline(_MAX_STDERR_LINE), b''):
+        if self._error:
+          continue
+
+        kind: Optional[str] = next((k for k, regex in _FATAL_ERRORS if regex.search(line)), None)
+        if not kind and _DECODE_ERROR_RE.search(line):
+          self._decode_errors += 1
+          if self._decode_errors >= _MAX_DECODE_ERRORS:
+            kind = 'corrupt'
+
+        if kind:
+          message: str = line.decode('utf8', errors='replace').strip()
+          self._error = (kind, message)
+          _STREAM_ERRORS.Inc(label=kind)
+          utils.log(utils.LogSeverity.ERROR, f'Error reading "{self._filename}": {message}',
+                    track=self._filename, error=kind)
+    except (OSError, ValueError):
+      # The pipe was closed by cleanup.
+      pass
 
-      if 'Invalid data' in err_string:
-        utils.log(utils.LogSeverity.ERROR, f'Error reading "{self._filename}".')
-        return True
+  @property
+  def elapsed(self) -> datetime.timedelta:
+    return self._elapsed
 
-      return False
-    except BaseException:
-      return True
+  @property
+  def duration(self) -> Optional[datetime.timedelta]:
+    return self._duration
+
+
+# Wrapper around another stream that reads its packets ahead of playback on a background thread,
+# into a bounded buffer, so that a brief stall reading the track (e.g. from a network mount) is
+# absorbed rather than heard.
+#
+# The elapsed time counts the packets actually played, not those read ahead.
+class BufferedAudio(discord.AudioSource):
+
+  def __init__(self, stream: Union[ResumedAudio, ogg.OggOpusAudio], packets: int, name: str):
+    # For reporting.
+    self._name: str = name
+
+    self._stream: Union[ResumedAudio, ogg.OggOpusAudio] = stream
+    self._elapsed: datetime.timedelta = stream.elapsed
+
+    # Packets read ahead, up to the given number. Guarded by the condition, which is notified
+    # whenever a packet is added or taken, or the stream ends.
+    self._packets: collections.deque[bytes] = collections.deque()
+    self._max_packets: int = max(1, packets)
+    self._ready: threading.Condition = threading.Condition()
+
+    # Set once the wrapped stream has ended (or failed), or this stream has been cleaned up.
+    self._ended: bool = False
+    self._closed: bool = False
+    self._exception: Optional[BaseException] = None
+
+    # Times playback had to wait longer than a packet's deadline for the buffer to refill. Waits
+    # while the stream is starting up, before the buffer has first filled, don't count.
+    self._underruns: int = 0
+    self._filled: bool = False
+
+    threading.Thread(target=self._Pump, name='audio-pump', daemon=True).start()
+
+  def read(self) -> bytes:
+    with self._ready:
+      if not self._packets and not self._ended:
+        before: float = time.perf_counter()
+        self._ready.wait_for(lambda: self._packets or self._ended)
+        if self._packets and self._filled and time.perf_counter() - before > _PACKET_DEADLINE_S:
+          self._underruns += 1
+          _BUFFER_UNDERRUNS.Inc()
+
+      if not self._packets:
+        if self._exception:
+          raise self._exception
+        return b''
+
+      data: bytes = self._packets.popleft()
+      self._ready.notify_all()
+
+    self._elapsed += ResumedAudio._READ_AUDIO_CHUNK_TIME
+    return data
+
+  def is_opus(self) -> bool:
+    return True
+
+  def cleanup(self) -> None:
+    with self._ready:
+      if self._closed:
+        return
+      self._closed = True
+      self._ended = True
+      self._packets.clear()
+      self._ready.notify_all()
+
+    self._stream.cleanup()
+
+    if self._underruns:
+      utils.log(utils.LogSeverity.WARNING,
+                f'Playback of "{self._name}" caught up with its buffer {self._underruns} times.',
+                track=self._name, underruns=self._underruns)
+
+  def HasError(self) -> bool:
+    return self._stream.HasError()
+
+  # Reads packets from the wrapped stream whenever there's room for them, until it ends. Runs on its
+  # own thread.
+  def _Pump(self) -> None:
+    while True:
+      with self._ready:
+        self._ready.wait_for(lambda: len(self._packets) < self._max_packets or self._closed)
+        if self._closed:
+          return
+
+      try:
+        data: bytes = self._stream.read()
+      except Exception as e:
+        # Raised to the player instead, as if it had read the stream itself.
+        with self._ready:
+          self._exception = e
+          self._ended = True
+          self._ready.notify_all()
+        return
+
+      with self._ready:
+        if self._closed:
+          return
+        if not data:
+          self._ended = True
+        else:
+          self._packets.append(data)
+          self._filled = self._filled or len(self._packets) >= self._max_packets
+        self._ready.notify_all()
+
+      if not data:
+        return
+
+  @property
+  def error(self) -> Optional[tuple[str, str]]:
+    return self._stream.error
 
   @property
   def elapsed(self) -> datetime.timedelta:
     return self._elapsed
 
+  @property
+  def duration(self) -> Optional[datetime.timedelta]:
+    return self._stream.duration
+
+  @property
+  def underruns(self) -> int:
+    return self._underruns
+
+  # Number of packets read ahead and not yet played.
+  @property
+  def buffered(self) -> int:
+    with self._ready:
+      return len(self._packets)
+
+  @property
+  def wrapped(self) -> Union[ResumedAudio, ogg.OggOpusAudio]:
+    return self._stream
 
-# Maintains a cursor in a list of music files and exposes an audio stream for the current file.
-class Playlist:
 
-  def __init__(self, name: str, fs: list[str]):
-    # Make copy.
+# Any of the audio sources a playlist can produce.
+Stream = Union[ResumedAudio, ogg.OggOpusAudio, BufferedAudio]
+
+
+# The arguments of a ResumedAudio, bar its encoder slot.
+class _Encoding(NamedTuple):
+  filename: str
+  elapsed: datetime.timedelta
+  transcode: bool
+  name: Optional[str]
+  duration: Optional[datetime.timedelta]
+  gain: Optional[float]
+
+# Returns an in-process stream of the given Ogg Opus file, or None if the file isn't supported.
+def _open_ogg(path: str, elapsed: datetime.timedelta, name: str) -> Optional[ogg.OggOpusAudio]:
+  try:
+    return ogg.OggOpusAudio(path, elapsed, name)
+  except (OSError, ValueError):
+    return None
+
+
+# Plays a playlist's current stream and then, without stopping, any following streams that the
+# playlist has prepared in advance. This avoids the gap of starting a fresh stream after each track.
+#
+# Runs on discord's audio thread: the given callbacks are called from it, and must be thread-safe.
+#   - on_near_end is called once per track, shortly before it ends, if the track's length is known.
+#   - on_advance is called whenever playback moves to a prepared stream.
+#   - on_first_packet, if given, is called once the first packet has been read.
+class GaplessAudio(discord.AudioSource):
+
+  def __init__(self, playlist: 'Playlist', stream: Stream, on_near_end: Callable[[], None],
+               on_advance: Callable[[], None],
+               on_first_packet: Optional[Callable[[], None]] = None):
+    self._playlist: 'Playlist' = playlist
+    self._on_near_end: Callable[[], None] = on_near_end
+    self._on_advance: Callable[[], None] = on_advance
+    self._on_first_packet: Optional[Callable[[], None]] = on_first_packet
+
+    # Number of packets still to throw away before the next one is played, so as to skip ahead in
+    # the current track without opening a new stream. Requested from the event loop.
+    self._skip_lock: threading.Lock = threading.Lock()
+    self._skip: int = 0
+
+    self._SetStream(stream, [])
+
+  def read(self) -> bytes:
+    self._Discard()
+
+    while True:
+      if self._packets:
+        return self._packets.popleft()
+
+      before: float = time.perf_counter()
+      data: bytes = self._stream.read()
+      if time.perf_counter() - before > _PACKET_DEADLINE_S:
+        _UNDERRUNS.Inc()
+
+      if data:
+        if self._on_first_packet:
+          self._on_first_packet()
+          self._on_first_packet = None
+        if self._prewarm_at is not None and self._stream.elapsed >= self._prewarm_at:
+          self._prewarm_at = None
+          self._on_near_end()
+        return data
+
+      # Errors are reported by the after-play callback.
+      if self._stream.HasError():
+        return b''
+
+      taken: Optional[tuple[Stream, list[bytes]]] = self._playlist.TakeNext()
+      if not taken:
+        return b''
+
+      self._stream.cleanup()
+      self._SetStream(*taken)
+      self._on_advance()
+
+  def is_opus(self) -> bool:
+    return True
+
+  def cleanup(self) -> None:
+    self._stream.cleanup()
+
+  # Skips the given interval ahead in the current track. Packets are read and thrown away a few at a
+  # time before each one played, which for a short interval is much quicker than starting a new
+  # stream. Skipping past the end of the track moves on to the next one as usual. Thread-safe.
+  def Skip(self, interval: datetime.timedelta) -> None:
+    with self._skip_lock:
+      self._skip += interval // ResumedAudio._READ_AUDIO_CHUNK_TIME
+
+  # Abandons what's left of any skip. Thread-safe.
+  def CancelSkip(self) -> None:
+    with self._skip_lock:
+      self._skip = 0
+
+  # How far ahead the current track can be skipped in place without waiting on an encoder: any
+  # distance for a track read in-process, or else only as far as has already been read ahead.
+  @property
+  def skippable(self) -> datetime.timedelta:
+    stream: Stream = self._stream
+    packets: int = len(self._packets)
+    if isinstance(stream, BufferedAudio):
+      if isinstance(stream.wrapped, ogg.OggOpusAudio):
+        return datetime.timedelta.max
+      packets += stream.buffered
+    elif isinstance(stream, ogg.OggOpusAudio):
+      return datetime.timedelta.max
+    return packets * ResumedAudio._READ_AUDIO_CHUNK_TIME
+
+  # The part of the requested skips that hasn't been made yet.
+  @property
+  def skipping(self) -> datetime.timedelta:
+    with self._skip_lock:
+      return self._skip * ResumedAudio._READ_AUDIO_CHUNK_TIME
+
+  # Throws away packets of the current track, those already buffered first, until the requested skip
+  # has been made, the track ends or the time budget for this packet runs out.
+  def _Discard(self) -> None:
+    deadline: float = time.perf_counter() + _DISCARD_BUDGET_S
+    while time.perf_counter() < deadline:
+      with self._skip_lock:
+        if not self._skip:
+          return
+        self._skip -= 1
+
+      if self._packets:
+        self._packets.popleft()
+      elif not self._stream.read():
+        self.CancelSkip()
+        return
+
+  def _SetStream(self, stream: Stream, packets: list[bytes]) -> None:
+    self._stream: Stream = stream
+    self._packets: collections.deque[bytes] = collections.deque(packets)
+
+    duration: Optional[datetime.timedelta] = stream.duration
+    self._prewarm_at: Optional[datetime.timedelta] = (
+        None if duration is None else duration - _PREWARM_TIME)
+
+
+# A playlist's position, as saved between runs.
+class PlaylistState(NamedTuple):
+  seed: int
+  index: int
+  # Seconds into the current track.
+  elapsed: float
+  # Number of tracks and path of the current track, used to detect that the library has changed.
+  size: int
+  track: str
+
+
+# Maintains a cursor in a shuffled order of a catalog playlist's tracks and exposes an audio stream
+# for the current track. The shuffled order is a seeded permutation over the catalog's (shared)
+# array of track ids, evaluated on demand, so that the whole shuffle state is just (seed, index).
+# Tracks that the catalog has quarantined are skipped.
+#
+# The cursor may be advanced from discord's audio thread (see GaplessAudio), so it is guarded by a
+# lock. The lock is never held across an await.
+#
+# ffmpeg processes are started through the given encoder supervisor on behalf of the given owner
+# (e.g. a guild id). If given a read-ahead time, streams are buffered that far ahead of playback
+# (see BufferedAudio). If given a prefetcher, the files of the next few tracks in the shuffled order
+# are read into the page cache before they're played.
+class Playlist:
+  __slots__ = ('_name', '_tracks', '_library', '_encoders', '_owner', '_cache', '_read_ahead',
+               '_prefetcher', '_lock', '_next_src', '_next_index', '_generation', '_prewarming',
+               '_seed', '_order', '_index', '_cur_src', '_ff', '_pages')
+
+  def __init__(self, name: str, library: catalog.Catalog, supervisor: encoders.Supervisor,
+               track_cache: Optional[cache.TrackCache] = None, owner: Hashable = None,
+               read_ahead: datetime.timedelta = datetime.timedelta(),
+               prefetcher: Optional[prefetch.Prefetcher] = None):
     self._name: str = name
-    self._fs: list[str] = list(fs)
+
+    # Shared with the catalog and other guilds.
+    self._tracks: array.array = library.GetTrackIds(name)
+    self._library: catalog.Catalog = library
+
+    self._encoders: encoders.Supervisor = supervisor
+    self._owner: Hashable = owner
+
+    # Used to play pre-encoded tracks, if given.
+    self._cache: Optional[cache.TrackCache] = track_cache
+
+    # Number of packets to buffer ahead of playback, if any.
+    self._read_ahead: int = read_ahead // ResumedAudio._READ_AUDIO_CHUNK_TIME
+    self._prefetcher: Optional[prefetch.Prefetcher] = prefetcher
+
+    self._lock: threading.Lock = threading.Lock()
+
+    # A stream of the next track, prepared ahead of time along with its first few packets, and the
+    # position of that track.
+    self._next_src: Optional[tuple[Stream, list[bytes]]] = None
+    self._next_index: int = 0
+
+    # Incremented whenever the cursor moves, so that stale preparation can be detected.
+    self._generation: int = 0
+
+    # True while the next track is being prepared.
+    self._prewarming: bool = False
+
+    # Recently-rendered pages of the track listing, keyed by (seed, index, page). Only pages for the
+    # current seed and index are kept.
+    self._pages: collections.OrderedDict[tuple[int, int, int], str] = collections.OrderedDict()
 
     # Start shuffled.
     self.Restart()
 
   # Clear current song and reshuffle playlist.
   def Restart(self) -> None:
-    utils.log(utils.LogSeverity.INFO, f'Restarting playlist "{self._name}".')
+    utils.log(utils.LogSeverity.INFO, f'Restarting playlist "{self._name}".', playlist=self._name)
+
+    self.DiscardNext()
+    with self._lock:
+      self._generation += 1
+      self._index: int = 0
+      self._cur_src: Optional[Stream] = None
+      self._ff: datetime.timedelta = datetime.timedelta()
+      self._seed: int = random.getrandbits(64)
+      self._order: utils.Permutation = utils.Permutation(len(self._tracks), self._seed)
+
+  # Moves to the given saved position, if it's still valid for this playlist's tracks. Returns
+  # whether it was. The track is resumed at its saved offset only if it's unchanged.
+  def Restore(self, saved: PlaylistState) -> bool:
+    if saved.size != len(self._tracks) or not 0 <= saved.index < len(self._tracks):
+      return False
 
-    self._index: int = 0
-    self._cur_src: Optional[ResumedAudio] = None
-    self._ff: datetime.timedelta = datetime.timedelta()
-    random.shuffle(self._fs)
+    self.DiscardNext()
+    with self._lock:
+      self._generation += 1
+      self._seed = saved.seed
+      self._order = utils.Permutation(len(self._tracks), saved.seed)
+      self._index = saved.index
+      self._cur_src = None
+      unchanged: bool = self._library.GetPath(self._TrackAt(saved.index)) == saved.track
+      self._ff = datetime.timedelta(seconds=saved.elapsed if unchanged else 0)
+
+    return True
+
+  # Returns the current position, to be saved.
+  def GetState(self) -> PlaylistState:
+    with self._lock:
+      elapsed: datetime.timedelta = self._GetPosition()
+      track: str = (self._library.GetPath(self._TrackAt(self._index))
+                    if self._index < len(self._order) else '')
+      return PlaylistState(self._seed, self._index, elapsed.total_seconds(), len(self._tracks),
+                           track)
 
   # Returns a new stream that plays the track from the position last left off by any previous
   # stream, plus any subsequent fast-forwarding.
   #
   # Caller is responsible for cleaning up resources for the returned stream.
-  async def MakeStream(self) -> Optional[ResumedAudio]:
-    if self._index >= len(self._fs):
-      return None
-
-    if self._cur_src:
-      utils.log(utils.LogSeverity.INFO,
-                f'Resuming "{self.current_track_name}".')
-      self._cur_src = ResumedAudio(
-          self._fs[self._index], self._cur_src.elapsed + self._ff)
-    else:
-      utils.log(utils.LogSeverity.INFO,
-                f'Starting "{self.current_track_name}".')
-      self._cur_src = ResumedAudio(self._fs[self._index], self._ff)
+  async def MakeStream(self) -> Optional[Stream]:
+    _STREAMS_MADE.Inc()
+    wrapped: bool = False
+    while True:
+      with self._lock:
+        # Tracks that couldn't be played are skipped.
+        playable: int = self._SkipQuarantined(self._index)
+        if playable != self._index:
+          self._generation += 1
+          self._index = playable
+          self._cur_src = None
+          self._ff = datetime.timedelta()
+        past_end: bool = self._index >= len(self._order)
+
+      # Every track left in the order couldn't be played, so start a new one (as Skip does), unless
+      # that's already been tried.
+      if past_end:
+        if wrapped:
+          return None
+        wrapped = True
+        self.Restart()
+        continue
+
+      with self._lock:
+        # Moved meanwhile.
+        if self._index >= len(self._order):
+          continue
+
+        generation: int = self._generation
+        track: int = self._TrackAt(self._index)
+        ff: datetime.timedelta = self._ff
+        start: datetime.timedelta = self._cur_src.elapsed if self._cur_src else datetime.timedelta()
+
+        utils.log(utils.LogSeverity.INFO,
+                  f'{"Resuming" if self._cur_src else "Starting"} "{self.current_track_name}".',
+                  playlist=self._name, track=self.current_track_name)
+
+      # May wait for an encoder slot.
+      stream: Stream = await self._OpenTrack(track, start + ff)
+
+      with self._lock:
+        current: bool = self._generation == generation
+        if current:
+          self._cur_src = stream
+
+          # When resuming the audio, the current fast-forward amount is already inherited from the
+          # previous stream.
+          self._ff -= ff
+
+      if current:
+        self._PrefetchUpcoming()
+        return stream
+
+      # The cursor moved while we were waiting; try again with the new current track.
+      stream.cleanup()
+
+  # Prepares a stream of the next track, if there is one, so that it can be swapped in without a
+  # gap when the current track ends.
+  async def PrewarmNext(self) -> None:
+    with self._lock:
+      position: int = self._SkipQuarantined(self._index + 1)
+      if self._next_src or self._prewarming or position >= len(self._order):
+        return
+      self._prewarming = True
+      generation: int = self._generation
+      track: int = self._TrackAt(position)
 
-    # When resuming the audio, the current fast-forward amount is already inherited from the
-    # previous stream.
-    self._ff = datetime.timedelta()
-
-    return self._cur_src
+    try:
+      utils.log(utils.LogSeverity.INFO, f'Preparing "{self._library.GetName(track)}".',
+                playlist=self._name, track=self._library.GetName(track))
+      stream: Stream = await self._OpenTrack(track, datetime.timedelta())
+
+      # In-process streams are instantly ready, but ffmpeg needs to be given a head start. Buffered
+      # streams give themselves one.
+      packets: list[bytes] = []
+      if isinstance(stream, ResumedAudio):
+        packets = await utils.run_blocking(
+            lambda: [p for p in (stream.read() for _ in range(_PREWARM_PACKETS)) if p])
+    finally:
+      with self._lock:
+        self._prewarming = False
+
+    with self._lock:
+      if self._generation == generation and not self._next_src:
+        self._next_src = (stream, packets)
+        self._next_index = position
+        return
+
+    # The cursor moved while we were preparing.
+    stream.cleanup()
+
+  # Advances the cursor to the prepared next track and returns its stream and buffered packets, or
+  # returns None if no track has been prepared. Called from the audio thread.
+  def TakeNext(self) -> Optional[tuple[Stream, list[bytes]]]:
+    with self._lock:
+      taken: Optional[tuple[Stream, list[bytes]]] = self._next_src
+      if not taken:
+        return None
+
+      self._next_src = None
+      self._generation += 1
+      self._index = self._next_index
+      self._cur_src = taken[0]
+      self._ff = datetime.timedelta()
+
+    self._PrefetchUpcoming()
+    return taken
+
+  # Throws away any prepared next track.
+  def DiscardNext(self) -> None:
+    with self._lock:
+      discarded: Optional[tuple[Stream, list[bytes]]] = self._next_src
+      self._next_src = None
+      self._generation += 1
+
+    if discarded:
+      discarded[0].cleanup()
 
   # Skips forward into the track for subsequent calls to MakeStream. Existing stream objects are
   # unaffected.
   def FastForward(self, duration: datetime.timedelta) -> None:
-    if self._index >= len(self._fs):
-      return
+    with self._lock:
+      if self._index >= len(self._order):
+        return
+
+      self._ff += duration
 
-    self._ff += duration
+  # Moves to the given position in the current track for subsequent calls to MakeStream. Existing
+  # stream objects are unaffected.
+  def Seek(self, position: datetime.timedelta) -> None:
+    with self._lock:
+      if self._index >= len(self._order):
+        return
+
+      self._ff = max(position, datetime.timedelta()) - (
+          self._cur_src.elapsed if self._cur_src else datetime.timedelta())
+
+  # Returns the position in the current track from which MakeStream would play.
+  def GetPosition(self) -> datetime.timedelta:
+    with self._lock:
+      return self._GetPosition()
 
   def StreamHasError(self) -> bool:
-    return self._index >= len(self._fs) or self._cur_src is not None and self._cur_src.HasError()
+    with self._lock:
+      return (self._index >= len(self._order)
+              or self._cur_src is not None and self._cur_src.HasError())
 
   # Move to the next song, reshuffling and starting again if there isn't one.
   def Skip(self) -> None:
-    self._index += 1
+    self.DiscardNext()
 
-    if self._index >= len(self._fs):
+    with self._lock:
+      self._index = self._SkipQuarantined(self._index + 1)
+      wrapped: bool = self._index >= len(self._order)
+      if not wrapped:
+        self._cur_src = None
+        self._ff = datetime.timedelta()
+
+    if wrapped:
       self.Restart()
+
+  # If the current stream failed, records its track as unplayable so that it's skipped from now on.
+  # Returns whether it did.
+  async def QuarantineCurrent(self) -> bool:
+    with self._lock:
+      if self._index >= len(self._order) or not self._cur_src or not self._cur_src.error:
+        return False
+      track: int = self._TrackAt(self._index)
+      kind, message = self._cur_src.error
+
+    # Recording it may write to the library index.
+    await utils.run_blocking(self._library.Quarantine, track, f'{kind}: {message}')
+    return True
+
+  # Moves the cursor to the start of the given track, keeping the shuffled order. Returns false if
+  # the track isn't in this playlist.
+  def JumpTo(self, track: int) -> bool:
+    try:
+      position: int = self._order.Index(self._tracks.index(track))
+    except ValueError:
+      return False
+
+    self.DiscardNext()
+    with self._lock:
+      self._generation += 1
+      self._index = position
+      self._cur_src = None
+      self._ff = datetime.timedelta()
+
+    return True
+
+  # Returns a stream of the given track. Ogg Opus files (including cached tracks) are read
+  # in-process where possible; otherwise, the track is played from the cache if it's there or else
+  # scheduled to be cached for next time.
+  #
+  # Looking up and opening the track touch the disk, and starting ffmpeg can take a while, so both
+  # are done off the event loop.
+  #
+  # Native Opus files are streamed without re-encoding, and so without normalisation, only if
+  # they're already close to the target loudness.
+  async def _OpenTrack(self, track: int, elapsed: datetime.timedelta) -> Stream:
+    stream: Union[ResumedAudio, ogg.OggOpusAudio]
+    located: Union[ogg.OggOpusAudio, _Encoding] = await utils.run_blocking(
+        self._LocateTrack, track, elapsed)
+    if not isinstance(located, _Encoding):
+      stream = located
+    else:
+      slot: encoders.Slot = await self._encoders.Acquire(self._owner)
+      stream = await utils.run_blocking(functools.partial(ResumedAudio, *located, slot=slot))
+
+    if self._read_ahead:
+      return BufferedAudio(stream, self._read_ahead, self._library.GetName(track))
+    return stream
+
+  # Returns an in-process stream of the given track if possible, or else how to encode it. Blocks.
+  def _LocateTrack(self, track: int,
+                   elapsed: datetime.timedelta) -> Union[ogg.OggOpusAudio, '_Encoding']:
+    path: str = self._library.GetPath(track)
+    name: str = self._library.GetName(track)
+
+    info: Optional[catalog.TrackInfo] = self._library.GetTrackInfo(path)
+    duration: Optional[datetime.timedelta] = (
+        datetime.timedelta(seconds=info.duration) if info and info.duration is not None else None)
+    gain: Optional[float] = _track_gain(info)
+
+    if self._cache:
+      options: list[str] = _cache_options(gain)
+      cached_path: Optional[str] = self._cache.Lookup(path, options)
+      if cached_path:
+        cached: Optional[ogg.OggOpusAudio] = _open_ogg(cached_path, elapsed, name)
+        if cached:
+          return cached
+
+        # Evicted since it was looked up, or unreadable. Play the source instead, rather than have
+        # the cached file's failure blamed on the track.
+        utils.log(utils.LogSeverity.WARNING, f'Couldn\'t open cached "{name}"; encoding it again.',
+                  track=name)
+        self._cache.Discard(path, options)
+
+    # A track whose loudness hasn't been measured yet is played as-is, rather than with the costly
+    # realtime filter.
+    if (os.path.splitext(path)[1].lower() in _OGG_EXTS
+        and (gain is None or abs(gain) <= _NATIVE_MAX_GAIN)):
+      native: Optional[ogg.OggOpusAudio] = _open_ogg(path, elapsed, name)
+      if native:
+        return native
+
+    if self._cache:
+      self._cache.Request(path, options)
+
+    return _Encoding(path, elapsed, True, name, duration, gain)
+
+  # Asks the prefetcher, if there is one, to read the files of the tracks following the current one,
+  # until the cursor next moves.
+  def _PrefetchUpcoming(self) -> None:
+    if not self._prefetcher:
       return
 
-    self._cur_src = None
-    self._ff = datetime.timedelta()
+    with self._lock:
+      generation: int = self._generation
+      start: int = self._index + 1
+      upcoming: list[int] = [self._TrackAt(i) for i in range(
+          start, min(len(self._order), start + self._prefetcher.tracks))]
+
+    self._prefetcher.Request(self._owner, self._TrackFiles(upcoming),
+                             lambda: self._generation == generation)
+
+  # Yields the file each of the given tracks would be played from (its cached encoding, if there is
+  # one), skipping quarantined tracks. Blocks.
+  def _TrackFiles(self, tracks: list[int]) -> Iterator[str]:
+    for track in tracks:
+      if self._library.IsQuarantined(track):
+        continue
+
+      path: str = self._library.GetPath(track)
+      if self._cache:
+        options: list[str] = _cache_options(_track_gain(self._library.GetTrackInfo(path)))
+        path = self._cache.Lookup(path, options, play=False) or path
+      yield path
+
+  # Returns the given (0-indexed) page of the track listing, or else the page holding the current
+  # track, with a cursor next to the current track. Only the tracks on the page are looked up.
+  def GetListingPage(self, page: Optional[int] = None) -> ListingPage:
+    with self._lock:
+      seed: int = self._seed
+      order: utils.Permutation = self._order
+      index: int = self._index
+
+    pages, page = _resolve_page(len(order), page, index)
+    key: tuple[int, int, int] = (seed, index, page)
+
+    # Pages for an old shuffle or position have a stale order or cursor.
+    if self._pages and next(iter(self._pages))[:2] != key[:2]:
+      self._pages.clear()
+
+    if key not in self._pages:
+      start: int = page * _LISTING_PAGE_SIZE
+      titles: list[str] = [self._library.GetName(self._tracks[order[i]])
+                           for i in range(start, min(len(order), start + _LISTING_PAGE_SIZE))]
+      self._pages[key] = f'{self._name}:\n\n' + _format_listing(titles, index, start)
+      while len(self._pages) > _CACHED_PAGES:
+        self._pages.popitem(last=False)
+    else:
+      self._pages.move_to_end(key)
+
+    return ListingPage(self._pages[key], page, pages)
+
+  # Must be called with the lock held.
+  def _GetPosition(self) -> datetime.timedelta:
+    return (self._cur_src.elapsed if self._cur_src else datetime.timedelta()) + self._ff
+
+  # Returns the id of the track at the given position in the shuffled order.
+  def _TrackAt(self, position: int) -> int:
+    return self._tracks[self._order[position]]
 
-  # Returns a full track listing with a cursor next to the currently-playing track.
-  def GetTrackListing(self) -> str:
-    titles: list[str] = [utils.file_stem(fn) for fn in self._fs]
-    return f'{self._name}:\n\n' + _format_listing(titles, self._index)
+  # Returns the first position from the given one whose track hasn't been quarantined, or the end of
+  # the order if there isn't one.
+  def _SkipQuarantined(self, position: int) -> int:
+    while position < len(self._order) and self._library.IsQuarantined(self._TrackAt(position)):
+      position += 1
+    return position
 
   @property
   def name(self) -> str:
     return self._name
 
   @property
-  def current_track_name(self) -> Optional[str]:
-    return None if not self._fs else utils.file_stem(self._fs[self._index])
-
+  def track_count(self) -> int:
+    return len(self._tracks)
 
-# Resturns a playlist listing. Puts a cursor next to one "index" playlist.
-def get_playlist_listing(playlists, index):
-  return 'Playlists:\n\n' + _format_listing(playlists, index)
+  @property
+  def current_track_name(self) -> Optional[str]:
+    return (self._library.GetName(self._TrackAt(self._index))
+            if self._tracks and self._index < len(self._order) else None)
+
+
+# Returns the given (0-indexed) page of the playlist listing, or else the page holding the "index"
+# playlist. Puts a cursor next to the "index" playlist.
+def get_playlist_listing(playlists: list[str], index: int,
+                         page: Optional[int] = None) -> ListingPage:
+  pages, page = _resolve_page(len(playlists), page, index)
+  start: int = page * _LISTING_PAGE_SIZE
+  return ListingPage(
+      'Playlists:\n\n' + _format_listing(playlists[start:start + _LISTING_PAGE_SIZE], index, start),
+      page, pages)
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+import collections
+import os
+import threading
+import time
+
+from typing import Callable, Hashable, Iterator, Optional
+
+import metrics
+import utils
+
+# Size of each read, and the most read of any one file.
+_CHUNK_BYTES: int = 1 << 20
+_MAX_FILE_BYTES: int = 64 << 20
+
+# Number of recently-prefetched files that aren't read again.
+_MAX_RECENT: int = 256
+
+_PREFETCHED_BYTES: metrics.Counter = metrics.Counter(
+    'shilo_prefetch_bytes_total', 'Bytes of upcoming tracks read ahead of time.')
+_PREFETCHED_FILES: metrics.Counter = metrics.Counter(
+    'shilo_prefetch_files_total', 'Upcoming tracks read ahead of time.')
+
+
+# Warms the OS page cache with the files of tracks that are about to be played, so that starting
+# them doesn't wait on slow storage (e.g. a network mount).
+#
+# Each owner (e.g. a guild) has at most one request at a time: a list of files, in the order they'll
+# be played. A new request replaces the owner's previous one, abandoning any file being read for it,
+# and a request is abandoned as soon as its requester says it's stale (e.g. the playlist was
+# reshuffled).
+# Requests are served a file at a time, round-robin across owners, by one background thread that
+# reads sequentially within a byte rate shared by every owner.
+#
+# Safe to use from multiple threads.
+class Prefetcher:
+
+  def __init__(self, tracks: int, bytes_per_s: int):
+    self._tracks: int = tracks
+    self._bytes_per_s: int = bytes_per_s
+
+    # Guards everything below, and is notified when a request is made or cancelled.
+    self._changed: threading.Condition = threading.Condition()
+
+    # Outstanding requests per owner, in round-robin order. The paths are resolved lazily, on the
+    # prefetch thread, since finding a track's file may itself touch the disk.
+    self._requests: collections.OrderedDict[Hashable, tuple[Iterator[str], Callable[[], bool]]] = (
+        collections.OrderedDict())
+
+    # A number unique to each owner's outstanding request, so that a read for a request that's since
+    # been replaced or cancelled can be abandoned.
+    self._generations: dict[Hashable, int] = {}
+    self._last_generation: int = 0
+
+    # Files read recently, in least- to most-recently read order.
+    self._recent: collections.OrderedDict[str, None] = collections.OrderedDict()
+
+    # Monotonic time before which the next chunk mustn't be read, to keep within the byte rate.
+    self._next_read_at: float = 0.0
+
+    self._thread: Optional[threading.Thread] = None
+
+  # Number of upcoming tracks each playlist should ask to prefetch.
+  @property
+  def tracks(self) -> int:
+    return self._tracks
+
+  # Replaces the given owner's request with the given files, read in order for as long as the given
+  # function returns true. The function is called from the prefetch thread.
+  def Request(self, owner: Hashable, paths: Iterator[str], current: Callable[[], bool]) -> None:
+    with self._changed:
+      self._last_generation += 1
+      self._generations[owner] = self._last_generation
+      self._requests[owner] = (paths, current)
+      self._requests.move_to_end(owner)
+      self._changed.notify()
+
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._Run, name='prefetch', daemon=True)
+        self._thread.start()
+
+  # Abandons the given owner's request, if it has one, and forgets the owner.
+  def Cancel(self, owner: Hashable) -> None:
+    with self._changed:
+      self._requests.pop(owner, None)
+      if self._generations.pop(owner, None) is not None:
+        self._changed.notify()
+
+  # Serves requests forever. Runs on its own thread.
+  def _Run(self) -> None:
+    while True:
+      with self._changed:
+        self._changed.wait_for(lambda: bool(self._requests))
+        owner, (paths, current) = next(iter(self._requests.items()))
+        generation: int = self._generations[owner]
+        self._requests.move_to_end(owner)
+
+      try:
+        path: Optional[str] = next(paths, None) if current() else None
+      except Exception as e:
+        utils.log(utils.LogSeverity.WARNING, f'Failed to find track to prefetch: {e}')
+        path = None
+
+      with self._changed:
+        if path is None:
+          # Done, unless the request was replaced meanwhile.
+          if self._generations.get(owner) == generation:
+            self._requests.pop(owner, None)
+            del self._generations[owner]
+          continue
+
+        if path in self._recent:
+          self._recent.move_to_end(path)
+          continue
+
+      self._Read(path, owner, generation, current)
+
+  # Reads the given file into the page cache, stopping early if the owner's request is replaced or
+  # goes stale.
+  def _Read(self, path: str, owner: Hashable, generation: int,
+            current: Callable[[], bool]) -> None:
+    read: int = 0
+    try:
+      with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+          os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        while read < _MAX_FILE_BYTES:
+          if not self._Throttle(owner, generation) or not current():
+            return
+
+          chunk: int = len(f.read(_CHUNK_BYTES))
+          if not chunk:
+            break
+          read += chunk
+          _PREFETCHED_BYTES.Inc(chunk)
+          with self._changed:
+            self._next_read_at = (max(self._next_read_at, time.monotonic())
+                                  + chunk / self._bytes_per_s)
+    except OSError as e:
+      # Playing the track will report the problem, if it persists.
+      utils.log(utils.LogSeverity.WARNING, f'Failed to prefetch "{path}": {e}')
+      return
+
+    _PREFETCHED_FILES.Inc()
+    with self._changed:
+      self._recent[path] = None
+      while len(self._recent) > _MAX_RECENT:
+        self._recent.popitem(last=False)
+
+  # Waits until the byte rate allows another read. Returns false if the owner's request has been
+  # replaced or cancelled meanwhile.
+  def _Throttle(self, owner: Hashable, generation: int) -> bool:
+    with self._changed:
+      while self._generations.get(owner) == generation:
+        wait: float = self._next_read_at - time.monotonic()
+        if wait <= 0:
+          return True
+        self._changed.wait(wait)
+      return False
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import array
+import bisect
+import time
+
+from typing import Optional
+
+import catalog
+import utils
+
+# Discord shows at most this many autocomplete suggestions.
+MAX_RESULTS: int = 25
+
+# Upper bound on the matches ranked for one query. Queries matching more tracks than this (e.g. a
+# single common word) are ranked among the first matches found.
+_MAX_CANDIDATES: int = 2000
+
+# Length of the substrings indexed.
+_GRAM: int = 3
+
+
+# Returns the form of the given text used for matching.
+def _fold(text: str) -> str:
+  return ' '.join(text.casefold().split())
+
+
+# Returns the distinct substrings of the given (folded) text that are indexed.
+def _grams(text: str) -> set[str]:
+  return {text[i:i + _GRAM] for i in range(len(text) - _GRAM + 1)}
+
+
+# In-memory index of track names and playlist names, used to answer searches (e.g. autocomplete
+# suggestions) without scanning the whole catalog.
+#
+# Track names are indexed by trigram: each trigram maps to the ascending ids of the tracks whose
+# names contain it. A query of three or more characters is answered by walking the shortest of its
+# trigrams' lists and checking the others by binary search. Shorter queries are answered by prefix,
+# from a list of ids sorted by name.
+#
+# Immutable once built, so safe to use from multiple threads.
+class TrackSearch:
+
+  def __init__(self, library: catalog.Catalog):
+    started: float = time.monotonic()
+
+    self._library: catalog.Catalog = library
+    self._playlist_names: list[str] = library.playlist_names
+    self._folded: tuple[str, ...] = tuple(
+        _fold(library.GetName(i)) for i in range(library.track_count))
+
+    self._postings: dict[str, array.array] = {}
+    for track, name in enumerate(self._folded):
+      for gram in _grams(name):
+        postings: Optional[array.array] = self._postings.get(gram)
+        if postings is None:
+          postings = self._postings[gram] = array.array('I')
+        postings.append(track)
+
+    self._by_name: array.array = array.array(
+        'I', sorted(range(len(self._folded)), key=self._folded.__getitem__))
+
+    # Per playlist, a flag for each track id saying whether the playlist holds that track.
+    self._members: dict[str, bytearray] = {}
+    for playlist_name in self._playlist_names:
+      members: bytearray = bytearray(len(self._folded))
+      for track in library.GetTrackIds(playlist_name):
+        members[track] = 1
+      self._members[playlist_name] = members
+
+    utils.log(utils.LogSeverity.INFO,
+              f'Indexed {len(self._folded)} track names in '
+              f'{(time.monotonic() - started) * 1000:.0f}ms.')
+
+  # Returns the ids of up to the given number of tracks whose names contain the given text, best
+  # matches first. Only tracks in the given playlist are returned, if one is given.
+  def Search(self, query: str, playlist_name: Optional[str] = None,
+             limit: int = MAX_RESULTS) -> list[int]:
+    folded: str = _fold(query)
+    members: Optional[bytearray] = self._members.get(playlist_name) if playlist_name else None
+    if playlist_name and members is None:
+      return []
+
+    if len(folded) < _GRAM:
+      return self._SearchPrefix(folded, members, limit)
+
+    postings: list[array.array] = []
+    for gram in _grams(folded):
+      gram_postings: Optional[array.array] = self._postings.get(gram)
+      if gram_postings is None:
+        return []
+      postings.append(gram_postings)
+    postings.sort(key=len)
+
+    matches: list[int] = []
+    for track in postings[0]:
+      if members is not None and not members[track]:
+        continue
+      if not all(_contains(p, track) for p in postings[1:]):
+        continue
+      # Trigrams can all be present without being adjacent.
+      if folded not in self._folded[track]:
+        continue
+
+      matches.append(track)
+      if len(matches) >= _MAX_CANDIDATES:
+        break
+
+    # Names starting with the query first, then shorter (i.e. closer) names.
+    matches.sort(key=lambda t: (not self._folded[t].startswith(folded), len(self._folded[t]),
+                                self._folded[t]))
+    return matches[:limit]
+
+  # Returns up to the given number of playlist names containing the given text, those starting with
+  # it first.
+  def SearchPlaylists(self, query: str, limit: int = MAX_RESULTS) -> list[str]:
+    folded: str = _fold(query)
+    matches: list[str] = [n for n in self._playlist_names if folded in _fold(n)]
+    matches.sort(key=lambda n: not _fold(n).startswith(folded))
+    return matches[:limit]
+
+  # Returns the names of the playlists holding the given track.
+  def GetPlaylists(self, track: int) -> list[str]:
+    return [n for n in self._playlist_names if self._members[n][track]]
+
+  # Returns true if the given playlist holds the given track.
+  def Contains(self, playlist_name: str, track: int) -> bool:
+    members: Optional[bytearray] = self._members.get(playlist_name)
+    return members is not None and 0 <= track < len(members) and bool(members[track])
+
+  # Returns tracks whose names start with the given text, in name order.
+  def _SearchPrefix(self, folded: str, members: Optional[bytearray], limit: int) -> list[int]:
+    matches: list[int] = []
+    start: int = bisect.bisect_left(self._by_name, folded, key=self._folded.__getitem__)
+    for i in range(start, len(self._by_name)):
+      track: int = self._by_name[i]
+      if not self._folded[track].startswith(folded):
+        break
+      if members is None or members[track]:
+        matches.append(track)
+        if len(matches) >= limit:
+          break
+    return matches
+
+
+# Returns true if the given ascending array holds the given value.
+def _contains(values: array.array, value: int) -> bool:
+  i: int = bisect.bisect_left(values, value)
+  return i < len(values) and values[i] == value
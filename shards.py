@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.process
+import signal
+import threading
+import time
+
+from typing import Any, Callable, Optional
+
+import utils
+
+# Discord lets a bot identify one shard at a time, every five seconds, so processes are started far
+# enough apart for all of their shards to connect.
+_IDENTIFY_INTERVAL_S: float = 5.0
+
+# Delay before restarting a process that exited, doubled for each further exit up to the maximum. A
+# process that ran for long enough before exiting is restarted after the initial delay again.
+_RESTART_DELAY_S: float = 5.0
+_MAX_RESTART_DELAY_S: float = 300.0
+_HEALTHY_RUN_S: float = 600.0
+
+# How often to check on the processes, and how long they're given to save their state and exit.
+_POLL_INTERVAL_S: float = 1.0
+_STOP_TIMEOUT_S: float = 30.0
+
+
+# Runs the bot's shards split across several processes, and restarts any process that exits. Each
+# process runs the given target with its own index and list of shard ids; shards are dealt out
+# round-robin.
+#
+# The processes are spawned afresh rather than forked, so the target must be importable (e.g. a
+# module-level function, or a partial application of one).
+class ShardSupervisor:
+
+  def __init__(self, target: Callable[[int, list[int]], None], processes: int, shard_count: int):
+    self._target: Callable[[int, list[int]], None] = target
+    self._context: Any = multiprocessing.get_context('spawn')
+    self._shard_ids: list[list[int]] = [list(range(i, shard_count, processes))
+                                        for i in range(processes)]
+
+    # Per process: the process if it's been started, when it was (monotonic), the delay before
+    # restarting it if it exits, and when to restart it if it has.
+    self._processes: list[Optional[multiprocessing.process.BaseProcess]] = [None] * processes
+    self._started: list[float] = [0.0] * processes
+    self._delays: list[float] = [_RESTART_DELAY_S] * processes
+    self._restart_at: list[Optional[float]] = [None] * processes
+
+    self._stopping: threading.Event = threading.Event()
+
+  # Starts every process and keeps them running until the supervisor is interrupted or terminated,
+  # then stops them.
+  def Run(self) -> None:
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+      signal.signal(sig, lambda *_: self._stopping.set())
+
+    utils.log(utils.LogSeverity.INFO,
+              f'Running {sum(len(s) for s in self._shard_ids)} shards in '
+              f'{len(self._processes)} processes.')
+
+    for i, shard_ids in enumerate(self._shard_ids):
+      self._Start(i)
+      if self._stopping.wait(_IDENTIFY_INTERVAL_S * len(shard_ids)):
+        break
+
+    while not self._stopping.is_set():
+      running: list[Any] = [p.sentinel for p in self._processes if p and p.exitcode is None]
+      multiprocessing.connection.wait(running, timeout=_POLL_INTERVAL_S)
+      self._Restart()
+
+    self._Stop()
+
+  # Schedules a restart of every process that has exited, and restarts those whose delay is up.
+  def _Restart(self) -> None:
+    now: float = time.monotonic()
+    for i, process in enumerate(self._processes):
+      if process is None or process.exitcode is None:
+        continue
+
+      if self._restart_at[i] is None:
+        if now - self._started[i] >= _HEALTHY_RUN_S:
+          self._delays[i] = _RESTART_DELAY_S
+        self._restart_at[i] = now + self._delays[i]
+        utils.log(utils.LogSeverity.ERROR,
+                  f'Shard process {i} (shards {self._shard_ids[i]}) exited with code '
+                  f'{process.exitcode}; restarting in {self._delays[i]:.0f}s.')
+        self._delays[i] = min(_MAX_RESTART_DELAY_S, self._delays[i] * 2)
+
+      restart_at: Optional[float] = self._restart_at[i]
+      if restart_at is not None and now >= restart_at:
+        process.close()
+        self._Start(i)
+
+  def _Start(self, i: int) -> None:
+    process: multiprocessing.process.BaseProcess = self._context.Process(
+        target=self._target, args=(i, self._shard_ids[i]), name=f'shard-{i}')
+    process.start()
+
+    self._processes[i] = process
+    self._started[i] = time.monotonic()
+    self._restart_at[i] = None
+    utils.log(utils.LogSeverity.INFO,
+              f'Started shard process {i} (shards {self._shard_ids[i]}), pid {process.pid}.')
+
+  # Asks every process to exit (which saves its state), killing any that take too long.
+  def _Stop(self) -> None:
+    running: list[multiprocessing.process.BaseProcess] = [
+        p for p in self._processes if p and p.exitcode is None]
+    utils.log(utils.LogSeverity.INFO, f'Stopping {len(running)} shard processes.')
+
+    for process in running:
+      process.terminate()
+
+    deadline: float = time.monotonic() + _STOP_TIMEOUT_S
+    for process in running:
+      process.join(max(0.0, deadline - time.monotonic()))
+      if process.exitcode is None:
+        utils.log(utils.LogSeverity.WARNING, f'Killing unresponsive shard process {process.pid}.')
+        process.kill()
+        process.join()
@@ -1,7 +1,13 @@
 #!/usr/bin/python3
 
 import argparse
+import asyncio
+import collections
+import datetime
+import functools
 import json
+import os
+import time
 
 from typing import Any, cast, Iterator, Optional
 
@@ -9,11 +15,64 @@ import discord
 import discord.ext.commands as dcoms
 import discord.commands.context as dctx
 
+import broadcasts
+import cache
+import catalog
+import encoders
 import guilds
+import messages
+import metrics
+import playlists
+import prefetch
+import search
+import shards
+import state
 import utils
 
 _CONFIG_FILE: str = 'shilo.json'
 
+# Default location of the persistent library index.
+_INDEX_FILE: str = 'shilo.db'
+
+# Default location of the persistent playback state.
+_STATE_FILE: str = 'shilo-state.db'
+
+# How often to save the position of every playing guild.
+_CHECKPOINT_INTERVAL_S: float = 30.0
+
+# Defaults for evicting unused guilds from memory: the most guilds kept, and how long a guild can go
+# unused before it's evicted regardless.
+_MAX_GUILDS: int = 1000
+_GUILD_IDLE_S: float = 24 * 3600
+
+# Guilds used more recently than this are never evicted, so that no command is cut short.
+_MIN_GUILD_IDLE_S: float = 300
+
+# How often to look for idle guilds.
+_EVICT_INTERVAL_S: float = 60
+
+# Prefixes the values of track autocomplete suggestions, which are track ids rather than names.
+_TRACK_CHOICE_PREFIX: str = '#'
+
+# Defaults for the optional track cache.
+_CACHE_MAX_BYTES: int = 4 * 2**30
+_CACHE_WORKERS: int = 2
+
+# Default time by which playback is buffered ahead; none.
+_BUFFER_MS: int = 0
+
+# Defaults for prefetching upcoming tracks: how many to read ahead per playlist, and the rate at
+# which they're read, across all guilds.
+_PREFETCH_TRACKS: int = 3
+_PREFETCH_MIB_PER_S: float = 16
+
+# Default limit on Discord API calls a second for messages about playback, across all guilds. Well
+# under Discord's global limit, which also covers command responses.
+_MESSAGES_PER_S: float = 40
+
+# Default limit on concurrently-running ffmpeg processes.
+_MAX_ENCODERS: int = 4 * (os.cpu_count() or 1)
+
 # Strings for the bot help message.
 _HELP_MESSAGE: str = (
     'I am a renowned bard, here to play shuffled music to suit your mood.'
@@ -39,6 +98,12 @@ _HELP_TABLE: list[list[str]] = [
     ['', '', ''],
     ['/next', '', 'Skips to the next track in the current playlist.'],
     ['', '', ''],
+    [
+        '/play', 'track [playlist name]',
+        'Jumps to the track with the given name, in the given playlist, the current playlist or ' +
+        'else any playlist holding it.'
+    ],
+    ['', '', ''],
     [
         '/ff', 'interval',
         'Fast-forwards the current track by the interval given. The interval should be a string ' +
@@ -46,16 +111,32 @@ _HELP_TABLE: list[list[str]] = [
     ],
     ['', '', ''],
     [
-        '/list', '[playlist name]',
+        '/seek', 'position',
+        'Moves to the given position in the current track, either as a time like "1:30" or as an ' +
+        'interval like "90s".'
+    ],
+    ['', '', ''],
+    [
+        '/list', '[playlist name] [page]',
         'Prints a track listing of the given playlist, or the listing of all playlists if no ' +
-        'playlist is given.'
+        'playlist is given. Long listings are split into pages.'
     ],
     ['', '', ''],
     ['/help', '', 'Shows the command index.'],
+    ['', '', ''],
+    ['/stats', '', 'Shows performance statistics. Administrators only.'],
 ]
 
 _HELP_WIDTH: int = 40
 
+_STATS_WIDTH: int = 60
+
+# Discord's limit on message length, less room for formatting.
+_MAX_MESSAGE_CHARS: int = 1990
+
+_COMMAND_SECONDS: metrics.Histogram = metrics.Histogram(
+    'shilo_command_seconds', 'Time to handle a slash command.', label='command')
+
 _CMD_DESCS = {
     'join': 'Adds the bot to your current voice channel',
     'leave': 'Removes the bot from your current voice channel',
@@ -63,36 +144,133 @@ _CMD_DESCS = {
     'restart': 'Reshuffles and starts a playlist',
     'stop': 'Stops playback',
     'next': 'Skips to the next track in the current playlist',
+    'play': 'Jumps to a track by name',
     'ff': 'Fast forwards the current track by the given interval',
+    'seek': 'Moves to the given position in the current track',
     'list': 'Displays the available playlists or tracks in the given playlist',
     'help': 'Explains how to use the bot',
+    'stats': 'Shows performance statistics',
 }
 
 _CMD_ARG_DESCS = {
     'list': 'The playlist whose tracks to list (otherwise, available playlists will be listed)',
+    'page': 'The page of the listing to show (defaults to the page with the current track)',
     'start': 'The playlist to start (defaults to the last-played playlist)',
     'restart': 'The playlist to restart (defaults to the last-played playlist)',
     'ff': 'The time interval to fast-forward by (e.g. "1s", "2 min")',
+    'seek': 'The position to move to (e.g. "1:30", "90s")',
+    'play': 'The name of the track to play',
+    'play_playlist': 'The playlist to play the track in (defaults to any playlist holding it)',
 }
 
+# Autocompletes playlist names.
+async def _suggest_playlists(ctx: discord.AutocompleteContext) -> list[str]:
+  return cast('ShiloBot', ctx.bot).SuggestPlaylists(ctx.value or '')
+
+
+# Autocompletes track names, limited to the chosen playlist if there is one.
+async def _suggest_tracks(ctx: discord.AutocompleteContext) -> list[discord.OptionChoice]:
+  return cast('ShiloBot', ctx.bot).SuggestTracks(ctx.value or '', ctx.options.get('playlist_name'))
+
+
 # The top-level bot. Responsible for creating independent presences in different guilds and
 # forwarding them commands.
-class ShiloBot(dcoms.Bot):
+#
+# Runs the given shards of the bot, or else as many as Discord recommends.
+class ShiloBot(dcoms.AutoShardedBot):
   # I'm including some prefix that will hopefully never match, so that not every message is passed
   # to my bot. Given I'm using slash commands, I'm not sure this is necessary.
   _CMD_PREFIX = '__shilo'
 
-  def __init__(self, playlist_config: dict[str, list[str]]):
+  def __init__(self, playlist_config: dict[str, list[str]],
+               index: Optional[catalog.LibraryIndex] = None,
+               track_cache: Optional[cache.TrackCache] = None,
+               max_encoders: int = _MAX_ENCODERS,
+               broadcast_names: Optional[list[str]] = None,
+               metrics_port: Optional[int] = None,
+               store: Optional[state.StateStore] = None,
+               max_guilds: int = _MAX_GUILDS,
+               guild_idle_s: float = _GUILD_IDLE_S,
+               read_ahead: datetime.timedelta = datetime.timedelta(milliseconds=_BUFFER_MS),
+               prefetcher: Optional[prefetch.Prefetcher] = None,
+               sender: Optional[messages.Sender] = None,
+               shard_ids: Optional[list[int]] = None,
+               shard_count: Optional[int] = None,
+               probe: bool = True):
     super().__init__(command_prefix=self._CMD_PREFIX, help_command=None,
                      intents=discord.Intents(messages=True,
                                              message_content=True,
                                              guilds=True,
-                                             voice_states=True))
-
-    self._playlist_config: dict[str, list[str]] = playlist_config
-    self._guilds: dict[int, guilds.ShiloGuild] = {}
+                                             voice_states=True),
+                     shard_ids=shard_ids, shard_count=shard_count)
+
+    # Resolve playlist globs once for all guilds. When running in several processes, only one
+    # probes the library.
+    self._catalog: catalog.Catalog = catalog.Catalog(playlist_config, index)
+    if probe:
+      self._catalog.StartProbing()
+    self._search: search.TrackSearch = search.TrackSearch(self._catalog)
+
+    self._cache: Optional[cache.TrackCache] = track_cache
+
+    # How far ahead of playback every stream is read.
+    self._read_ahead: datetime.timedelta = read_ahead
+
+    # Shared by all guilds, so that prefetching stays within one I/O budget.
+    self._prefetcher: Optional[prefetch.Prefetcher] = prefetcher
+
+    # Shared by all guilds, so that messages about playback stay within Discord's rate limits.
+    self._sender: messages.Sender = sender or messages.Sender()
+
+    # Shared by all guilds, so that the total number of ffmpeg processes is bounded.
+    self._encoders: encoders.Supervisor = encoders.Supervisor(max_encoders)
+
+    # Playlists played once for every guild that starts them.
+    self._broadcasts: dict[str, broadcasts.Broadcast] = {
+        name: broadcasts.Broadcast(playlists.Playlist(name, self._catalog, self._encoders,
+                                                      self._cache, owner=name,
+                                                      read_ahead=read_ahead,
+                                                      prefetcher=prefetcher))
+        for name in broadcast_names or [] if name in playlist_config
+    }
+    # In least- to most-recently used order, along with the (monotonic) time each was last used.
+    self._guilds: collections.OrderedDict[int, guilds.ShiloGuild] = collections.OrderedDict()
+    self._last_used: dict[int, float] = {}
+
+    # Guilds being built, keyed by id.
+    self._building: dict[int, asyncio.Future[guilds.ShiloGuild]] = {}
+
+    # Remembers each guild's playback state between runs, if given. Unused guilds are only evicted
+    # from memory if there's somewhere to save them.
+    self._store: Optional[state.StateStore] = store
+    self._max_guilds: int = max_guilds
+    self._guild_idle_s: float = guild_idle_s
+
+    # Local port on which to serve metrics, if any.
+    self._metrics_port: Optional[int] = metrics_port
+    self._monitors: list[asyncio.Task] = []
+
+    # Start times of commands being handled, keyed by interaction id.
+    self._command_starts: dict[int, float] = {}
+
+    metrics.Gauge('shilo_guilds', 'Guilds in memory.', lambda: len(self._guilds))
+    metrics.Gauge('shilo_voice_connections', 'Voice channels connected to.',
+                  lambda: len(self.voice_clients))
+    metrics.Gauge('shilo_playing', 'Voice channels being played to.',
+                  lambda: sum(1 for vc in self.voice_clients
+                              if cast(discord.VoiceClient, vc).is_playing()))
+    metrics.Gauge('shilo_encoders_active', 'ffmpeg processes running.',
+                  lambda: self._encoders.active)
+    metrics.Gauge('shilo_encoders_queued', 'Streams waiting for an ffmpeg process.',
+                  lambda: self._encoders.queued)
+    metrics.Gauge('shilo_tracks_quarantined', 'Tracks skipped because they couldn\'t be played.',
+                  lambda: self._catalog.quarantined_count)
+    metrics.Gauge('shilo_messages_queued', 'Messages about playback waiting to be sent.',
+                  lambda: self._sender.queued)
 
     self._RegisterOnReady()
+    self._RegisterCommandTiming()
+    self._RegisterLogFields()
     self._RegisterOnVoiceStateUpdate()
     self._RegisterJoin()
     self._RegisterLeave()
@@ -100,11 +278,81 @@ class ShiloBot(dcoms.Bot):
     self._RegisterRestart()
     self._RegisterStop()
     self._RegisterNext()
+    self._RegisterPlay()
     self._RegisterFastForward()
+    self._RegisterSeek()
     self._RegisterList()
     self._RegisterHelp()
+    self._RegisterStats()
     self._RegisterOnCommandError()
 
+  # Starts background monitoring before connecting.
+  async def start(self, token: str, *, reconnect: bool = True) -> None:
+    self._monitors.append(asyncio.create_task(metrics.monitor_loop_lag()))
+    self._monitors.append(asyncio.create_task(metrics.watch_loop()))
+    if self._metrics_port is not None:
+      self._monitors.append(asyncio.create_task(metrics.serve(self._metrics_port)))
+    if self._store:
+      self._monitors.append(asyncio.create_task(self._Checkpoint()))
+      self._monitors.append(asyncio.create_task(self._EvictIdle()))
+
+    await super().start(token, reconnect=reconnect)
+
+  # Saves any unwritten playback state before disconnecting.
+  async def close(self) -> None:
+    if self._store:
+      self._SaveAll()
+      await utils.run_blocking(self._store.Flush)
+
+    await super().close()
+
+  # Periodically saves the position of every playing guild, so that little is lost in a crash.
+  async def _Checkpoint(self) -> None:
+    while True:
+      await asyncio.sleep(_CHECKPOINT_INTERVAL_S)
+      self._SaveAll(playing_only=True)
+
+  # Periodically evicts guilds that haven't been used for a long time.
+  async def _EvictIdle(self) -> None:
+    while True:
+      await asyncio.sleep(_EVICT_INTERVAL_S)
+      self._EvictGuilds(self._max_guilds, self._guild_idle_s)
+
+  # Evicts least-recently-used guilds until at most the given number remain, along with any unused
+  # for longer than the given time. Connected guilds and recently-used guilds are kept. Evicted
+  # guilds are saved, to be rebuilt on next use.
+  def _EvictGuilds(self, limit: int, idle_s: Optional[float] = None) -> None:
+    if not self._store:
+      return
+
+    connected: set[int] = {vc.guild.id
+                           for vc in cast(list[discord.VoiceClient], self.voice_clients)}
+    now: float = time.monotonic()
+
+    evicted: int = 0
+    for guild_id in list(self._guilds):
+      idle: float = now - self._last_used[guild_id]
+      if len(self._guilds) <= limit and (idle_s is None or idle <= idle_s):
+        # Every later guild was used more recently.
+        break
+
+      if guild_id in connected or idle < _MIN_GUILD_IDLE_S:
+        continue
+
+      self._guilds.pop(guild_id).Close()
+      del self._last_used[guild_id]
+      evicted += 1
+
+    if evicted:
+      utils.log(utils.LogSeverity.INFO, f'Evicted {evicted} idle guilds.')
+
+  def _SaveAll(self, playing_only: bool = False) -> None:
+    playing: set[int] = {vc.guild.id for vc in cast(list[discord.VoiceClient], self.voice_clients)
+                         if vc.is_playing()}
+    for guild_id, guild in self._guilds.items():
+      if guild_id in playing or not playing_only:
+        guild.SaveState()
+
   def _RegisterOnReady(self) -> None:
 
     @self.event
@@ -112,6 +360,33 @@ class ShiloBot(dcoms.Bot):
       name = self.user.name if self.user else 'Bot'
       utils.log(utils.LogSeverity.INFO, f'{name} connected.')
 
+  # Records the time taken to handle each slash command.
+  def _RegisterCommandTiming(self) -> None:
+
+    async def on_application_command(ctx: dctx.ApplicationContext) -> None:
+      self._command_starts[ctx.interaction.id] = time.perf_counter()
+
+    async def on_application_command_completion(ctx: dctx.ApplicationContext) -> None:
+      started: Optional[float] = self._command_starts.pop(ctx.interaction.id, None)
+      if started is not None and ctx.command:
+        _COMMAND_SECONDS.Observe(time.perf_counter() - started, ctx.command.qualified_name)
+
+    async def on_application_command_error(ctx: dctx.ApplicationContext,
+                                           error: discord.DiscordException) -> None:
+      self._command_starts.pop(ctx.interaction.id, None)
+
+    self.add_listener(on_application_command)
+    self.add_listener(on_application_command_completion)
+    self.add_listener(on_application_command_error)
+
+  # Attributes everything logged while handling a command to the command and its guild.
+  def _RegisterLogFields(self) -> None:
+
+    @self.before_invoke
+    async def set_log_fields(ctx: dctx.ApplicationContext) -> None:
+      utils.set_log_fields(guild=ctx.guild_id,
+                           command=ctx.command.qualified_name if ctx.command else None)
+
   def _RegisterOnVoiceStateUpdate(self) -> None:
 
     @self.event
@@ -131,19 +406,19 @@ class ShiloBot(dcoms.Bot):
       if not bot_vc:
         return
 
-      await self._EnsureGuild(guild).OnVoiceStateUpdate(bot_vc, before, after)
+      await (await self._EnsureGuild(guild)).OnVoiceStateUpdate(bot_vc, before, after)
 
   def _RegisterJoin(self) -> None:
 
     @self.slash_command(description=_CMD_DESCS['join'])
     async def join(ctx: dctx.ApplicationContext) -> None:
-      await self._EnsureGuild(ctx.guild).Join(ctx, announce=True)
+      await (await self._EnsureGuild(ctx.guild)).Join(ctx, announce=True)
 
   def _RegisterLeave(self) -> None:
 
     @self.slash_command(description=_CMD_DESCS['leave'])
     async def leave(ctx: dctx.ApplicationContext) -> None:
-      await self._EnsureGuild(ctx.guild).Leave(ctx)
+      await (await self._EnsureGuild(ctx.guild)).Leave(ctx)
 
   def _RegisterStart(self) -> None:
 
@@ -152,9 +427,10 @@ class ShiloBot(dcoms.Bot):
                     playlist_name: discord.Option(
                         str,
                         _CMD_ARG_DESCS['start'],
-                        required=False
+                        required=False,
+                        autocomplete=_suggest_playlists
                     )) -> None:
-      await self._EnsureGuild(ctx.guild).Start(ctx, playlist_name)
+      await (await self._EnsureGuild(ctx.guild)).Start(ctx, playlist_name)
 
   def _RegisterRestart(self) -> None:
 
@@ -163,21 +439,73 @@ class ShiloBot(dcoms.Bot):
                       playlist_name: discord.Option(
                           str,
                           _CMD_ARG_DESCS['restart'],
-                          required=False
+                          required=False,
+                          autocomplete=_suggest_playlists
                       )) -> None:
-      await self._EnsureGuild(ctx.guild).Restart(ctx, playlist_name)
+      await (await self._EnsureGuild(ctx.guild)).Restart(ctx, playlist_name)
 
   def _RegisterStop(self) -> None:
 
     @self.slash_command(description=_CMD_DESCS['stop'])
     async def stop(ctx: dctx.ApplicationContext) -> None:
-      await self._EnsureGuild(ctx.guild).Stop(ctx)
+      await (await self._EnsureGuild(ctx.guild)).Stop(ctx)
 
   def _RegisterNext(self) -> None:
 
     @self.slash_command(description=_CMD_DESCS['next'])
     async def next(ctx: dctx.ApplicationContext) -> None:
-      await self._EnsureGuild(ctx.guild).Next(ctx)
+      await (await self._EnsureGuild(ctx.guild)).Next(ctx)
+
+  def _RegisterPlay(self) -> None:
+
+    @self.slash_command(description=_CMD_DESCS['play'])
+    async def play(ctx: dctx.ApplicationContext,
+                   track: discord.Option(
+                       str,
+                       _CMD_ARG_DESCS['play'],
+                       required=True,
+                       autocomplete=_suggest_tracks
+                   ),
+                   playlist_name: discord.Option(
+                       str,
+                       _CMD_ARG_DESCS['play_playlist'],
+                       required=False,
+                       autocomplete=_suggest_playlists
+                   )) -> None:
+      track_id: Optional[int] = self._ResolveTrack(track, playlist_name)
+      if track_id is None:
+        utils.log(utils.LogSeverity.WARNING, f'No track matching "{track}".')
+        await ctx.respond(f'Couldn\'t find track "{track}"'
+                          + (f' in playlist "{playlist_name}"!' if playlist_name else '!'))
+        return
+
+      playlist_names: list[str] = ([playlist_name] if playlist_name
+                                   else self._search.GetPlaylists(track_id))
+      await (await self._EnsureGuild(ctx.guild)).Play(ctx, track_id, playlist_names)
+
+  # Returns the id of the track chosen from the autocomplete suggestions, or else of the track best
+  # matching the given text. Only tracks in the given playlist are considered, if one is given.
+  def _ResolveTrack(self, value: str, playlist_name: Optional[str]) -> Optional[int]:
+    if value.startswith(_TRACK_CHOICE_PREFIX) and value[1:].isdigit():
+      track: int = int(value[1:])
+      if playlist_name and self._search.Contains(playlist_name, track):
+        return track
+      if not playlist_name and track < self._catalog.track_count:
+        return track
+
+    matches: list[int] = self._search.Search(value, playlist_name, limit=1)
+    return matches[0] if matches else None
+
+  # Returns autocomplete suggestions for the given partial playlist name.
+  def SuggestPlaylists(self, value: str) -> list[str]:
+    return self._search.SearchPlaylists(value)
+
+  # Returns autocomplete suggestions for the given partial track name, limited to the given playlist
+  # if there is one.
+  def SuggestTracks(self, value: str,
+                    playlist_name: Optional[str] = None) -> list[discord.OptionChoice]:
+    return [discord.OptionChoice(self._catalog.GetName(t)[:100], f'{_TRACK_CHOICE_PREFIX}{t}')
+            for t in self._search.Search(value, playlist_name)]
 
   def _RegisterFastForward(self) -> None:
 
@@ -188,7 +516,18 @@ class ShiloBot(dcoms.Bot):
                      _CMD_ARG_DESCS['ff'],
                      required=True
                  )) -> None:
-      await self._EnsureGuild(ctx.guild).FastForward(ctx, interval)
+      await (await self._EnsureGuild(ctx.guild)).FastForward(ctx, interval)
+
+  def _RegisterSeek(self) -> None:
+
+    @self.slash_command(description=_CMD_DESCS['seek'])
+    async def seek(ctx: dctx.ApplicationContext,
+                   position: discord.Option(
+                       str,
+                       _CMD_ARG_DESCS['seek'],
+                       required=True
+                   )) -> None:
+      await (await self._EnsureGuild(ctx.guild)).Seek(ctx, position)
 
   def _RegisterList(self) -> None:
 
@@ -197,9 +536,16 @@ class ShiloBot(dcoms.Bot):
                    playlist_name: discord.Option(
                        str,
                        _CMD_ARG_DESCS['list'],
-                       required=False
+                       required=False,
+                       autocomplete=_suggest_playlists
+                   ),
+                   page: discord.Option(
+                       int,
+                       _CMD_ARG_DESCS['page'],
+                       required=False,
+                       min_value=1
                    )) -> None:
-      await self._EnsureGuild(ctx.guild).List(ctx, playlist_name)
+      await (await self._EnsureGuild(ctx.guild)).List(ctx, playlist_name, page)
 
   def _RegisterHelp(self) -> None:
 
@@ -208,6 +554,32 @@ class ShiloBot(dcoms.Bot):
       utils.log(utils.LogSeverity.INFO, 'Printing help.')
       await ctx.respond(f'{_HELP_MESSAGE}\n```{utils.format_table(_HELP_TABLE, _HELP_WIDTH)}```')
 
+  def _RegisterStats(self) -> None:
+
+    @self.slash_command(description=_CMD_DESCS['stats'],
+                        default_member_permissions=discord.Permissions(administrator=True))
+    async def stats(ctx: dctx.ApplicationContext) -> None:
+      # Permissions can be overridden per server, so check again.
+      if (not isinstance(ctx.author, discord.Member)
+              or not ctx.author.guild_permissions.administrator):
+        await ctx.respond('Only administrators can view statistics!', ephemeral=True)
+        return
+
+      utils.log(utils.LogSeverity.INFO, 'Printing stats.')
+      rows: list[list[str]] = [[name, value] for name, value in metrics.summarise()]
+
+      # Split over as many messages as needed.
+      lines: list[str] = utils.format_table(rows, _STATS_WIDTH).split('\n')
+      while lines:
+        count: int = 1
+        size: int = len(lines[0])
+        while count < len(lines) and size + len(lines[count]) + 1 <= _MAX_MESSAGE_CHARS:
+          size += len(lines[count]) + 1
+          count += 1
+
+        await ctx.respond('```\n' + '\n'.join(lines[:count]) + '```', ephemeral=True)
+        lines = lines[count:]
+
   def _RegisterOnCommandError(self) -> None:
 
     @self.event
@@ -224,25 +596,123 @@ class ShiloBot(dcoms.Bot):
       await ctx.respond('Command failed! Internal error.')
       utils.log(utils.LogSeverity.ERROR, f'Internal error: "{error}".')
 
-  # Retrieve the object for the given guild, creating a new one if necessary.
-  def _EnsureGuild(self, g: discord.Guild) -> guilds.ShiloGuild:
-    if g.id not in self._guilds:
-      self._guilds[g.id] = guilds.ShiloGuild(self._playlist_config)
-      utils.log(utils.LogSeverity.INFO, f'Initialising for guild "{g.name}".')
+  # Retrieve the object for the given guild, creating a new one (or rebuilding an evicted one) if
+  # necessary. Marks the guild as recently used.
+  async def _EnsureGuild(self, g: discord.Guild) -> guilds.ShiloGuild:
+    # Attribute everything logged while handling this event to the guild.
+    utils.set_log_fields(guild=g.id)
 
+    if g.id not in self._guilds:
+      # Building a guild reads its saved state, so is done off the event loop. Concurrent commands
+      # for a new guild share one build.
+      building: Optional[asyncio.Future[guilds.ShiloGuild]] = self._building.get(g.id)
+      if building is None:
+        # Make room for the new guild.
+        self._EvictGuilds(self._max_guilds - 1)
+
+        building = self._building[g.id] = utils.run_blocking(
+            guilds.ShiloGuild, g.id, self._catalog, self._encoders, self._cache, self._broadcasts,
+            self._store, self._read_ahead, self._prefetcher, self._sender)
+        building.add_done_callback(lambda _, guild_id=g.id: self._building.pop(guild_id, None))
+
+      guild: guilds.ShiloGuild = await asyncio.shield(building)
+      if g.id not in self._guilds:
+        self._guilds[g.id] = guild
+        utils.log(utils.LogSeverity.INFO, f'Initialising for guild "{g.name}".')
+    else:
+      self._guilds.move_to_end(g.id)
+
+    self._last_used[g.id] = time.monotonic()
     return self._guilds[g.id]
 
 
+# Runs the bot in this process: either every shard, or the given shards as the given one of several
+# processes. Processes split the encoder limit between them, share the track cache, and each has
+# its own metrics port.
+def run(config: dict[str, Any], process: int = 0, processes: int = 1,
+        shard_ids: Optional[list[int]] = None, shard_count: Optional[int] = None) -> None:
+  utils.log(utils.LogSeverity.INFO, 'Loading library index.')
+  index: catalog.LibraryIndex = catalog.LibraryIndex(config.get('index', _INDEX_FILE))
+
+  track_cache: Optional[cache.TrackCache] = None
+  if 'cache' in config:
+    cache_config: dict[str, Any] = config['cache']
+    # Shared by every process, so that each track is only encoded once.
+    track_cache = cache.TrackCache(cache_config['directory'],
+                                   cache_config.get('max_bytes', _CACHE_MAX_BYTES),
+                                   cache_config.get('workers', _CACHE_WORKERS))
+
+  store: state.StateStore = state.StateStore(config.get('state', _STATE_FILE))
+
+  prefetcher: Optional[prefetch.Prefetcher] = None
+  prefetch_tracks: int = config.get('prefetch_tracks', _PREFETCH_TRACKS)
+  if prefetch_tracks > 0:
+    prefetcher = prefetch.Prefetcher(
+        prefetch_tracks,
+        int(config.get('prefetch_mib_per_s', _PREFETCH_MIB_PER_S) * 2**20 / processes))
+
+  # Discord's global rate limit is shared by every process.
+  sender: messages.Sender = messages.Sender(
+      config.get('messages_per_s', _MESSAGES_PER_S) / processes)
+
+  # The limit covers every ffmpeg process. Background ones (the cache's transcoders, and the library
+  # prober in the first process) run outside the supervisor, so their share is set aside and
+  # playback gets the rest.
+  max_encoders: int = max(1, config.get('max_encoders', _MAX_ENCODERS) // processes)
+  background_encoders: int = (track_cache.workers if track_cache else 0) + (process == 0)
+  playback_encoders: int = max(1, max_encoders - background_encoders)
+
+  metrics_port: Optional[int] = config.get('metrics_port')
+  bot: ShiloBot = ShiloBot(config['playlists'], index, track_cache,
+                           playback_encoders,
+                           config.get('broadcasts', []),
+                           metrics_port + process if metrics_port is not None else None, store,
+                           config.get('max_guilds', _MAX_GUILDS),
+                           config.get('guild_idle_s', _GUILD_IDLE_S),
+                           datetime.timedelta(milliseconds=config.get('buffer_ms', _BUFFER_MS)),
+                           prefetcher,
+                           sender,
+                           shard_ids, shard_count, probe=process == 0)
+
+  utils.log(utils.LogSeverity.INFO, 'Connecting to Discord.')
+  bot.run(config['token'])
+
+
+# Entry point of each shard process when running in several.
+def _run_process(config_path: str, processes: int, shard_count: int, process: int,
+                 shard_ids: list[int]) -> None:
+  utils.set_log_fields(process=process)
+  run(_load_config(config_path), process, processes, shard_ids, shard_count)
+
+
+def _load_config(path: str) -> dict[str, Any]:
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
 def main() -> None:
   parser = argparse.ArgumentParser()
   parser.add_argument('--config', type=str, default=_CONFIG_FILE)
   args = parser.parse_args()
 
-  config: dict[str, Any] = json.loads(open(args.config, 'r').read())
-  bot: ShiloBot = ShiloBot(config['playlists'])
+  config: dict[str, Any] = _load_config(args.config)
 
-  utils.log(utils.LogSeverity.INFO, 'Connecting to Discord.')
-  bot.run(config['token'])
+  processes: int = config.get('processes', 1)
+  shard_count: Optional[int] = config.get('shards')
+  if processes <= 1:
+    run(config, shard_ids=list(range(shard_count)) if shard_count else None,
+        shard_count=shard_count)
+    return
+
+  # Bring the library index up to date once, so that the processes start from it rather than all
+  # rescanning the library at once.
+  utils.log(utils.LogSeverity.INFO, 'Updating library index.')
+  catalog.Catalog(config['playlists'], catalog.LibraryIndex(config.get('index', _INDEX_FILE)))
+
+  shard_count = shard_count or processes
+  processes = min(processes, shard_count)
+  shards.ShardSupervisor(functools.partial(_run_process, args.config, processes, shard_count),
+                         processes, shard_count).Run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+import json
+import sqlite3
+import threading
+import time
+
+from typing import Any, Optional
+
+import utils
+
+# How long to wait after a change before writing, so that bursts of changes share a transaction.
+_WRITE_DELAY_S: float = 2.0
+
+# Limit on the time to wait for another process (e.g. another shard process) to finish writing.
+_BUSY_TIMEOUT_S: float = 60.0
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS guilds (
+  id INTEGER PRIMARY KEY,
+  state TEXT NOT NULL
+);
+"""
+
+
+# Persistent per-guild playback state (e.g. the current playlist and each playlist's position),
+# stored in SQLite as one JSON object per guild.
+#
+# Saves are write-behind: they only replace the guild's pending state in memory, and a background
+# thread writes every pending state in one transaction shortly afterwards. Loads see pending states,
+# including those still being written, and otherwise read through their own connection, so they
+# never wait for a write.
+#
+# Safe to use from multiple threads.
+class StateStore:
+
+  def __init__(self, path: str):
+    self._writer: sqlite3.Connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT_S,
+                                                       check_same_thread=False)
+    self._writer.execute('PRAGMA journal_mode=WAL')
+    self._writer.execute('PRAGMA synchronous=NORMAL')
+    self._writer.executescript(_SCHEMA)
+    self._writer.commit()
+
+    self._read_lock: threading.Lock = threading.Lock()
+    self._reader: sqlite3.Connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT_S,
+                                                       check_same_thread=False)
+
+    # Serialised states not yet written, and those being written but not yet committed, by guild
+    # id. Guarded by the condition.
+    self._cond: threading.Condition = threading.Condition()
+    self._pending: dict[int, str] = {}
+    self._writing: dict[int, str] = {}
+
+    # Held while a batch is being written.
+    self._write_lock: threading.Lock = threading.Lock()
+
+    threading.Thread(target=self._WriteBehind, name='state', daemon=True).start()
+
+  # Returns the saved state of the given guild, if any.
+  def Load(self, guild_id: int) -> Optional[dict[str, Any]]:
+    with self._cond:
+      serialised: Optional[str] = self._pending.get(guild_id, self._writing.get(guild_id))
+
+    if serialised is None:
+      with self._read_lock:
+        row = self._reader.execute('SELECT state FROM guilds WHERE id = ?',
+                                   (guild_id,)).fetchone()
+      if not row:
+        return None
+      serialised = row[0]
+
+    try:
+      return json.loads(serialised)
+    except ValueError:
+      utils.log(utils.LogSeverity.WARNING, f'Ignoring corrupt state of guild {guild_id}.')
+      return None
+
+  # Schedules the given state of the given guild to be saved, replacing any earlier state.
+  def Save(self, guild_id: int, guild_state: dict[str, Any]) -> None:
+    serialised: str = json.dumps(guild_state, separators=(',', ':'))
+    with self._cond:
+      self._pending[guild_id] = serialised
+      self._cond.notify()
+
+  # Writes every pending state now. Blocks until done.
+  def Flush(self) -> None:
+    with self._write_lock:
+      with self._cond:
+        batch: dict[int, str] = self._pending
+        self._pending = {}
+        self._writing = batch
+      try:
+        self._Write(batch)
+      finally:
+        # Loads read the committed states from now on (or, if the write failed, the pending ones).
+        with self._cond:
+          self._writing = {}
+
+  # Runs on a background thread.
+  def _WriteBehind(self) -> None:
+    while True:
+      with self._cond:
+        while not self._pending:
+          self._cond.wait()
+
+      # Let further changes accumulate.
+      time.sleep(_WRITE_DELAY_S)
+      self.Flush()
+
+  def _Write(self, batch: dict[int, str]) -> None:
+    if not batch:
+      return
+
+    try:
+      with self._writer:
+        self._writer.executemany('INSERT OR REPLACE INTO guilds (id, state) VALUES (?, ?)',
+                                 batch.items())
+    except sqlite3.Error as e:
+      utils.log(utils.LogSeverity.ERROR, f'Couldn\'t save guild state: "{e}".')
+      # Retry with the next batch, unless superseded.
+      with self._cond:
+        for guild_id, serialised in batch.items():
+          self._pending.setdefault(guild_id, serialised)
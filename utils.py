@@ -1,11 +1,22 @@
 #!/usr/bin/python3
 
+import asyncio
+import atexit
+import concurrent.futures as futures
+import contextvars
 import datetime
 import enum
+import functools
+import json
 import os
+import queue
+import random
+import sys
 import textwrap
+import threading
+import time
 
-from typing import Any, Coroutine, Iterable, Optional
+from typing import Any, Callable, Coroutine, Iterable, Optional, TypeVar
 
 
 # Used to signal the severity of a message, which could lead to different logging behaviour (e.g. a
@@ -17,10 +28,163 @@ class LogSeverity(enum.Enum):
   FATAL = 4
 
 
-# Prints a message to stdout along with the time and an indicator of severity.
-def log(severity: LogSeverity, message: str) -> None:
-  time_str: str = datetime.datetime.now().strftime('%Y-%m-%d %X')
-  print(f'{time_str} [{severity.name}] {message}', flush=True)
+_T = TypeVar('_T')
+
+# Number of threads that run blocking work (e.g. file, database and process work) moved off the
+# event loop. Bounded so that a stalled disk can't tie up unboundedly many threads.
+_BLOCKING_WORKERS: int = 8
+
+# Upper bound on log records waiting to be written. Further records are dropped (and counted)
+# rather than blocking the caller.
+_LOG_QUEUE_SIZE: int = 4096
+
+# Each call to log in the source may write at most this many records per second on average, in
+# bursts of up to _LOG_BURST. Records over the limit are counted in the next one written.
+_LOG_RATE_PER_S: float = 10.0
+_LOG_BURST: float = 50.0
+
+# Fields added to every record logged in the current context (e.g. the guild being served).
+_log_fields: contextvars.ContextVar[dict[str, Any]] = contextvars.ContextVar('log_fields',
+                                                                              default={})
+
+
+# Writes log records to stdout as JSON lines, on a background thread, so that logging never waits
+# for stdout (e.g. a busy journald).
+class _LogWriter:
+
+  def __init__(self):
+    self._queue: queue.Queue[tuple[float, LogSeverity, str, dict[str, Any]]] = queue.Queue(
+        _LOG_QUEUE_SIZE)
+
+    # Guards the fields below, which are touched by every logging thread.
+    self._lock: threading.Lock = threading.Lock()
+    # Per call site: (tokens, monotonic time of last update, records suppressed since last written).
+    self._buckets: dict[tuple[str, int], tuple[float, float, int]] = {}
+    self._dropped: int = 0
+    self._unreported: int = 0
+    self._thread: Optional[threading.Thread] = None
+
+  # Queues a record for writing, unless it's sampled out, rate-limited or there's no room.
+  def Log(self, severity: LogSeverity, message: str, fields: dict[str, Any],
+          site: tuple[str, int], sample: float) -> None:
+    if sample < 1 and random.random() >= sample:
+      return
+
+    now: float = time.monotonic()
+    with self._lock:
+      tokens, updated, suppressed = self._buckets.get(site, (_LOG_BURST, now, 0))
+      tokens = min(_LOG_BURST, tokens + (now - updated) * _LOG_RATE_PER_S)
+      if tokens < 1:
+        self._buckets[site] = (tokens, now, suppressed + 1)
+        return
+      self._buckets[site] = (tokens - 1, now, 0)
+
+      if not self._thread:
+        self._thread = threading.Thread(target=self._Write, name='log', daemon=True)
+        self._thread.start()
+        atexit.register(self.Flush)
+
+    if suppressed:
+      fields = {**fields, 'suppressed': suppressed}
+
+    try:
+      self._queue.put_nowait((time.time(), severity, message, fields))
+    except queue.Full:
+      with self._lock:
+        self._dropped += 1
+        self._unreported += 1
+
+  # Number of records dropped because the queue was full.
+  @property
+  def dropped(self) -> int:
+    return self._dropped
+
+  # Blocks until every queued record is written.
+  def Flush(self) -> None:
+    if self._thread:
+      self._queue.join()
+
+  # Runs on a background thread.
+  def _Write(self) -> None:
+    while True:
+      records: list[tuple[float, LogSeverity, str, dict[str, Any]]] = [self._queue.get()]
+      while True:
+        try:
+          records.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+
+      with self._lock:
+        dropped: int = self._unreported
+        self._unreported = 0
+
+      lines: list[str] = [self._Format(*r) for r in records]
+      if dropped:
+        lines.append(self._Format(time.time(), LogSeverity.WARNING,
+                                  f'Dropped {dropped} log records.', {}))
+
+      try:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+      except (OSError, ValueError):
+        pass
+      finally:
+        for _ in records:
+          self._queue.task_done()
+
+  def _Format(self, timestamp: float, severity: LogSeverity, message: str,
+              fields: dict[str, Any]) -> str:
+    return json.dumps({
+        'time': datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds'),
+        'severity': severity.name,
+        'message': message,
+        **fields,
+    }, default=str)
+
+
+_log_writer: _LogWriter = _LogWriter()
+
+
+# Logs a message along with the time, an indicator of severity, any fields set for the current
+# context and the given fields. Records are written to stdout as JSON in the background, so this
+# never blocks; a fraction of noisy messages can be kept by giving a sample rate below 1.
+def log(severity: LogSeverity, message: str, sample: float = 1.0, **fields: Any) -> None:
+  caller = sys._getframe(1)
+  _log_writer.Log(severity, message, {**_log_fields.get(), **fields},
+                  (caller.f_code.co_filename, caller.f_lineno), sample)
+
+
+# Adds the given fields to every record logged in the current context (i.e. the current task and
+# any tasks it starts).
+def set_log_fields(**fields: Any) -> None:
+  _log_fields.set({**_log_fields.get(), **fields})
+
+
+# Blocks until every record logged so far is written.
+def flush_logs() -> None:
+  _log_writer.Flush()
+
+
+# Returns the number of log records dropped because too many were waiting to be written.
+def dropped_logs() -> int:
+  return _log_writer.dropped
+
+
+# Returns the log fields set in the given context.
+def get_log_fields(context: contextvars.Context) -> dict[str, Any]:
+  return context.get(_log_fields, {})
+
+
+_blocking_executor: futures.ThreadPoolExecutor = futures.ThreadPoolExecutor(
+    max_workers=_BLOCKING_WORKERS, thread_name_prefix='blocking')
+
+
+# Runs the given blocking call on a small pool of threads shared by the whole process, so that it
+# doesn't hold up the event loop. Anything logged by the call carries the current log fields.
+def run_blocking(func: Callable[..., _T], *args: Any) -> 'asyncio.Future[_T]':
+  context: contextvars.Context = contextvars.copy_context()
+  return asyncio.get_running_loop().run_in_executor(_blocking_executor,
+                                                    functools.partial(context.run, func, *args))
 
 
 # Helper object holding a callback that can be cancelled.
@@ -28,19 +192,94 @@ class CancellableCoroutine():
 
   def __init__(self, callback: Coroutine[None, None, Any]):
     self._cancelled: bool = False
+    self._started: bool = False
     self._callback: Coroutine[None, None, Any] = callback
 
   def Cancel(self):
     self._cancelled = True
     self._callback.close()
 
+  @property
+  def cancelled(self) -> bool:
+    return self._cancelled
+
+  @property
+  def started(self) -> bool:
+    return self._started
+
   async def Run(self):
     if self._cancelled:
       return
 
+    self._started = True
     await self._callback
 
 
+# A pseudorandom permutation of range(size), determined by a seed. Positions are mapped to values on
+# demand in (expected) constant time, without materialising the order.
+#
+# Uses a balanced Feistel network over the smallest even number of bits that covers the range, so
+# that it's a bijection on that power-of-two domain; values outside the range are "cycle-walked"
+# (re-encrypted until they land in range). The domain is less than four times the range, so this
+# takes under four rounds on average.
+class Permutation:
+  __slots__ = ('_size', '_half_bits', '_half_mask', '_keys')
+
+  _ROUNDS: int = 4
+  _MASK64: int = 2**64 - 1
+
+  def __init__(self, size: int, seed: int):
+    self._size: int = size
+    self._half_bits: int = max(1, ((size - 1).bit_length() + 1) // 2)
+    self._half_mask: int = (1 << self._half_bits) - 1
+
+    rng: random.Random = random.Random(seed)
+    self._keys: tuple[int, ...] = tuple(rng.getrandbits(64) for _ in range(self._ROUNDS))
+
+  def __len__(self) -> int:
+    return self._size
+
+  def __getitem__(self, position: int) -> int:
+    if not 0 <= position < self._size:
+      raise IndexError('Permutation index out of range.')
+
+    value: int = self._Encrypt(position)
+    while value >= self._size:
+      value = self._Encrypt(value)
+    return value
+
+  # Returns the position of the given value, i.e. the inverse of indexing.
+  def Index(self, value: int) -> int:
+    if not 0 <= value < self._size:
+      raise ValueError('Value not in permutation.')
+
+    position: int = self._Decrypt(value)
+    while position >= self._size:
+      position = self._Decrypt(position)
+    return position
+
+  def _Encrypt(self, value: int) -> int:
+    left: int = value >> self._half_bits
+    right: int = value & self._half_mask
+    for key in self._keys:
+      left, right = right, left ^ self._Round(right, key)
+    return (left << self._half_bits) | right
+
+  def _Decrypt(self, value: int) -> int:
+    left: int = value >> self._half_bits
+    right: int = value & self._half_mask
+    for key in reversed(self._keys):
+      left, right = right ^ self._Round(left, key), left
+    return (left << self._half_bits) | right
+
+  # Mixes the given half-block with a round key (after the splitmix64 finaliser).
+  def _Round(self, value: int, key: int) -> int:
+    x: int = (value + key) & self._MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & self._MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & self._MASK64
+    return (x ^ (x >> 31)) & self._half_mask
+
+
 # Basic parsing of human-readable intervals like '1s', '10mins'.
 def parse_interval(s: str) -> Optional[datetime.timedelta]:
   INTERVALS: dict[str, datetime.timedelta] = {
@@ -71,6 +310,25 @@ def parse_interval(s: str) -> Optional[datetime.timedelta]:
     return None
 
 
+# Parsing of a position within a track, given either as a clock time like '1:30' or '1:02:03', or
+# as an interval from the start like '90s'.
+def parse_position(s: str) -> Optional[datetime.timedelta]:
+  if ':' not in s:
+    return parse_interval(s)
+
+  try:
+    parts: list[float] = [float(p) for p in s.strip().split(':')]
+  except ValueError:
+    return None
+  if len(parts) > 3 or any(p < 0 for p in parts):
+    return None
+
+  seconds: float = 0.0
+  for part in parts:
+    seconds = seconds * 60 + part
+  return datetime.timedelta(seconds=seconds)
+
+
 # Returns the basename of the path without any extension.
 def file_stem(path: str) -> str:
   basename: str = os.path.basename(path)
@@ -94,7 +352,7 @@ def format_table(table: Iterable[Iterable[str]], wrap_width: int = 80) -> str:
           unwrapped_entry, wrap_width, replace_whitespace=False) or ['']
 
       # Manually ensure every new line is a separate entry in the list.
-      wrapped_row.append(sum([l.split('\n') for l in wrapped_entry], []))
+      wrapped_row.append([l for line in wrapped_entry for l in line.split('\n')])
 
     # Step 2: pad each entry to be the same number of lines.
     max_lines: int = max(len(entry) for entry in wrapped_row)
@@ -109,14 +367,10 @@ def format_table(table: Iterable[Iterable[str]], wrap_width: int = 80) -> str:
   # Next, pad every line of each column to be the same size.
   for col in list(zip(*wrapped_table)):  # Transposed.
     # Unwrap the entries so that a column contains each line.
-    unwrapped_col: list[str] = sum(col, [])
+    unwrapped_col: list[str] = [l for entry in col for l in entry]
     max_width: int = max(len(l) for l in unwrapped_col)
 
-    padded_col: list[str] = []
-    for entry in unwrapped_col:
-      padded_col.append(entry + ''.join([' '] * (max_width - len(entry))))
-
-    padded_table_t.append(padded_col)
+    padded_table_t.append([entry.ljust(max_width) for entry in unwrapped_col])
 
   # Join padded entries into row strings, then row strings into an output string.
   return '\n'.join('\t'.join(row) for row in zip(*padded_table_t))